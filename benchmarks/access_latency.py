@@ -0,0 +1,143 @@
+"""Measures the Python-side latency of reading and writing signals and of eval().
+
+Usage:
+    python3 benchmarks/access_latency.py [--iterations 200000]
+
+Signals up to 64 bits are read and written directly in the memory of the
+model, through ctypes scalars at the byte offsets exported by the wrapper, and
+signals wider than 64 bits are copied to and from the memory of the model in
+one step. For comparison, every operation is also measured the way it was done
+before, looking up the ctypes getter or setter and setting its types on each
+call, and transferring wide signals one 32-bit word at a time.
+The design is tiny, so the numbers are dominated by the Python overhead.
+
+The second table compares reading and writing through sim.io, which returns
+SignalValue objects, with sim.raw, which returns plain ints.
+"""
+
+import argparse
+import ctypes
+import os
+import shutil
+import tempfile
+import timeit
+
+from pyverilator import PyVerilator
+
+test_verilog = """
+module access_latency (
+        input         clk,
+        input  [31:0] a,
+        input  [63:0] b,
+        input  [511:0] c,
+        output [31:0] x,
+        output [63:0] y,
+        output [511:0] z);
+    reg [31:0] x_reg;
+    reg [63:0] y_reg;
+    reg [511:0] z_reg;
+    always @(posedge clk) begin
+        x_reg <= a;
+        y_reg <= b;
+        z_reg <= c;
+    end
+    assign x = x_reg;
+    assign y = y_reg;
+    assign z = z_reg;
+endmodule
+"""
+
+
+def per_call_read(sim, name, restype):
+    fn = getattr(sim.lib, "get_" + name)
+    fn.argtypes = [ctypes.c_void_p]
+    fn.restype = restype
+    return int(fn(sim.model))
+
+
+def per_call_write(sim, name, argtype, value):
+    fn = getattr(sim.lib, "set_" + name)
+    fn.argtypes = [ctypes.c_void_p, argtype]
+    fn(sim.model, argtype(value))
+
+
+def per_call_read_words(sim, name, num_words):
+    fn = getattr(sim.lib, "get_" + name)
+    fn.argtypes = [ctypes.c_void_p, ctypes.c_uint32]
+    fn.restype = ctypes.c_uint32
+    out = 0
+    for i in range(num_words):
+        out |= int(fn(sim.model, i)) << (i * 32)
+    return out
+
+
+def per_call_write_words(sim, name, num_words, value):
+    fn = getattr(sim.lib, "set_" + name)
+    fn.argtypes = [ctypes.c_void_p, ctypes.c_uint64, ctypes.c_uint32]
+    for i in range(num_words):
+        fn(sim.model, i, ctypes.c_uint32(value >> (i * 32)))
+
+
+def per_call_eval(sim):
+    fn = sim.lib.eval
+    fn.argtypes = [ctypes.c_void_p]
+    fn(sim.model)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=200000, help="calls per measurement")
+    args = parser.parse_args()
+
+    build_dir = tempfile.mkdtemp(prefix="access_latency-")
+    try:
+        verilog_file = os.path.join(build_dir, "access_latency.v")
+        with open(verilog_file, "w") as f:
+            f.write(test_verilog)
+        sim = PyVerilator.build(verilog_file, build_dir=os.path.join(build_dir, "obj"))
+        # measure the accessors themselves, without evaluating the model after each write
+        sim.auto_eval = False
+        x = sim.io.x.signal
+        y = sim.io.y.signal
+        a = sim.io.a.signal
+        b = sim.io.b.signal
+        c = sim.io.c.signal
+        z = sim.io.z.signal
+        wide_value = (1 << 511) | 5
+
+        measurements = [
+            ("read 32 bit", lambda: x.value, lambda: per_call_read(sim, "x", ctypes.c_uint32)),
+            ("read 64 bit", lambda: y.value, lambda: per_call_read(sim, "y", ctypes.c_uint64)),
+            ("write 32 bit", lambda: a.write(5), lambda: per_call_write(sim, "a", ctypes.c_uint32, 5)),
+            ("write 64 bit", lambda: b.write(5), lambda: per_call_write(sim, "b", ctypes.c_uint64, 5)),
+            ("read 512 bit", lambda: z.value, lambda: per_call_read_words(sim, "z", 16)),
+            ("write 512 bit", lambda: c.write(wide_value), lambda: per_call_write_words(sim, "c", 16, wide_value)),
+            ("eval", sim.eval, lambda: per_call_eval(sim)),
+        ]
+        print("{:<14}  {:>12}  {:>12}  {:>8}".format("operation", "per call [ns]", "direct [ns]", "speedup"))
+        for name, direct, per_call in measurements:
+            per_call_time = min(timeit.repeat(per_call, number=args.iterations, repeat=3)) / args.iterations
+            direct_time = min(timeit.repeat(direct, number=args.iterations, repeat=3)) / args.iterations
+            print(
+                "{:<14}  {:>12.0f}  {:>12.0f}  {:>7.1f}x".format(
+                    name, per_call_time * 1e9, direct_time * 1e9, per_call_time / direct_time
+                )
+            )
+
+        collection_measurements = [
+            ("read 32 bit", lambda: sim.io.x, lambda: sim.raw.x),
+            ("read 64 bit", lambda: sim.io.y, lambda: sim.raw.y),
+            ("write 32 bit", lambda: setattr(sim.io, "a", 5), lambda: setattr(sim.raw, "a", 5)),
+        ]
+        print()
+        print("{:<14}  {:>12}  {:>12}  {:>8}".format("operation", "sim.io [ns]", "sim.raw [ns]", "speedup"))
+        for name, io_access, raw_access in collection_measurements:
+            io_time = min(timeit.repeat(io_access, number=args.iterations, repeat=3)) / args.iterations
+            raw_time = min(timeit.repeat(raw_access, number=args.iterations, repeat=3)) / args.iterations
+            print("{:<14}  {:>12.0f}  {:>12.0f}  {:>7.1f}x".format(name, io_time * 1e9, raw_time * 1e9, io_time / raw_time))
+    finally:
+        shutil.rmtree(build_dir)
+
+
+if __name__ == "__main__":
+    main()
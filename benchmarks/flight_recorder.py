@@ -0,0 +1,96 @@
+"""Measures the cost of keeping the last cycles of a run for a failure waveform.
+
+Usage:
+    python3 benchmarks/flight_recorder.py [--cycles 200000] [--keep 1000] [--signals 100]
+
+The design has a number of 32-bit registers that change every cycle. It runs
+for the same number of cycles with sim.run() without a trace, with a flight
+recorder (sim.flight_recorder()) of the ports, its default, and of all
+signals, which keeps the last keep cycles in memory and writes nothing because
+the run passes, and with a VCD trace of the whole run, which is how a failure
+waveform was obtained before. Finally the time to write the kept cycles of all
+signals with Recorder.dump() is measured.
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from pyverilator import PyVerilator
+
+test_verilog = """
+module flight_recorder #(parameter N = 100) (
+        input         clk,
+        output [31:0] sum);
+    wire [31:0] taps [0:N];
+    assign taps[0] = 32'd1;
+    genvar i;
+    generate
+        for (i = 0; i < N; i = i + 1) begin : stage
+            reg [31:0] r;
+            initial r = 0;
+            always @(posedge clk) r <= r + taps[i];
+            assign taps[i + 1] = r;
+        end
+    endgenerate
+    assign sum = taps[N];
+endmodule
+"""
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--cycles", type=int, default=200000, help="clock cycles per measurement")
+parser.add_argument("--keep", type=int, default=1000, help="cycles kept by the flight recorder")
+parser.add_argument("--signals", type=int, default=100, help="number of registers of the design")
+args = parser.parse_args()
+
+build_dir = tempfile.mkdtemp(prefix="flight_recorder-")
+try:
+    verilog_file = os.path.join(build_dir, "flight_recorder.v")
+    with open(verilog_file, "w") as f:
+        f.write(test_verilog)
+    sim = PyVerilator.build(
+        verilog_file,
+        build_dir=os.path.join(build_dir, "obj"),
+        extra_args=["-GN=%d" % args.signals],
+        read_internal_signals=True,
+    )
+    failure_file = os.path.join(build_dir, "failure.vcd")
+    trace_file = os.path.join(build_dir, "trace.vcd")
+    print("%d signals" % len(sim.inputs + sim.outputs + sim.internal_signals))
+
+    print("{:<17}  {:>10}  {:>14}  {:>12}".format("mode", "time [s]", "cycle [ns]", "size [kB]"))
+
+    def report(name, elapsed, filename=None):
+        size = "%.0f" % (os.path.getsize(filename) / 1e3) if filename is not None and os.path.exists(filename) else "-"
+        print("{:<17}  {:>10.3f}  {:>14.0f}  {:>12}".format(name, elapsed, elapsed / args.cycles * 1e9, size))
+
+    start = time.perf_counter()
+    sim.run(args.cycles)
+    report("no trace", time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with sim.flight_recorder(failure_file, cycles=args.keep):
+        sim.run(args.cycles)
+    report("flight rec. ports", time.perf_counter() - start, failure_file)
+
+    all_signals = [name for name, _ in sim.inputs + sim.outputs + sim.internal_signals]
+    start = time.perf_counter()
+    with sim.flight_recorder(failure_file, cycles=args.keep, signals=all_signals) as recorder:
+        sim.run(args.cycles)
+    report("flight rec. all", time.perf_counter() - start, failure_file)
+
+    start = time.perf_counter()
+    sim.start_vcd_trace(trace_file, flush_every=None)
+    sim.run(args.cycles)
+    sim.stop_vcd_trace()
+    report("full vcd trace", time.perf_counter() - start, trace_file)
+
+    start = time.perf_counter()
+    recorder.dump()
+    elapsed = time.perf_counter() - start
+    print("dump of %d cycles: %.3f s, %.0f kB" % (len(recorder), elapsed, os.path.getsize(failure_file) / 1e3))
+    del sim
+finally:
+    shutil.rmtree(build_dir)
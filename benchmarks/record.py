@@ -0,0 +1,126 @@
+"""Measures recording many signals in every clock cycle with sim.record().
+
+Usage:
+    python3 benchmarks/record.py [--cycles 100000] [--signals 100]
+
+The design has a number of 32-bit registers that change every cycle. All of
+them are recorded in every cycle: with a recorder while sim.run() ticks the
+clock, with a recorder while the clock is ticked from python, with
+snapshot(out=) into a preallocated array after every tick from python, and
+by writing a VCD trace during sim.run() and reading it back with a minimal
+parser. The cost of sim.run() without recording is shown for reference.
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from pyverilator import PyVerilator
+
+test_verilog = """
+module record #(parameter N = 100) (
+        input         clk,
+        output [31:0] sum);
+    wire [31:0] taps [0:N];
+    assign taps[0] = 32'd1;
+    genvar i;
+    generate
+        for (i = 0; i < N; i = i + 1) begin : stage
+            reg [31:0] r;
+            initial r = 0;
+            always @(posedge clk) r <= r + taps[i];
+            assign taps[i + 1] = r;
+        end
+    endgenerate
+    assign sum = taps[N];
+endmodule
+"""
+
+
+def native_run(sim, signals, cycles):
+    sim.run(cycles)
+
+
+def recorder_run(sim, signals, cycles):
+    with sim.record(signals, capacity=cycles) as recorder:
+        sim.run(cycles)
+    return recorder.columns()
+
+
+def recorder_ticks(sim, signals, cycles):
+    with sim.record(signals, capacity=cycles) as recorder:
+        for _ in range(cycles):
+            sim.clock.tick()
+    return recorder.columns()
+
+
+def snapshot_ticks(sim, signals, cycles):
+    records = np.zeros(cycles, dtype=sim.snapshot_dtype(internals=True))
+    for cycle in range(cycles):
+        sim.clock.tick()
+        sim.snapshot(internals=True, out=records[cycle : cycle + 1])
+    return records
+
+
+def vcd_run(sim, signals, cycles):
+    vcd_file = os.path.join(build_dir, "record.vcd")
+    sim.start_vcd_trace(vcd_file, flush_every=None)
+    sim.run(cycles)
+    sim.stop_vcd_trace()
+    # the values of all signals at each timestamp, without any checks
+    codes = {}
+    values = {}
+    rows = []
+    with open(vcd_file) as f:
+        for line in f:
+            line = line.lstrip()
+            if line.startswith("$var"):
+                fields = line.split()
+                codes.setdefault(fields[3], fields[4])
+            elif line.startswith("#"):
+                rows.append(dict(values))
+            elif line.startswith("b"):
+                value, code = line.split()
+                values[codes[code]] = int(value[1:], 2)
+    return rows
+
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--cycles", type=int, default=100000, help="clock cycles per measurement")
+parser.add_argument("--signals", type=int, default=100, help="number of recorded registers")
+args = parser.parse_args()
+
+build_dir = tempfile.mkdtemp(prefix="record-")
+try:
+    verilog_file = os.path.join(build_dir, "record.v")
+    with open(verilog_file, "w") as f:
+        f.write(test_verilog)
+    sim = PyVerilator.build(
+        verilog_file,
+        build_dir=os.path.join(build_dir, "obj"),
+        extra_args=["-GN=%d" % args.signals],
+        read_internal_signals=True,
+    )
+    signals = [name for name, _ in sim.internal_signals]
+    print("%d signals" % len(signals))
+
+    measurements = [
+        ("run()", native_run),
+        ("run() + recorder", recorder_run),
+        ("tick + recorder", recorder_ticks),
+        ("tick + snapshot", snapshot_ticks),
+        ("run() + vcd + parse", vcd_run),
+    ]
+    print("{:<20}  {:>10}  {:>14}".format("recording", "time [s]", "cycle [ns]"))
+    for name, measure in measurements:
+        start = time.perf_counter()
+        measure(sim, signals, args.cycles)
+        elapsed = time.perf_counter() - start
+        print("{:<20}  {:>10.3f}  {:>14.0f}".format(name, elapsed, elapsed / args.cycles * 1e9))
+    del sim
+finally:
+    shutil.rmtree(build_dir)
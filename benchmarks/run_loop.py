@@ -0,0 +1,88 @@
+"""Measures running a design for many clock cycles from python and with sim.run().
+
+Usage:
+    python3 benchmarks/run_loop.py [--cycles 100000]
+
+The cycles are run three times: with a python loop of sim.clock.tick(), with
+a python loop that checks a stop condition after every tick, and with
+sim.run(), which toggles the clock, evaluates the model and checks the stop
+condition in a native loop inside the model library. The same comparison is
+repeated with VCD tracing enabled.
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from pyverilator import PyVerilator
+
+test_verilog = """
+module run_loop (
+        input         clk,
+        input         rst,
+        output [31:0] count,
+        output        done);
+    reg [31:0] count_reg;
+    always @(posedge clk) count_reg <= rst ? 0 : count_reg + 1;
+    assign count = count_reg;
+    assign done = count_reg == 32'hffffffff;
+endmodule
+"""
+
+
+def python_ticks(sim, cycles):
+    for _ in range(cycles):
+        sim.clock.tick()
+
+
+def python_ticks_until(sim, cycles):
+    for _ in range(cycles):
+        sim.clock.tick()
+        if sim.io.done == 1:
+            break
+
+
+def measure(fn, sim, cycles):
+    sim.io.rst = 1
+    sim.clock.tick()
+    sim.io.rst = 0
+    start = time.perf_counter()
+    fn(sim, cycles)
+    elapsed = time.perf_counter() - start
+    assert sim.io.count == cycles
+    return elapsed
+
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--cycles", type=int, default=100000, help="clock cycles per measurement")
+args = parser.parse_args()
+
+build_dir = tempfile.mkdtemp(prefix="run_loop-")
+try:
+    verilog_file = os.path.join(build_dir, "run_loop.v")
+    with open(verilog_file, "w") as f:
+        f.write(test_verilog)
+    sim = PyVerilator.build(verilog_file, build_dir=os.path.join(build_dir, "obj"))
+
+    loops = [
+        ("clock.tick()", python_ticks),
+        ("tick + until", python_ticks_until),
+        ("run()", lambda sim, cycles: sim.run(cycles)),
+        ("run(until=)", lambda sim, cycles: sim.run(cycles, until="done")),
+    ]
+    print("{:<14}  {:>8}  {:>14}  {:>14}".format("loop", "trace", "time [s]", "cycles/s"))
+    for trace in (False, True):
+        if trace:
+            sim.start_vcd_trace(os.path.join(build_dir, "run_loop.vcd"))
+        for name, loop in loops:
+            elapsed = measure(loop, sim, args.cycles)
+            print(
+                "{:<14}  {:>8}  {:>14.3f}  {:>14.0f}".format(name, "vcd" if trace else "-", elapsed, args.cycles / elapsed)
+            )
+        if trace:
+            sim.stop_vcd_trace()
+    del sim
+finally:
+    shutil.rmtree(build_dir)
@@ -0,0 +1,88 @@
+"""Measures applying per-cycle stimulus and sampling outputs from python and with sim.run_vectors().
+
+Usage:
+    python3 benchmarks/run_vectors.py [--cycles 100000]
+
+The design is a registered multiply-accumulate data path. The python loop
+writes the inputs through sim.io, ticks the clock and reads the outputs every
+cycle, sim.run_vectors() does the same in a native loop over NumPy arrays.
+Both must produce the same outputs.
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from pyverilator import PyVerilator
+
+test_verilog = """
+module mac (
+        input         clk,
+        input         clear,
+        input  [15:0] a,
+        input  [15:0] b,
+        output [31:0] product,
+        output [47:0] acc);
+    reg [31:0] product_reg;
+    reg [47:0] acc_reg;
+    always @(posedge clk) begin
+        product_reg <= a * b;
+        acc_reg <= clear ? 0 : acc_reg + a * b;
+    end
+    assign product = product_reg;
+    assign acc = acc_reg;
+endmodule
+"""
+
+
+def python_loop(sim, stimulus):
+    product = []
+    acc = []
+    for clear, a, b in zip(*(stimulus[name].tolist() for name in ("clear", "a", "b"))):
+        sim.io.clear = clear
+        sim.io.a = a
+        sim.io.b = b
+        sim.clock.tick()
+        product.append(sim.io.product.value)
+        acc.append(sim.io.acc.value)
+    return {"product": np.array(product, dtype=np.uint32), "acc": np.array(acc, dtype=np.uint64)}
+
+
+def native_loop(sim, stimulus):
+    return sim.run_vectors(stimulus, ["product", "acc"])
+
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--cycles", type=int, default=100000, help="clock cycles per measurement")
+args = parser.parse_args()
+
+rng = np.random.default_rng(0)
+stimulus = {
+    "clear": (np.arange(args.cycles) % 1000 == 0).astype(np.uint32),
+    "a": rng.integers(0, 1 << 16, args.cycles, dtype=np.uint32),
+    "b": rng.integers(0, 1 << 16, args.cycles, dtype=np.uint32),
+}
+
+build_dir = tempfile.mkdtemp(prefix="run_vectors-")
+try:
+    verilog_file = os.path.join(build_dir, "mac.v")
+    with open(verilog_file, "w") as f:
+        f.write(test_verilog)
+    sim = PyVerilator.build(verilog_file, build_dir=os.path.join(build_dir, "obj"))
+
+    print("{:<14}  {:>10}  {:>14}".format("loop", "time [s]", "cycles/s"))
+    results = []
+    for name, loop in (("python", python_loop), ("run_vectors()", native_loop)):
+        start = time.perf_counter()
+        results.append(loop(sim, stimulus))
+        elapsed = time.perf_counter() - start
+        print("{:<14}  {:>10.3f}  {:>14.0f}".format(name, elapsed, args.cycles / elapsed))
+    for output in ("product", "acc"):
+        assert (results[0][output] == results[1][output]).all(), output
+    del sim
+finally:
+    shutil.rmtree(build_dir)
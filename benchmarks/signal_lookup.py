@@ -0,0 +1,114 @@
+"""Measures looking up signals by name on a design with thousands of internal signals.
+
+Usage:
+    python3 benchmarks/signal_lookup.py [--signals 4000] [--iterations 20000]
+
+sim["name"], sim["name"] = value and "name" in sim find signals in an index
+that is built once when the model is loaded, by verilator name, modular name
+and lowercase alias. For comparison, every lookup is also measured the way it
+was done before, scanning the list of all signals, and the helpers of
+pyverilator.util.axi_utils, which try the name and its lowercase version.
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import timeit
+
+from pyverilator import PyVerilator
+
+test_verilog = """
+module signal_lookup #(parameter N = 4000) (
+        input         clk,
+        input  [31:0] S_AXI_WDATA,
+        output [31:0] sum);
+    wire [31:0] taps [0:N];
+    assign taps[0] = S_AXI_WDATA;
+    genvar i;
+    generate
+        for (i = 0; i < N; i = i + 1) begin : stage
+            reg [31:0] r;
+            initial r = 0;
+            always @(posedge clk) r <= taps[i] + i;
+            assign taps[i + 1] = r;
+        end
+    endgenerate
+    assign sum = taps[N];
+endmodule
+"""
+
+
+def scan_read(sim, port_name):
+    # the lookup of PyVerilator._read before the signal index
+    port_width = None
+    for name, width in sim.inputs + sim.outputs + sim.internal_signals:
+        if port_name == name:
+            port_width = width
+    if port_width is None:
+        raise ValueError('cannot read port "%s" because it does not exist' % port_name)
+    return sim._read_32(port_name)
+
+
+def scan_contains(sim, signal_name):
+    for name, _ in sim.inputs + sim.outputs + sim.internal_signals:
+        if name == signal_name:
+            return True
+    return False
+
+
+def scan_find_signal(sim, signal_name):
+    # the lookup of axi_utils._find_signal before the signal index
+    if scan_contains(sim, signal_name):
+        return signal_name
+    return signal_name.lower()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--signals", type=int, default=4000, help="number of internal registers of the design")
+    parser.add_argument("--iterations", type=int, default=20000, help="lookups per measurement")
+    args = parser.parse_args()
+
+    build_dir = tempfile.mkdtemp(prefix="signal_lookup-")
+    try:
+        verilog_file = os.path.join(build_dir, "signal_lookup.v")
+        with open(verilog_file, "w") as f:
+            f.write(test_verilog)
+        sim = PyVerilator.build(
+            verilog_file,
+            build_dir=os.path.join(build_dir, "obj"),
+            extra_args=["-GN=%d" % args.signals],
+            read_internal_signals=True,
+        )
+        sim.auto_eval = False
+        print("%d signals" % len(sim.inputs + sim.outputs + sim.internal_signals))
+        last_stage = sim.internal_signals[-1][0]
+        last_stage_modular = ".".join(sim.find_signal(last_stage).modular_name)
+
+        measurements = [
+            ("read port", lambda: sim["sum"], lambda: scan_read(sim, "sum")),
+            ("read internal", lambda: sim[last_stage], lambda: scan_read(sim, last_stage)),
+            ("read modular", lambda: sim[last_stage_modular], None),
+            ("contains", lambda: "sum" in sim, lambda: scan_contains(sim, "sum")),
+            ("missing", lambda: "missing" in sim, lambda: scan_contains(sim, "missing")),
+            ("find lowercase", lambda: sim.find_signal("s_axi_wdata"), lambda: scan_find_signal(sim, "s_axi_wdata")),
+        ]
+        print("{:<15}  {:>10}  {:>10}  {:>8}".format("lookup", "scan [ns]", "index [ns]", "speedup"))
+        for name, index, scan in measurements:
+            index_time = min(timeit.repeat(index, number=args.iterations, repeat=3)) / args.iterations
+            if scan is None:
+                print("{:<15}  {:>10}  {:>10.0f}".format(name, "-", index_time * 1e9))
+                continue
+            scan_time = min(timeit.repeat(scan, number=args.iterations // 10, repeat=3)) / (args.iterations // 10)
+            print(
+                "{:<15}  {:>10.0f}  {:>10.0f}  {:>7.0f}x".format(
+                    name, scan_time * 1e9, index_time * 1e9, scan_time / index_time
+                )
+            )
+    finally:
+        shutil.rmtree(build_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+"""Measures eval throughput of a bundled design against the number of verilator threads.
+
+Usage:
+    python3 benchmarks/thread_scaling.py [--threads 1 2 4] [--cycles 20000]
+
+The design is built once per thread count (verilator --threads N) and then
+clocked for the given number of cycles. Note that the bundled designs are
+small, so they mostly show the synchronization overhead of multithreaded
+evaluation; large designs are needed to see a speedup.
+"""
+
+import argparse
+import time
+
+import pkg_resources as pk
+
+from pyverilator import PyVerilator
+from pyverilator.util.axi_utils import reset_rtlsim
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4], help="thread counts to measure")
+parser.add_argument("--cycles", type=int, default=20000, help="clock cycles per measurement")
+args = parser.parse_args()
+
+verilog_root = pk.resource_filename("pyverilator.data", "verilog/lookup")
+
+print("{:>8}  {:>12}  {:>14}".format("threads", "build [s]", "cycles/s"))
+for threads in args.threads:
+    start = time.perf_counter()
+    sim = PyVerilator.build(
+        "Lookup_0.v",
+        verilog_path=[verilog_root],
+        top_module_name="Lookup_0",
+        threads=threads,
+    )
+    build_time = time.perf_counter() - start
+    reset_rtlsim(sim)
+
+    start = time.perf_counter()
+    for _ in range(args.cycles):
+        sim.clock.tick()
+    elapsed = time.perf_counter() - start
+    print("{:>8d}  {:>12.1f}  {:>14.0f}".format(threads, build_time, args.cycles / elapsed))
+    del sim
@@ -0,0 +1,81 @@
+"""Measures the size of the trace file and the overhead of tracing per clock cycle for VCD and FST.
+
+Usage:
+    python3 benchmarks/trace_format.py [--cycles 100000]
+
+The design is built with trace_format="vcd", with trace_format="fst" and with
+trace_format="fst" and the FST writer in a thread of its own (trace_threads=1).
+Each model runs the same number of cycles with sim.run() without a trace and
+with a trace that is only flushed when it is stopped. The overhead is the time
+per cycle minus the time per cycle without tracing.
+Building FST models requires zlib.
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from pyverilator import PyVerilator
+
+test_verilog = """
+module trace_format (
+        input         clk,
+        output [63:0] count,
+        output [31:0] mixed);
+    reg [63:0] count_reg;
+    reg [31:0] lfsr;
+    reg [31:0] acc;
+    initial count_reg = 0;
+    initial lfsr = 1;
+    initial acc = 0;
+    always @(posedge clk) begin
+        count_reg <= count_reg + 1;
+        lfsr <= {lfsr[30:0], lfsr[31] ^ lfsr[21] ^ lfsr[1] ^ lfsr[0]};
+        acc <= acc + (lfsr[7:0] == 0 ? lfsr : 0);
+    end
+    assign count = count_reg;
+    assign mixed = acc ^ lfsr;
+endmodule
+"""
+
+formats = [
+    ("vcd", "obj_vcd", {"trace_format": "vcd"}, ".vcd"),
+    ("fst", "obj_fst", {"trace_format": "fst"}, ".fst"),
+    ("fst, threaded", "obj_fst_threads", {"trace_format": "fst", "trace_threads": 1}, ".fst"),
+]
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--cycles", type=int, default=100000, help="clock cycles per measurement")
+args = parser.parse_args()
+
+build_dir = tempfile.mkdtemp(prefix="trace_format-")
+try:
+    verilog_file = os.path.join(build_dir, "trace_format.v")
+    with open(verilog_file, "w") as f:
+        f.write(test_verilog)
+
+    print("{:<14}  {:>14}  {:>14}  {:>12}".format("format", "cycle [ns]", "overhead [ns]", "size [kB]"))
+    for name, obj_dir, build_options, extension in formats:
+        sim = PyVerilator.build(
+            verilog_file, build_dir=os.path.join(build_dir, obj_dir), read_internal_signals=True, **build_options
+        )
+        start = time.perf_counter()
+        sim.run(args.cycles)
+        baseline = (time.perf_counter() - start) / args.cycles
+
+        trace_file = os.path.join(build_dir, "trace_format" + extension)
+        sim.start_trace(trace_file, flush_every=None)
+        start = time.perf_counter()
+        sim.run(args.cycles)
+        sim.stop_vcd_trace()
+        cycle_time = (time.perf_counter() - start) / args.cycles
+        print(
+            "{:<14}  {:>14.0f}  {:>14.0f}  {:>12.0f}".format(
+                name, cycle_time * 1e9, (cycle_time - baseline) * 1e9, os.path.getsize(trace_file) / 1e3
+            )
+        )
+        del sim
+finally:
+    shutil.rmtree(build_dir)
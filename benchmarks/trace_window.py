@@ -0,0 +1,89 @@
+"""Measures the cost of tracing a long run when only a window of cycles is of interest.
+
+Usage:
+    python3 benchmarks/trace_window.py [--cycles 200000] [--window 1000]
+
+The design runs for the same number of cycles with sim.run() without a trace,
+with a trace started by a trigger signal that goes high window cycles before
+the end, with a trace of all cycles, with a trace limited to the last window
+cycles (start_cycle and stop_cycle of start_trace()), and with a trace of all
+cycles limited to one submodule (scopes).
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from pyverilator import PyVerilator
+
+test_verilog = """
+module lane (input clk, input [31:0] seed, output [31:0] out);
+    reg [31:0] lfsr;
+    initial lfsr = 1;
+    always @(posedge clk) lfsr <= {lfsr[30:0], lfsr[31] ^ lfsr[21] ^ lfsr[1] ^ lfsr[0]} ^ seed;
+    assign out = lfsr;
+endmodule
+module trace_window #(parameter [63:0] TRIGGER = 0) (
+        input         clk,
+        output [63:0] count,
+        output [31:0] mixed,
+        output        fire);
+    reg [63:0] count_reg;
+    initial count_reg = 0;
+    always @(posedge clk) count_reg <= count_reg + 1;
+    wire [31:0] out [0:7];
+    genvar i;
+    generate
+        for (i = 0; i < 8; i = i + 1) begin : lanes
+            lane u_lane (.clk(clk), .seed(count_reg[31:0] + i), .out(out[i]));
+        end
+    endgenerate
+    assign count = count_reg;
+    assign mixed = out[0] ^ out[1] ^ out[2] ^ out[3] ^ out[4] ^ out[5] ^ out[6] ^ out[7];
+    assign fire = count_reg >= TRIGGER;
+endmodule
+"""
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--cycles", type=int, default=200000, help="clock cycles per measurement")
+parser.add_argument("--window", type=int, default=1000, help="cycles traced by the window and the trigger")
+args = parser.parse_args()
+
+build_dir = tempfile.mkdtemp(prefix="trace_window-")
+try:
+    verilog_file = os.path.join(build_dir, "trace_window.v")
+    with open(verilog_file, "w") as f:
+        f.write(test_verilog)
+    sim = PyVerilator.build(
+        verilog_file,
+        build_dir=os.path.join(build_dir, "obj"),
+        extra_args=["-GTRIGGER=%d" % (2 * args.cycles - args.window)],
+        trace_depth=4,
+    )
+    vcd_file = os.path.join(build_dir, "trace_window.vcd")
+
+    traces = [
+        ("no trace", None),
+        # count keeps running across the measurements, fire goes high window cycles before the end of this one
+        ("trigger", {"trigger": "fire"}),
+        ("all cycles", {}),
+        ("window", {"start_cycle": args.cycles - args.window, "stop_cycle": args.cycles}),
+        ("one scope", {"scopes": ["trace_window.lanes[0].u_lane"]}),
+    ]
+    print("{:<12}  {:>10}  {:>14}  {:>12}".format("trace", "time [s]", "cycle [ns]", "size [kB]"))
+    for name, options in traces:
+        if options is not None:
+            sim.start_vcd_trace(vcd_file, flush_every=None, **options)
+        start = time.perf_counter()
+        sim.run(args.cycles)
+        elapsed = time.perf_counter() - start
+        size = "-"
+        if options is not None:
+            sim.stop_vcd_trace()
+            size = "%.0f" % (os.path.getsize(vcd_file) / 1e3)
+        print("{:<12}  {:>10.3f}  {:>14.0f}  {:>12}".format(name, elapsed, elapsed / args.cycles * 1e9, size))
+    del sim
+finally:
+    shutil.rmtree(build_dir)
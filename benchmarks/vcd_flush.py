@@ -0,0 +1,88 @@
+"""Measures the overhead of VCD tracing per clock cycle for each flush policy.
+
+Usage:
+    python3 benchmarks/vcd_flush.py [--cycles 20000]
+
+The design is ticked with sim.clock.tick() and with sim.run(), without a
+trace and with a trace for each flush policy of start_vcd_trace(): after
+every dump (the default), every N dumps, every T seconds, and only when the
+trace is stopped. The overhead is the time per cycle minus the time per cycle
+without tracing.
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from pyverilator import PyVerilator
+
+test_verilog = """
+module vcd_flush (
+        input         clk,
+        output [63:0] count);
+    reg [63:0] count_reg;
+    reg [31:0] lfsr;
+    initial count_reg = 0;
+    initial lfsr = 1;
+    always @(posedge clk) begin
+        count_reg <= count_reg + 1;
+        lfsr <= {lfsr[30:0], lfsr[31] ^ lfsr[21] ^ lfsr[1] ^ lfsr[0]};
+    end
+    assign count = count_reg ^ {lfsr, lfsr};
+endmodule
+"""
+
+policies = [
+    ("no trace", None),
+    ("every dump", {}),
+    ("every 100", {"flush_every": 100}),
+    ("every 10000", {"flush_every": 10000}),
+    ("every 0.1 s", {"flush_every": None, "flush_interval": 0.1}),
+    ("on stop", {"flush_every": None}),
+]
+
+
+def python_ticks(sim, cycles):
+    for _ in range(cycles):
+        sim.clock.tick()
+
+
+def native_run(sim, cycles):
+    sim.run(cycles)
+
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--cycles", type=int, default=20000, help="clock cycles per measurement")
+args = parser.parse_args()
+
+build_dir = tempfile.mkdtemp(prefix="vcd_flush-")
+try:
+    verilog_file = os.path.join(build_dir, "vcd_flush.v")
+    with open(verilog_file, "w") as f:
+        f.write(test_verilog)
+    sim = PyVerilator.build(verilog_file, build_dir=os.path.join(build_dir, "obj"))
+    vcd_file = os.path.join(build_dir, "vcd_flush.vcd")
+
+    print("{:<12}  {:<12}  {:>14}  {:>14}".format("loop", "flush", "cycle [ns]", "overhead [ns]"))
+    for loop_name, loop in (("clock.tick()", python_ticks), ("run()", native_run)):
+        baseline = None
+        for policy_name, policy in policies:
+            if policy is not None:
+                sim.start_vcd_trace(vcd_file, **policy)
+            start = time.perf_counter()
+            loop(sim, args.cycles)
+            if policy is not None:
+                sim.stop_vcd_trace()
+            cycle_time = (time.perf_counter() - start) / args.cycles
+            if baseline is None:
+                baseline = cycle_time
+            print(
+                "{:<12}  {:<12}  {:>14.0f}  {:>14.0f}".format(
+                    loop_name, policy_name, cycle_time * 1e9, (cycle_time - baseline) * 1e9
+                )
+            )
+    del sim
+finally:
+    shutil.rmtree(build_dir)
@@ -1,3 +1,16 @@
-from .pyverilator import Clock, Collection, Input, InternalSignal, Output, PyVerilator, Signal, Submodule  # noqa
+from .pyverilator import (  # noqa
+    BuildError,
+    BuildReport,
+    BuildResult,
+    Clock,
+    Collection,
+    Input,
+    InternalSignal,
+    Output,
+    PyVerilator,
+    Recorder,
+    Signal,
+    Submodule,
+)
 
 name = "PyVerilator"
@@ -0,0 +1,559 @@
+"""Persistent, content-addressed cache of compiled PyVerilator models.
+
+A cache entry holds the shared object produced by PyVerilator.build() for one
+set of build inputs. Entries are keyed by a hash of everything that can change
+the compiled model: the contents of the Verilog sources, the build arguments,
+the C++ wrapper template and the Verilator and C++ compiler versions. Verilator
+can also read files that are not named in the build arguments, e.g. modules
+found next to the top-level file or files listed with -f. Each entry therefore
+records the files verilator actually read (V<top>__ver.d), and it is only used
+while all of them are unchanged.
+
+Usage:
+    cache = BuildCache()
+    sim = PyVerilator.build('my_verilator_file.v', cache=cache)
+    print(cache.entries())
+    cache.purge()
+
+The cache directory also holds the precompiled verilator runtime objects
+(verilated.o, verilated_vcd_c.o, ...) that every design links against. They
+only depend on the verilator installation, the compiler and the compile flags,
+so they are built once per configuration and hard linked into build directories.
+
+The cache can also be inspected from the command line:
+    python3 -m pyverilator.cache list
+    python3 -m pyverilator.cache purge
+"""
+
+import argparse
+import functools
+import hashlib
+import inspect
+import json
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+
+import pyverilator.verilatorcpp as template_cpp
+
+# bump this when the layout of cache entries, the meaning of the key or the generated wrapper changes
+CACHE_FORMAT_VERSION = 2
+
+# files with these extensions in verilog_path and include directories are
+# considered inputs of a build
+HDL_EXTENSIONS = (".v", ".sv", ".vh", ".svh", ".vlt")
+
+DEFAULT_MAX_SIZE = 2 * 1024**3
+
+ENTRY_METADATA_FILE = "entry.json"
+
+
+def default_cache_dir():
+    """Returns the cache directory used when none is given explicitly.
+
+    This is $PYVERILATOR_CACHE_DIR if set, otherwise 'pyverilator' inside the
+    user cache directory ($XDG_CACHE_HOME or ~/.cache)."""
+    cache_dir = os.environ.get("PYVERILATOR_CACHE_DIR")
+    if cache_dir:
+        return cache_dir
+    user_cache_dir = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(user_cache_dir, "pyverilator")
+
+
+def resolve_cache(cache):
+    """Converts the cache argument of PyVerilator.build() into a BuildCache or None.
+
+    cache can be:
+        None: use a cache only if $PYVERILATOR_CACHE_DIR is set
+        False: never use a cache
+        True: use the default cache directory
+        str: use a cache in this directory
+        BuildCache: use this cache
+    """
+    if cache is None:
+        if os.environ.get("PYVERILATOR_CACHE_DIR"):
+            return BuildCache()
+        return None
+    if cache is False:
+        return None
+    if cache is True:
+        return BuildCache()
+    if isinstance(cache, BuildCache):
+        return cache
+    if isinstance(cache, str):
+        return BuildCache(cache)
+    raise TypeError("cache must be None, a bool, a directory name or a BuildCache, not %r" % (cache,))
+
+
+@functools.lru_cache(maxsize=None)
+def verilator_version(verilator):
+    """Returns the version string reported by the given verilator executable."""
+    out = subprocess.run(["perl", verilator, "--version"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+    return out.decode("utf-8", "replace").strip()
+
+
+@functools.lru_cache(maxsize=None)
+def verilator_root(verilator):
+    """Returns VERILATOR_ROOT as reported by the given verilator executable."""
+    out = subprocess.run(
+        ["perl", verilator, "--getenv", "VERILATOR_ROOT"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+    ).stdout
+    return out.decode("utf-8", "replace").strip()
+
+
+@functools.lru_cache(maxsize=None)
+def compiler_version(verilator):
+    """Returns the version string of the C++ compiler used by verilated.mk."""
+    cxx = "c++"
+    verilated_mk = os.path.join(verilator_root(verilator), "include", "verilated.mk")
+    if os.path.isfile(verilated_mk):
+        with open(verilated_mk) as f:
+            for line in f:
+                result = re.match(r"CXX\s*=\s*(\S+)", line)
+                if result:
+                    cxx = result.group(1)
+                    break
+    try:
+        out = subprocess.run([cxx, "--version"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+    except OSError:
+        return cxx
+    lines = out.decode("utf-8", "replace").splitlines()
+    return cxx + " " + (lines[0] if lines else "")
+
+
+def template_hash():
+    """Returns a hash of the C++ wrapper template source code."""
+    return hashlib.sha256(inspect.getsource(template_cpp).encode("utf-8")).hexdigest()
+
+
+def source_files(verilog_files, verilog_path=[], extra_args=[], cwd=None):
+    """Returns the sorted list of files that may be read by verilator for a build.
+
+    This includes the given verilog_files, all HDL files in the verilog_path
+    directories and include directories (-I<dir>, +incdir+<dir>), and any other
+    file named in extra_args (e.g. -v or -f arguments). Relative paths are
+    relative to cwd, the directory verilator runs in (default: the working directory)."""
+
+    def resolve(path):
+        return os.path.abspath(os.path.join(cwd, path) if cwd is not None else path)
+
+    files = set(resolve(f) for f in verilog_files)
+    dirs = [resolve(d) for d in verilog_path]
+    for arg in extra_args:
+        if arg.startswith("+incdir+"):
+            dirs.extend(resolve(d) for d in arg[len("+incdir+") :].split("+") if d)
+        elif arg.startswith("-I") and len(arg) > 2:
+            dirs.append(resolve(arg[2:]))
+        elif os.path.isfile(resolve(arg)):
+            files.add(resolve(arg))
+    for d in dirs:
+        if not os.path.isdir(d):
+            continue
+        for name in os.listdir(d):
+            path = os.path.join(d, name)
+            if name.endswith(HDL_EXTENSIONS) and os.path.isfile(path):
+                files.add(os.path.abspath(path))
+    return sorted(files)
+
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def read_dependency_file(path):
+    """Returns the prerequisites listed in a make dependency file, such as V<top>__ver.d."""
+    with open(path) as f:
+        text = f.read().replace("\\\n", " ")
+    dependencies = []
+    for line in text.splitlines():
+        if ":" in line:
+            for dependency in line.split(":", 1)[1].split():
+                if dependency not in dependencies:
+                    dependencies.append(dependency)
+    return dependencies
+
+
+def file_state(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def dependency_states(paths):
+    """Returns {path: [size, mtime_ns, digest]} for the existing files among paths."""
+    return {os.path.abspath(path): file_state(path) + [file_digest(path)] for path in paths if os.path.isfile(path)}
+
+
+def dependencies_changed(states):
+    """Returns True if one of the files recorded by dependency_states() changed or is gone.
+
+    Files are compared by size and modification time first, and by contents if those differ."""
+    for path, (size, mtime_ns, digest) in states.items():
+        try:
+            if file_state(path) != [size, mtime_ns] and file_digest(path) != digest:
+                return True
+        except OSError:
+            return True
+    return False
+
+
+# make variables of the verilated makefiles that are specific to a design and do
+# not change how the verilator runtime objects are compiled
+DESIGN_SPECIFIC_MAKE_VARS = ("VM_PREFIX", "VM_MODPREFIX", "VM_USER_CLASSES", "VM_USER_DIR", "VM_PARALLEL_BUILDS")
+DESIGN_SPECIFIC_MAKE_VAR_PREFIXES = ("VM_CLASSES_", "VM_SUPPORT_", "VM_HIER")
+
+
+def read_makefile_vars(path):
+    """Returns a dict of the simple variable assignments in a makefile generated by verilator."""
+    variables = {}
+    with open(path) as f:
+        text = f.read().replace("\\\n", " ")
+    for line in text.splitlines():
+        result = re.match(r"([A-Za-z_][A-Za-z0-9_]*)\s*(\+=|\?=|:=|=)\s*(.*)$", line)
+        if result:
+            name, op, value = result.group(1), result.group(2), " ".join(result.group(3).split())
+            if op == "+=" and name in variables:
+                variables[name] = (variables[name] + " " + value).strip()
+            else:
+                variables[name] = value
+    return variables
+
+
+def _verilated_makefile_vars(build_dir, prefix):
+    make_vars = read_makefile_vars(os.path.join(build_dir, prefix + ".mk"))
+    make_vars.update(read_makefile_vars(os.path.join(build_dir, prefix + "_classes.mk")))
+    return make_vars
+
+
+def _runtime_object_names(make_vars):
+    global_classes = make_vars.get("VM_GLOBAL_FAST", "") + " " + make_vars.get("VM_GLOBAL_SLOW", "")
+    return [name + ".o" for name in global_classes.split()]
+
+
+def runtime_object_names(build_dir, prefix):
+    """Returns the names of the verilator runtime objects (e.g. verilated.o) that make builds in build_dir."""
+    return _runtime_object_names(_verilated_makefile_vars(build_dir, prefix))
+
+
+def model_object_names(build_dir, prefix):
+    """Returns the objects and archives make links into the model in build_dir.
+
+    These are the objects of user files (e.g. the pyverilator wrapper), the
+    verilator runtime objects and the archive of the design (V<top>__ALL.a)."""
+    make_vars = _verilated_makefile_vars(build_dir, prefix)
+    user_objects = [name + ".o" for name in make_vars.get("VM_USER_CLASSES", "").split()]
+    return user_objects + _runtime_object_names(make_vars) + [prefix + "__ALL.a"]
+
+
+def unlink_shared_objects(build_dir, object_names):
+    """Removes objects in build_dir that are hard linked to the runtime objects of a cache.
+
+    This must be done before make may recompile them, since the compiler would
+    otherwise overwrite the shared copy in place."""
+    for object_name in object_names:
+        path = os.path.join(build_dir, object_name)
+        if os.path.isfile(path) and os.stat(path).st_nlink > 1:
+            os.remove(path)
+
+
+def runtime_objects(verilator, build_dir, prefix, make_flags=[]):
+    """Returns (key, object_names) for the verilator runtime objects of a verilated design.
+
+    object_names are the runtime objects (e.g. verilated.o) that make builds in
+    build_dir, and key identifies the configuration they are compiled with."""
+    make_vars = _verilated_makefile_vars(build_dir, prefix)
+    object_names = _runtime_object_names(make_vars)
+    config = {
+        name: value
+        for name, value in make_vars.items()
+        if name not in DESIGN_SPECIFIC_MAKE_VARS and not name.startswith(DESIGN_SPECIFIC_MAKE_VAR_PREFIXES)
+    }
+    key_data = {
+        "format": CACHE_FORMAT_VERSION,
+        "verilator": verilator_version(verilator),
+        "compiler": compiler_version(verilator),
+        "make_vars": config,
+        "make_flags": list(make_flags),
+        "objects": object_names,
+    }
+    key = hashlib.sha256(json.dumps(key_data, sort_keys=True).encode("utf-8")).hexdigest()
+    return (key, object_names)
+
+
+def build_key(verilator, verilog_files, verilog_path=[], extra_args=[], cwd=None, **build_options):
+    """Computes the cache key for a build.
+
+    build_options are any other values that change the compiled model (trace
+    depth, compiler flags, ...). They must be JSON serializable. cwd is the
+    directory verilator runs in, see source_files()."""
+    key_data = {
+        "format": CACHE_FORMAT_VERSION,
+        "verilator": verilator_version(verilator),
+        "compiler": compiler_version(verilator),
+        "template": template_hash(),
+        "verilog_files": list(verilog_files),
+        "verilog_path": list(verilog_path),
+        "extra_args": list(extra_args),
+        "sources": [
+            (os.path.basename(path), file_digest(path))
+            for path in source_files(verilog_files, verilog_path, extra_args, cwd)
+        ],
+        "options": build_options,
+    }
+    return hashlib.sha256(json.dumps(key_data, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class BuildCache:
+    """Size-bounded LRU cache of compiled PyVerilator models on disk.
+
+    Each entry is a directory named after its key that contains the shared
+    object and an entry.json metadata file. The modification time of entry.json
+    records when the entry was last used, and the least recently used entries
+    are evicted when the total size of the cache exceeds max_size bytes. The
+    precompiled runtime objects of each configuration count towards max_size as
+    well, and are evicted with the entries by the time they were last linked.
+
+    max_size defaults to $PYVERILATOR_CACHE_MAX_SIZE, or 2 GiB if unset.
+    """
+
+    def __init__(self, cache_dir=None, max_size=None):
+        if cache_dir is None:
+            cache_dir = default_cache_dir()
+        if max_size is None:
+            max_size = int(os.environ.get("PYVERILATOR_CACHE_MAX_SIZE", DEFAULT_MAX_SIZE))
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = max_size
+        self.builds_dir = os.path.join(self.cache_dir, "builds")
+        self.runtime_dir = os.path.join(self.cache_dir, "runtime")
+
+    def _entry_dir(self, key):
+        return os.path.join(self.builds_dir, key)
+
+    def lookup(self, key):
+        """Returns the path of the cached shared object for key, or None on a miss.
+
+        An entry whose recorded dependencies changed is a miss as well."""
+        entry_dir = self._entry_dir(key)
+        try:
+            with open(os.path.join(entry_dir, ENTRY_METADATA_FILE)) as f:
+                metadata = json.load(f)
+            so_file = os.path.join(entry_dir, metadata["so_file"])
+            if not os.path.isfile(so_file) or dependencies_changed(metadata.get("dependencies", {})):
+                return None
+            # mark the entry as recently used
+            os.utime(os.path.join(entry_dir, ENTRY_METADATA_FILE))
+        except (OSError, ValueError, KeyError):
+            return None
+        return so_file
+
+    def store(self, key, so_file, metadata={}, dependencies=[]):
+        """Copies so_file into the cache under key and returns the path of the cached copy.
+
+        dependencies are the files the model was built from, see read_dependency_file(). lookup()
+        only returns the entry while they are unchanged, and an entry for the same key whose
+        dependencies changed is replaced. The entry is written to a temporary directory first and
+        then renamed into place, so concurrent readers never see partial entries."""
+        os.makedirs(self.builds_dir, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(prefix=".tmp-" + key[:16] + "-", dir=self.builds_dir)
+        try:
+            so_name = os.path.basename(so_file)
+            shutil.copy2(so_file, os.path.join(tmp_dir, so_name))
+            entry_metadata = dict(metadata)
+            entry_metadata.update(
+                {
+                    "key": key,
+                    "so_file": so_name,
+                    "created": time.time(),
+                    "dependencies": dependency_states(dependencies),
+                }
+            )
+            with open(os.path.join(tmp_dir, ENTRY_METADATA_FILE), "w") as f:
+                json.dump(entry_metadata, f, indent=2, sort_keys=True)
+            if os.path.isdir(self._entry_dir(key)) and self.lookup(key) is None:
+                # an outdated entry for the same key, built from other versions of its dependencies
+                self.remove(key)
+            try:
+                os.rename(tmp_dir, self._entry_dir(key))
+            except OSError:
+                # another process stored the same entry first
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        self.evict()
+        return self.lookup(key)
+
+    def link_runtime_objects(self, key, object_names, build_dir):
+        """Links the precompiled runtime objects for key into build_dir.
+
+        Returns False if they have not been compiled yet. The linked objects are
+        marked as newer than the makefiles in build_dir, so make does not rebuild them."""
+        runtime_objects_dir = os.path.join(self.runtime_dir, key)
+        if not object_names or not all(os.path.isfile(os.path.join(runtime_objects_dir, o)) for o in object_names):
+            return False
+        makefiles_mtime = max(
+            [os.path.getmtime(os.path.join(build_dir, name)) for name in os.listdir(build_dir) if name.endswith(".mk")],
+            default=0,
+        )
+        for object_name in object_names:
+            source = os.path.join(runtime_objects_dir, object_name)
+            target = os.path.join(build_dir, object_name)
+            if os.path.lexists(target):
+                if os.path.samefile(source, target) and os.path.getmtime(target) >= makefiles_mtime:
+                    # already linked by a previous build in build_dir, keep the mtime to avoid relinking the model
+                    continue
+                os.remove(target)
+            try:
+                os.link(source, target)
+            except OSError:
+                # e.g. build_dir is on another file system
+                shutil.copy2(source, target)
+            os.utime(target)
+        # mark the runtime objects as recently used
+        os.utime(runtime_objects_dir)
+        return True
+
+    def store_runtime_objects(self, key, object_names, build_dir):
+        """Stores the runtime objects compiled in build_dir for key."""
+        if not object_names or not all(os.path.isfile(os.path.join(build_dir, o)) for o in object_names):
+            return
+        os.makedirs(self.runtime_dir, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(prefix=".tmp-" + key[:16] + "-", dir=self.runtime_dir)
+        try:
+            for object_name in object_names:
+                shutil.copy2(os.path.join(build_dir, object_name), os.path.join(tmp_dir, object_name))
+            try:
+                os.rename(tmp_dir, os.path.join(self.runtime_dir, key))
+            except OSError:
+                # another process stored the same objects first
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        self.evict()
+
+    def entries(self):
+        """Returns a list of dicts describing the cache entries, most recently used first."""
+        entries = []
+        if not os.path.isdir(self.builds_dir):
+            return entries
+        for key in os.listdir(self.builds_dir):
+            entry_dir = self._entry_dir(key)
+            metadata_file = os.path.join(entry_dir, ENTRY_METADATA_FILE)
+            if key.startswith(".") or not os.path.isfile(metadata_file):
+                continue
+            try:
+                with open(metadata_file) as f:
+                    metadata = json.load(f)
+                metadata["last_used"] = os.path.getmtime(metadata_file)
+                metadata["size"] = _dir_size(entry_dir)
+            except (OSError, ValueError):
+                continue
+            metadata["path"] = entry_dir
+            entries.append(metadata)
+        entries.sort(key=lambda entry: entry["last_used"], reverse=True)
+        return entries
+
+    def runtime_entries(self):
+        """Returns a list of dicts describing the precompiled runtime objects, most recently used first."""
+        entries = []
+        if not os.path.isdir(self.runtime_dir):
+            return entries
+        for key in os.listdir(self.runtime_dir):
+            path = os.path.join(self.runtime_dir, key)
+            if key.startswith(".") or not os.path.isdir(path):
+                continue
+            try:
+                last_used = os.path.getmtime(path)
+            except OSError:
+                continue
+            entries.append({"key": key, "path": path, "last_used": last_used, "size": _dir_size(path)})
+        entries.sort(key=lambda entry: entry["last_used"], reverse=True)
+        return entries
+
+    def size(self):
+        """Returns the total size in bytes of all cache entries and runtime objects."""
+        return sum(entry["size"] for entry in self.entries() + self.runtime_entries())
+
+    def remove(self, key):
+        shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+
+    def evict(self, max_size=None):
+        """Removes least recently used entries and runtime objects until the cache is at most max_size bytes.
+
+        Returns the list of removed keys."""
+        if max_size is None:
+            max_size = self.max_size
+        removed = []
+        entries = self.entries() + self.runtime_entries()
+        entries.sort(key=lambda entry: entry["last_used"], reverse=True)
+        total = sum(entry["size"] for entry in entries)
+        while entries and total > max_size:
+            entry = entries.pop()
+            # builds that already linked the runtime objects keep their hard links
+            shutil.rmtree(entry["path"], ignore_errors=True)
+            total -= entry["size"]
+            removed.append(entry["key"])
+        return removed
+
+    def purge(self):
+        """Removes all entries and runtime objects from the cache."""
+        shutil.rmtree(self.builds_dir, ignore_errors=True)
+        shutil.rmtree(self.runtime_dir, ignore_errors=True)
+
+    def __repr__(self):
+        return "BuildCache(%r, max_size=%d)" % (self.cache_dir, self.max_size)
+
+
+def _dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def main(argv=None):
+    prog_name = "python3 -m pyverilator.cache"
+    parser = argparse.ArgumentParser(prog=prog_name, description="Inspect and purge the PyVerilator build cache")
+    parser.add_argument("--cache-dir", default=None, help="cache directory (default: %s)" % default_cache_dir())
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("list", help="list cache entries, most recently used first")
+    evict_parser = subparsers.add_parser("evict", help="evict least recently used entries")
+    evict_parser.add_argument("max_size", type=int, help="maximum cache size in bytes")
+    subparsers.add_parser("purge", help="remove all cache entries")
+    args = parser.parse_args(argv)
+
+    cache = BuildCache(args.cache_dir)
+    if args.command == "purge":
+        cache.purge()
+    elif args.command == "evict":
+        for key in cache.evict(args.max_size):
+            print("evicted " + key)
+    else:
+        entries = cache.entries()
+        for entry in entries:
+            print(
+                "{}  {:<24}  {:>10d}  {}".format(
+                    entry["key"][:16],
+                    entry.get("top_module", ""),
+                    entry["size"],
+                    time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["last_used"])),
+                )
+            )
+        runtime_entries = cache.runtime_entries()
+        print("%d entries, %d bytes in %s" % (len(entries), sum(e["size"] for e in entries), cache.cache_dir))
+        print("%d runtime object sets, %d bytes" % (len(runtime_entries), sum(e["size"] for e in runtime_entries)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,380 @@
+"""Discovery of the ports and internal signals of a verilated design.
+
+Verilator can write a machine readable dump of the design: --json-only in
+recent versions of verilator 5, and --xml-only in verilator 4 and early
+versions of verilator 5. The dump contains the direction and data type of every
+variable and the module hierarchy, so signals are discovered with their exact
+width, their place in the hierarchy and, for unpacked arrays (e.g. memories),
+their dimensions.
+
+Signals are described by dicts:
+    name       the C++ name of the signal in the verilated model, e.g.
+               'top__DOT__child__DOT__count' for an internal signal
+    width      width in bits (of one element for arrays)
+    direction  'input', 'output' or 'inout' for ports, None for internal signals
+    hierarchy  list of instance names leading to the signal, ending with its name
+    dims       sizes of the unpacked dimensions, [] if the signal is not an array
+
+Only signals that are members of the verilated model are returned: signals
+that verilator optimized away or that live in a module verilator did not
+inline are dropped, and ports with unpacked dimensions are skipped with a
+warning. The discovered signals are stored in the build directory
+(SIGNALS_FILE), so they only have to be discovered again when verilator runs
+again. If verilator can not dump the design, the signals are found by scanning
+the declarations in the generated header, with a warning.
+"""
+
+import json
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import warnings
+import xml.etree.ElementTree as ElementTree
+
+SIGNALS_FILE = "pyverilator_signals.json"
+
+# widths of the basic data types that do not have a range
+KEYWORD_WIDTHS = {"byte": 8, "shortint": 16, "int": 32, "integer": 32, "longint": 64, "time": 64}
+
+# variable types that hold values in the model (and not e.g. parameters)
+SIGNAL_VAR_TYPES = ("PORT", "VAR", "WIRE", "TRIWIRE", "SUPPLY0", "SUPPLY1")
+
+
+def encode_name(name):
+    """Encodes a Verilog identifier like verilator does for C++ (see AstNode::encodeName).
+
+    Characters that are not legal in C++ identifiers, a leading digit and the
+    second of two underscores in a row are replaced with '__0XX', where XX is
+    the upper case hex ascii value of the character, e.g. "." becomes "__02E"."""
+    out = ""
+    i = 0
+    while i < len(name):
+        c = name[i]
+        if (c.isascii() and c.isalpha()) if i == 0 else (c.isascii() and c.isalnum()):
+            out += c
+        elif c == "_":
+            if name[i + 1 : i + 2] == "_":
+                out += "___05F"
+                i += 1
+            else:
+                out += c
+        else:
+            out += "".join("__0%02X" % b for b in c.encode("utf-8"))
+        i += 1
+    return out
+
+
+def encode_scope_name(name):
+    """Encodes the name of an instance or generate block, e.g. 'blk[0]' becomes 'blk__BRA__0__KET__'."""
+    result = re.match(r"^(.*?)((?:\[[^\]]*\])*)$", name)
+    indices = result.group(2).replace("[", "__BRA__").replace("]", "__KET__")
+    return encode_name(result.group(1)) + indices
+
+
+def _range_width(text):
+    # '7:0' or '[0:3]'
+    result = re.match(r"^\[?\s*(-?\d+)\s*:\s*(-?\d+)\s*\]?$", text or "")
+    if not result:
+        return None
+    return abs(int(result.group(1)) - int(result.group(2))) + 1
+
+
+def _dtype_shape(dtypes, dtype_id, depth=0):
+    """Returns (width, dims) of a data type, or None if it is not supported."""
+    dtype = dtypes.get(dtype_id)
+    if dtype is None or depth > 32:
+        return None
+    kind = dtype["type"]
+    if kind == "BASICDTYPE":
+        if dtype.get("range"):
+            return (_range_width(dtype["range"]), [])
+        return (KEYWORD_WIDTHS.get(dtype.get("keyword"), 1), [])
+    sub_id = dtype.get("refDTypep") or dtype.get("subDTypep")
+    if sub_id is None and dtype.get("dtypep") != dtype_id:
+        sub_id = dtype.get("dtypep")
+    sub_shape = _dtype_shape(dtypes, sub_id, depth + 1) if sub_id is not None else None
+    if kind in ("REFDTYPE", "ENUMDTYPE", "TYPEDEF", "CONSTDTYPE"):
+        return sub_shape
+    if kind in ("PACKARRAYDTYPE", "UNPACKARRAYDTYPE"):
+        length = _range_width(dtype.get("declRange"))
+        if sub_shape is None or length is None:
+            return None
+        width, dims = sub_shape
+        if kind == "PACKARRAYDTYPE":
+            return (width * length, []) if not dims else None
+        return (width, [length] + dims)
+    return None
+
+
+def _json_items(stmts, nodes):
+    items = []
+    for stmt in stmts:
+        kind = stmt.get("type")
+        if kind == "VAR":
+            items.append(
+                {
+                    "kind": "var",
+                    "name": stmt["name"],
+                    "direction": stmt.get("direction", "NONE"),
+                    "var_type": stmt.get("varType"),
+                    "dtype": stmt.get("dtypep"),
+                }
+            )
+        elif kind == "CELL":
+            items.append({"kind": "cell", "name": stmt["name"], "module": stmt.get("modp")})
+        elif kind in ("GENBLOCK", "BEGIN"):
+            # generate blocks keep their contents in itemsp, begin blocks in stmtsp
+            block_items = _json_items(stmt.get("itemsp", []) + stmt.get("stmtsp", []), nodes)
+            if stmt.get("name"):
+                items.append({"kind": "block", "name": stmt["name"], "items": block_items})
+            else:
+                items.extend(block_items)
+    return items
+
+
+def read_json_dump(path):
+    """Reads a V<top>.tree.json file written by verilator --json-only.
+
+    Returns (top_module_id, modules, dtypes), see design_signals()."""
+    with open(path) as f:
+        netlist = json.load(f)
+    nodes = {}
+
+    def index(node):
+        if isinstance(node, dict):
+            if "addr" in node:
+                nodes[node["addr"]] = node
+            for value in node.values():
+                index(value)
+        elif isinstance(node, list):
+            for value in node:
+                index(value)
+
+    index(netlist)
+    dtypes = {addr: node for addr, node in nodes.items() if node.get("type", "").endswith("DTYPE")}
+    modules = {}
+    top_module_id = None
+    for module in netlist.get("modulesp", []):
+        if module.get("type") != "MODULE":
+            continue
+        modules[module["addr"]] = {"name": module["name"], "items": _json_items(module.get("stmtsp", []), nodes)}
+        if module.get("level") == 1:
+            top_module_id = module["addr"]
+    return (top_module_id, modules, dtypes)
+
+
+def _xml_const(element):
+    # e.g. <const name="32'h1f"/>
+    result = re.match(r"^(?:\d*)'s?([hdbo])([0-9a-fA-F_]+)$", element.get("name", ""))
+    if not result:
+        return None
+    base = {"h": 16, "d": 10, "b": 2, "o": 8}[result.group(1)]
+    return int(result.group(2).replace("_", ""), base)
+
+
+def _xml_items(element):
+    items = []
+    for child in element:
+        if child.tag == "var" and child.get("param") is None and child.get("localparam") is None:
+            items.append(
+                {
+                    "kind": "var",
+                    "name": child.get("origName", child.get("name")),
+                    "direction": child.get("dir", "none").upper(),
+                    "var_type": "PORT" if child.get("dir") else "VAR",
+                    "dtype": child.get("dtype_id"),
+                }
+            )
+        elif child.tag == "instance":
+            items.append({"kind": "cell", "name": child.get("origName", child.get("name")), "module": child.get("defName")})
+        elif child.tag in ("begin", "genblock") and child.get("name"):
+            items.append({"kind": "block", "name": child.get("name"), "items": _xml_items(child)})
+        elif child.tag in ("begin", "genblock"):
+            items.extend(_xml_items(child))
+    return items
+
+
+def read_xml_dump(path):
+    """Reads a V<top>.xml file written by verilator --xml-only.
+
+    Returns (top_module_id, modules, dtypes), see design_signals()."""
+    root = ElementTree.parse(path).getroot()
+    modules = {}
+    top_module_id = None
+    for module in root.iter("module"):
+        modules[module.get("name")] = {"name": module.get("origName", module.get("name")), "items": _xml_items(module)}
+        if module.get("topModule") == "1":
+            top_module_id = module.get("name")
+    dtypes = {}
+    for typetable in root.iter("typetable"):
+        for dtype in typetable:
+            entry = {"type": dtype.tag.upper(), "keyword": dtype.get("name"), "refDTypep": dtype.get("sub_dtype_id")}
+            if dtype.get("left") is not None and dtype.get("right") is not None:
+                entry["range"] = "%s:%s" % (dtype.get("left"), dtype.get("right"))
+            range_element = dtype.find("range")
+            if range_element is not None:
+                bounds = [_xml_const(const) for const in range_element.findall("const")]
+                if len(bounds) == 2 and None not in bounds:
+                    entry["declRange"] = "[%d:%d]" % tuple(bounds)
+            dtypes[dtype.get("id")] = entry
+    return (top_module_id, modules, dtypes)
+
+
+def design_signals(top_module_id, modules, dtypes):
+    """Returns the signals of a design dump, before they are matched with the model.
+
+    modules maps module ids to dicts with the module 'name' and its 'items'
+    (variables, instances of other modules and named generate blocks), and
+    dtypes maps data type ids to the data types. The 'name' of the returned
+    signals is the C++ name verilator gives them if they are kept in the model."""
+    signals = []
+    top_module = modules.get(top_module_id)
+    if top_module is None:
+        return signals
+    top_name = encode_name(top_module["name"])
+
+    def visit(items, hierarchy, cpp_scope, depth):
+        for item in items:
+            if item["kind"] == "var":
+                if item["var_type"] not in SIGNAL_VAR_TYPES:
+                    continue
+                shape = _dtype_shape(dtypes, item["dtype"])
+                if shape is None or shape[0] is None:
+                    continue
+                is_port = not hierarchy and item["direction"] in ("INPUT", "OUTPUT", "INOUT")
+                cpp_name = encode_name(item["name"])
+                signals.append(
+                    {
+                        "name": cpp_name if is_port else "__DOT__".join(cpp_scope + [cpp_name]),
+                        "width": shape[0],
+                        "direction": item["direction"].lower() if is_port else None,
+                        "hierarchy": hierarchy + [item["name"]],
+                        "dims": shape[1],
+                    }
+                )
+            elif item["kind"] == "cell" and item["module"] in modules and depth < 256:
+                visit(
+                    modules[item["module"]]["items"],
+                    hierarchy + [item["name"]],
+                    cpp_scope + [encode_scope_name(item["name"])],
+                    depth + 1,
+                )
+            elif item["kind"] == "block":
+                visit(item["items"], hierarchy + [item["name"]], cpp_scope + [encode_scope_name(item["name"])], depth)
+
+    visit(top_module["items"], [], [top_name], 0)
+    return signals
+
+
+def dump_design(verilator_args, prefix, cwd=None):
+    """Runs verilator to dump the design and returns (top_module_id, modules, dtypes).
+
+    verilator_args is the verilator command line without -Mdir. Returns None,
+    with a warning that contains the errors of verilator, if this verilator can
+    not dump the design."""
+    dump_dir = tempfile.mkdtemp(prefix="pyverilator-dump-")
+    errors = []
+    try:
+        for option, dump_file, reader in [
+            ("--json-only", prefix + ".tree.json", read_json_dump),
+            ("--xml-only", prefix + ".xml", read_xml_dump),
+        ]:
+            proc = subprocess.run(
+                verilator_args + ["-Mdir", dump_dir, option],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                cwd=cwd,
+            )
+            dump_path = os.path.join(dump_dir, dump_file)
+            if proc.returncode == 0 and os.path.isfile(dump_path):
+                return reader(dump_path)
+            error = proc.stderr.decode("utf-8", errors="replace").strip()
+            errors.append("%s (exit code %d)%s" % (option, proc.returncode, ":\n" + error if error else ""))
+        warnings.warn(
+            "verilator could not dump the design, signals are found in the generated header instead, which misses "
+            "arrays and memories:\n" + "\n".join(errors)
+        )
+        return None
+    finally:
+        shutil.rmtree(dump_dir, ignore_errors=True)
+
+
+def model_members(header_files):
+    """Returns the set of identifiers declared in the given verilator generated headers."""
+    members = set()
+    for header_file in header_files:
+        if os.path.isfile(header_file):
+            with open(header_file) as f:
+                members.update(re.findall(r"[A-Za-z_][A-Za-z0-9_]*", f.read()))
+    return members
+
+
+def header_signals(header_file):
+    """Finds signals by scanning the VL_IN*, VL_OUT* and VL_SIG* declarations of a header.
+
+    This is the fallback for verilator versions that can not dump the design.
+    It does not find arrays and signals whose declarations use other macros."""
+    signals = []
+    with open(header_file) as f:
+        for line in f:
+            result = re.search(r"(VL_(IN|OUT|SIG)[^(]*)\(([^,]+),([0-9]+),([0-9]+)(?:,[0-9]+)?\);", line)
+            if not result:
+                continue
+            # sometime after verilator 4.012, these declarations contain &s
+            name = result.group(3).replace("&", "")
+            msb, lsb = int(result.group(4)), int(result.group(5))
+            if result.group(2) == "SIG":
+                if "[" in name or lsb != 0:
+                    continue
+                direction = None
+            else:
+                direction = "inout" if result.group(1).startswith("VL_INOUT") else result.group(2).lower() + "put"
+            signals.append({"name": name, "width": msb - lsb + 1, "direction": direction, "hierarchy": None, "dims": []})
+    return signals
+
+
+def discover_signals(verilator_args, build_dir, prefix, cwd=None):
+    """Discovers the signals of a design that verilator just generated a model for in build_dir.
+
+    verilator_args is the verilator command line used for the model, without -Mdir."""
+    return model_signals(dump_design(verilator_args, prefix, cwd), build_dir, prefix)
+
+
+def model_signals(dump, build_dir, prefix):
+    """Returns the signals of dump (see dump_design()) that are members of the model generated in build_dir.
+
+    Verilator can not write the dump while it generates the model (--json-only-output implies --json-only),
+    so dump_design() is a run of its own. It only elaborates the design and can run at the same time as the
+    run that generates the model, see PyVerilator.build()."""
+    header_file = os.path.join(build_dir, prefix + ".h")
+    root_header_file = os.path.join(build_dir, prefix + "___024root.h")
+    if dump is None:
+        return header_signals(header_file)
+    port_members = model_members([header_file])
+    # verilator 5 keeps the internal signals in the root class of the model
+    internal_members = model_members([root_header_file if os.path.isfile(root_header_file) else header_file])
+    signals = []
+    array_ports = []
+    for signal in design_signals(*dump):
+        if signal["direction"] is not None:
+            if signal["name"] in port_members and signal["dims"]:
+                array_ports.append(signal["name"])
+            elif signal["name"] in port_members:
+                signals.append(signal)
+        elif signal["name"] in internal_members:
+            signals.append(signal)
+    if array_ports:
+        warnings.warn("ports with unpacked dimensions are not supported and are skipped: " + ", ".join(array_ports))
+    return signals
+
+
+def write_signals(path, signals):
+    with open(path, "w") as f:
+        json.dump(signals, f, indent=1)
+
+
+def read_signals(path):
+    with open(path) as f:
+        return json.load(f)
@@ -0,0 +1,126 @@
+"""Incremental rebuilds of a model in a persistent build directory.
+
+PyVerilator.build() runs in stages: verilator generates C++ from the Verilog
+sources, the C++ wrapper is generated from the verilator header, and make
+compiles and links everything. When the same build_dir is used again, a stage
+is only executed if its inputs changed:
+
+    verilate  re-runs only if the verilator arguments or version changed, or
+              one of the files verilator read (listed in V<top>__ver.d) changed.
+              Verilator writes into a staging directory and only the generated
+              files whose contents changed are moved into build_dir, so make
+              only recompiles what actually changed.
+    wrapper   pyverilator_wrapper.cpp is only written if its contents changed.
+    make      decides itself what to rebuild based on file modification times.
+
+The state of the verilate stage is kept in a stamp file in build_dir.
+"""
+
+import json
+import os
+import shutil
+
+from pyverilator.cache import dependencies_changed, dependency_states
+
+# bump this when the layout of the stamp files changes
+STAMP_FORMAT_VERSION = 1
+
+
+def stamp_path(build_dir, stage):
+    return os.path.join(build_dir, "pyverilator_%s.stamp" % stage)
+
+
+def _read_stamp(build_dir, stage):
+    try:
+        with open(stamp_path(build_dir, stage)) as f:
+            stamp = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(stamp, dict) or stamp.get("version") != STAMP_FORMAT_VERSION:
+        return None
+    return stamp
+
+
+def stage_outputs(build_dir, stage):
+    """Returns the names of the files generated in build_dir the last time stage ran."""
+    stamp = _read_stamp(build_dir, stage)
+    return stamp["outputs"] if stamp is not None else []
+
+
+def stage_is_current(build_dir, stage, inputs):
+    """Returns True if stage already ran in build_dir with the same inputs.
+
+    inputs is a JSON serializable description of the stage arguments. The stage
+    is also out of date if one of its outputs is missing or one of its
+    dependencies changed. Dependencies are compared by size and modification
+    time first, and by contents if those differ."""
+    stamp = _read_stamp(build_dir, stage)
+    if stamp is None or stamp.get("inputs") != json.loads(json.dumps(inputs)):
+        return False
+    for output in stamp["outputs"]:
+        if not os.path.isfile(os.path.join(build_dir, output)):
+            return False
+    return not dependencies_changed(stamp["dependencies"])
+
+
+def record_stage(build_dir, stage, inputs, dependencies, outputs):
+    """Writes the stamp file of a stage that ran successfully in build_dir."""
+    stamp = {
+        "version": STAMP_FORMAT_VERSION,
+        "inputs": inputs,
+        "dependencies": dependency_states(dependencies),
+        "outputs": sorted(outputs),
+    }
+    tmp_path = stamp_path(build_dir, stage) + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(stamp, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, stamp_path(build_dir, stage))
+
+
+def invalidate_stage(build_dir, stage):
+    """Removes the stamp file of stage, so it runs again on the next build."""
+    if os.path.exists(stamp_path(build_dir, stage)):
+        os.remove(stamp_path(build_dir, stage))
+
+
+def write_if_changed(path, contents):
+    """Writes contents to the text file path unless it already has these contents.
+
+    An unchanged file keeps its modification time, so make does not rebuild
+    anything that depends on it. Returns True if the file was written."""
+    try:
+        with open(path) as f:
+            if f.read() == contents:
+                return False
+    except OSError:
+        pass
+    with open(path, "w") as f:
+        f.write(contents)
+    return True
+
+
+def _same_contents(path_a, path_b):
+    if os.path.getsize(path_a) != os.path.getsize(path_b):
+        return False
+    with open(path_a, "rb") as a, open(path_b, "rb") as b:
+        return a.read() == b.read()
+
+
+def update_outputs(staging_dir, build_dir, old_outputs=[]):
+    """Moves the files generated in staging_dir into build_dir.
+
+    Files whose contents did not change are left untouched in build_dir, and
+    files in old_outputs that were not generated again are removed. Returns the
+    names of the generated files."""
+    outputs = sorted(os.listdir(staging_dir))
+    for name in outputs:
+        source = os.path.join(staging_dir, name)
+        target = os.path.join(build_dir, name)
+        if os.path.isfile(target) and _same_contents(source, target):
+            continue
+        os.replace(source, target)
+    for name in old_outputs:
+        if name not in outputs and os.path.isfile(os.path.join(build_dir, name)):
+            os.remove(os.path.join(build_dir, name))
+    shutil.rmtree(staging_dir)
+    return outputs
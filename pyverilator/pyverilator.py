@@ -1,28 +1,270 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import contextlib
 import ctypes
+import io
 import json
 import os
-import re
 import shutil
 import subprocess
 import sys
 import tempfile
+import threading
+import time
 from keyword import iskeyword
 import warnings
+import weakref
 
 import pyverilator.verilatorcpp as template_cpp
+from pyverilator.cache import (
+    BuildCache,
+    build_key,
+    model_object_names,
+    read_dependency_file,
+    resolve_cache,
+    runtime_object_names,
+    runtime_objects,
+    unlink_shared_objects,
+    verilator_version,
+)
+from pyverilator.discovery import SIGNALS_FILE, dump_design, model_signals, read_signals, write_signals
+from pyverilator.incremental import (
+    invalidate_stage,
+    record_stage,
+    stage_is_current,
+    stage_outputs,
+    update_outputs,
+    write_if_changed,
+)
 
 # import tclwrapper
 
 
-def launch_process_helper(args):
+def launch_process_helper(args, cwd=None):
     """Helper function to launch a process in a way that facilitates logging
-    stdout/stderr with Python loggers."""
-    with subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as proc:
-        (verilator_cmd_out, verilator_cmd_err) = proc.communicate()
-    if verilator_cmd_out is not None:
-        sys.stdout.write(verilator_cmd_out.decode("utf-8"))
-    if verilator_cmd_err is not None:
-        sys.stderr.write(verilator_cmd_err.decode("utf-8"))
+    stdout/stderr with Python loggers.
+
+    The output of the process is written to sys.stdout and sys.stderr line by line while it runs.
+    Returns the output, or raises a BuildError holding it if the process exits with a non-zero code."""
+    log = []
+    lock = threading.Lock()
+
+    def forward(pipe, stream):
+        for line in iter(pipe.readline, b""):
+            text = line.decode("utf-8", errors="replace")
+            with lock:
+                log.append(text)
+                stream.write(text)
+                stream.flush()
+
+    with subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd) as proc:
+        forwarders = [
+            threading.Thread(target=forward, args=(proc.stdout, sys.stdout)),
+            threading.Thread(target=forward, args=(proc.stderr, sys.stderr)),
+        ]
+        for forwarder in forwarders:
+            forwarder.start()
+        for forwarder in forwarders:
+            forwarder.join()
+        returncode = proc.wait()
+    if returncode != 0:
+        raise BuildError(
+            "'%s' failed with exit code %d%s" % (" ".join(args), returncode, " in %s" % cwd if cwd is not None else ""),
+            "".join(log),
+        )
+    return "".join(log)
+
+
+def available_cpus():
+    """Returns the number of CPUs this process is allowed to run on."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+class BuildError(Exception):
+    """Raised by PyVerilator.build() when verilator or make fails, and by build_async() and build_many() when a
+    build fails.
+
+    log holds the output of verilator and make for the failed build."""
+
+    def __init__(self, message, log=""):
+        super().__init__(message)
+        self.log = log
+
+    def __reduce__(self):
+        return (BuildError, (str(self), self.log))
+
+
+class BuildReport:
+    """Describes how PyVerilator.build() built a model, available as the build_report attribute of the model.
+
+    phases maps the phases of the build to their wall time in seconds: cache_lookup, verilate, wrapper (generating
+    the C++ wrapper), compile, link and load. Phases that did not run are missing, e.g. a model found in the
+    cache only has cache_lookup and load. cache is "hit" or "miss" if a cache was used and None otherwise.
+    verilated is False if verilator did not run because build_dir was up to date. object_sizes maps the
+    objects, archives and the shared object in build_dir to their size in bytes. log holds the output of
+    verilator and make.
+
+    as_dict() returns the report as a JSON serializable dict, to track build times across designs and versions.
+    """
+
+    def __init__(self, top_module, build_dir=None):
+        self.top_module = top_module
+        self.build_dir = build_dir
+        self.so_file = None
+        self.phases = {}
+        self.cache = None
+        self.verilated = False
+        self.object_sizes = {}
+        self.log = ""
+
+    @property
+    def total_time(self):
+        return sum(self.phases.values())
+
+    def record_object_sizes(self, build_dir, so_file=None):
+        for name in sorted(os.listdir(build_dir)):
+            if name.endswith((".o", ".a")):
+                self.object_sizes[name] = os.path.getsize(os.path.join(build_dir, name))
+        if so_file is not None and os.path.isfile(so_file):
+            self.object_sizes[os.path.basename(so_file)] = os.path.getsize(so_file)
+
+    def as_dict(self):
+        return {
+            "top_module": self.top_module,
+            "build_dir": self.build_dir,
+            "so_file": self.so_file,
+            "phases": dict(self.phases),
+            "total_time": self.total_time,
+            "cache": self.cache,
+            "verilated": self.verilated,
+            "object_sizes": dict(self.object_sizes),
+        }
+
+    def __repr__(self):
+        return "BuildReport(%s, %.3fs, cache=%s)" % (self.top_module, self.total_time, self.cache)
+
+
+class BuildResult:
+    """A model compiled by PyVerilator.build_async().
+
+    so_file is the compiled model (None for gen_only builds), log holds the output of
+    verilator and make and report the BuildReport of the build.
+    Call load() to load the model into the current process. If the build used a
+    temporary build directory, it is removed when the loaded model is destroyed. A
+    result that is not loaded removes it in close() (also called at the end of a with
+    block), or when it is garbage collected."""
+
+    def __init__(self, spec, so_file, log, report, builddir_to_remove=None, mem_init_dirs=None):
+        self.spec = spec
+        self.so_file = so_file
+        self.log = log
+        self.report = report
+        self.mem_init_dirs = mem_init_dirs
+        self._own_builddir(builddir_to_remove)
+
+    def _own_builddir(self, builddir_to_remove):
+        self.builddir_to_remove = builddir_to_remove
+        self._finalizer = None
+        if builddir_to_remove is not None:
+            self._finalizer = weakref.finalize(self, shutil.rmtree, builddir_to_remove, ignore_errors=True)
+
+    def __getstate__(self):
+        # a result sent from a worker process is owned by the process that receives it
+        state = dict(self.__dict__)
+        if self._finalizer is not None:
+            self._finalizer.detach()
+        del state["_finalizer"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._own_builddir(self.builddir_to_remove)
+
+    def close(self):
+        """Removes the temporary build directory of a result that was not loaded."""
+        if self._finalizer is not None:
+            self._finalizer()
+        self._finalizer = None
+        self.builddir_to_remove = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def load(self):
+        if self.so_file is None:
+            return None
+        phase_start = time.perf_counter()
+        ret = PyVerilator(
+            self.so_file,
+            auto_eval=self.spec.get("auto_eval", True),
+            builddir_to_remove=self.builddir_to_remove,
+            threads=self.spec.get("threads"),
+            mem_init_dirs=self.mem_init_dirs,
+        )
+        # the loaded model owns the temporary build dir now
+        if self._finalizer is not None:
+            self._finalizer.detach()
+        self._finalizer = None
+        self.builddir_to_remove = None
+        self.report.phases["load"] = time.perf_counter() - phase_start
+        self.report.log = self.log
+        ret.build_report = self.report
+        ret.build_times = self.report.phases
+        ret.build_log = self.log
+        return ret
+
+    def __repr__(self):
+        return "BuildResult(%r)" % self.so_file
+
+
+def _build_worker(spec):
+    """Runs PyVerilator.build(**spec) in a worker process of PyVerilator.build_async()."""
+    log = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+            # the model is only loaded in the parent process
+            result = PyVerilator.build(_load=False, **spec)
+    except Exception as e:
+        raise BuildError("building %s failed: %s" % (spec.get("top_verilog_file"), e), log.getvalue()) from None
+    if result is None:
+        return BuildResult(spec, None, log.getvalue(), None)
+    result.spec = spec
+    result.log = log.getvalue()
+    return result
+
+
+# identity of the shared objects loaded by this process, by path
+_loaded_shared_objects = {}
+
+# default flush_every of start_trace(): after every dump, unless a flush_interval is given
+_FLUSH_EVERY_DEFAULT = object()
+
+
+def load_shared_object(so_file):
+    """Loads so_file with ctypes, even if an older version of it was already loaded from the same path.
+
+    The dynamic loader returns the library it already loaded for a path, even if
+    the file was rebuilt since then, so a rebuilt model is loaded through a
+    temporary hard link instead."""
+    st = os.stat(so_file)
+    identity = (st.st_dev, st.st_ino, st.st_mtime_ns)
+    if _loaded_shared_objects.setdefault(so_file, identity) == identity:
+        return ctypes.CDLL(so_file)
+    tmp_dir = tempfile.mkdtemp(prefix="pyverilator-")
+    try:
+        tmp_so_file = os.path.join(tmp_dir, os.path.basename(so_file))
+        try:
+            os.link(so_file, tmp_so_file)
+        except OSError:
+            shutil.copy2(so_file, tmp_so_file)
+        return ctypes.CDLL(tmp_so_file)
+    finally:
+        shutil.rmtree(tmp_dir)
 
 
 def verilator_name_to_standard_modular_name(verilator_name):
@@ -52,9 +294,6 @@ def verilator_name_to_standard_modular_name(verilator_name):
     In addition, sometimes '__PVT__' is added to verilator names to mark them as private.
     They can be replaced with ''."""
 
-    if "__BRA__" in verilator_name or "__KET__" in verilator_name:
-        raise NotImplementedError("__BRA__ and __KET__ are not currently supported")
-
     modular_verilator_name = verilator_name.split("__DOT__")
     if len(modular_verilator_name) > 1:
         # If there is at least one __DOT__ in the verilator signal name, then
@@ -63,6 +302,8 @@ def verilator_name_to_standard_modular_name(verilator_name):
         modular_verilator_name = modular_verilator_name[1:]
     final_modular_name = []
     for name_segment in modular_verilator_name:
+        # indices of generate blocks and instance arrays, e.g. blk__BRA__0__KET__ for blk[0]
+        name_segment = name_segment.replace("__BRA__", "[").replace("__KET__", "]")
         split_at_escape_char = name_segment.split("__0")
         final_name_segment = ""
         for i in range(len(split_at_escape_char)):
@@ -75,6 +316,311 @@ def verilator_name_to_standard_modular_name(verilator_name):
     return tuple(final_modular_name)
 
 
+def words_to_int(words):
+    """Converts a sequence of 32-bit words, least significant first, to an int."""
+    if sys.byteorder == "little":
+        return int.from_bytes(words, "little")
+    value = 0
+    for i, word in enumerate(words):
+        value |= word << (i * 32)
+    return value
+
+
+def signal_ctype(width):
+    """Returns the ctypes type verilator stores a signal of up to 64 bits in (CData, SData, IData or QData)."""
+    if width <= 8:
+        return ctypes.c_uint8
+    elif width <= 16:
+        return ctypes.c_uint16
+    elif width <= 32:
+        return ctypes.c_uint32
+    return ctypes.c_uint64
+
+
+def words_dtype(layout, num_words):
+    """Returns the NumPy structured dtype of a buffer of num_words 32-bit words holding the signals in layout.
+
+    layout is a list of (name, width, offset) tuples, where offset is the index of the first word of the signal.
+    Fields are uint32 for signals up to 32 bits, uint64 for signals up to 64 bits, and a subarray of uint32
+    words, least significant first, for wider signals."""
+    import numpy as np
+
+    formats = []
+    for _, width, _ in layout:
+        if width > 64:
+            formats.append(("<u4", ((width + 31) // 32,)))
+        elif width > 32:
+            formats.append("<u8")
+        else:
+            formats.append("<u4")
+    return np.dtype(
+        {
+            "names": [name for name, _, _ in layout],
+            "formats": formats,
+            "offsets": [offset * 4 for _, _, offset in layout],
+            "itemsize": num_words * 4,
+        }
+    )
+
+
+def int_to_words_bytes(value, num_words):
+    """Converts a non-negative int to the bytes of num_words native 32-bit words, least significant first."""
+    if sys.byteorder == "little":
+        return value.to_bytes(num_words * 4, "little")
+    return b"".join(((value >> (i * 32)) & 0xFFFFFFFF).to_bytes(4, "big") for i in range(num_words))
+
+
+class Tracer(ctypes.Structure):
+    """The state of automatic tracing, shared by python and the native loops of run() and run_vectors().
+
+    The model is only dumped in the cycles start_cycle <= cycle < stop_cycle. cycle counts clock cycles from the
+    start of the trace, or from the first change of the clock after which the signal number trigger had the
+    value trigger_value in the bits of trigger_mask; trigger is -1 once it matched or if there is none. dumps
+    counts the dumps of the native loops for the flush policy."""
+
+    _fields_ = [
+        ("tfp", ctypes.c_void_p),
+        ("cycle", ctypes.c_uint64),
+        ("start_cycle", ctypes.c_uint64),
+        ("stop_cycle", ctypes.c_uint64),
+        ("trigger", ctypes.c_int64),
+        ("trigger_mask", ctypes.c_uint64),
+        ("trigger_value", ctypes.c_uint64),
+        ("dumps", ctypes.c_uint64),
+    ]
+
+
+class RecorderState(ctypes.Structure):
+    """The state of a Recorder, shared by python and the native loops of run() and run_vectors().
+
+    signals are the numbers of the recorded signals and buffer the first of the rows of row_words 32-bit words
+    the samples are stored in, count is the number of samples so far and cycle the cycle of the next one.
+    every_eval records a sample after every evaluation instead of after every rising edge of the clock. With a
+    ring of n rows, sample i is stored in row i % n, so the buffer holds the last n samples. The states of all
+    active recorders are linked by next."""
+
+    _fields_ = [
+        ("signals", ctypes.c_void_p),
+        ("num_signals", ctypes.c_int32),
+        ("every_eval", ctypes.c_int32),
+        ("buffer", ctypes.c_void_p),
+        ("row_words", ctypes.c_uint64),
+        ("count", ctypes.c_uint64),
+        ("cycle", ctypes.c_uint64),
+        ("ring", ctypes.c_uint64),
+        ("next", ctypes.c_void_p),
+    ]
+
+
+def vcd_identifier(index):
+    """Returns the short identifier of the variable number index in a VCD file."""
+    identifier = ""
+    while True:
+        identifier += chr(33 + index % 94)
+        index //= 94
+        if not index:
+            return identifier
+
+
+class Recorder:
+    """Records the values of signals into NumPy arrays in memory, see PyVerilator.record() and
+    PyVerilator.flight_recorder().
+
+    A sample of all signals is taken after every rising edge of the clock of the model, or after every eval() if
+    the model has no clock, whether the clock is ticked from python or by run() and run_vectors(). With
+    auto_eval=False, the sample of a rising edge written from python is taken by the next eval(), so that it holds
+    the same values as the sample run() takes of that cycle. Each sample is copied by the model library into a row
+    of a preallocated buffer, which grows as needed, or, with ring, into a ring buffer of capacity rows that keeps
+    only the last capacity samples.
+
+        with sim.record(["count", "state"]) as recorder:
+            sim.run(1000)
+        recorder["count"]  # one value per cycle
+        recorder["cycle"]  # the cycle of each sample, counted from the start of the recording
+
+    Columns are NumPy arrays of the types of snapshot_dtype(): uint32 up to 32 bits, uint64 up to 64 bits, and
+    (samples, words) uint32 arrays above, least significant word first. The samples can be written to a VCD file
+    with dump(), which happens automatically if the with block of a recorder with a filename raises."""
+
+    def __init__(self, sim, signals=None, capacity=1024, ring=False, filename=None):
+        import numpy as np
+
+        self.sim = sim
+        self.filename = filename
+        self.names = []
+        self.signals = []
+        if signals is None:
+            signals = [name for name, _ in sim.inputs + sim.outputs + sim.internal_signals]
+        for signal in signals:
+            name = signal.verilator_name if isinstance(signal, Signal) else signal
+            found = signal if isinstance(signal, Signal) else sim.find_signal(signal)
+            if found is None or isinstance(found, InternalArray):
+                raise ValueError("record() can not record %r" % (signal,))
+            if name in self.names or name == "cycle":
+                raise ValueError("record() got the name %r twice" % (name,))
+            self.names.append(name)
+            self.signals.append(found)
+        layout = [("cycle", 64, 0)]
+        row_words = 2
+        for name, signal in zip(self.names, self.signals):
+            layout.append((name, signal.width, row_words))
+            row_words += (signal.width + 31) // 32
+        self.dtype = words_dtype(layout, row_words)
+        signal_numbers = [sim._signal_numbers[signal.verilator_name] for signal in self.signals]
+        self._signal_numbers = np.array(signal_numbers or [0], np.intc)
+        self._buffer = np.zeros(max(capacity, 1), dtype=self.dtype)
+        self._state = RecorderState(
+            signals=self._signal_numbers.ctypes.data,
+            num_signals=len(self.signals),
+            every_eval=int(sim.clock is None),
+            buffer=self._buffer.ctypes.data,
+            row_words=row_words,
+            ring=len(self._buffer) if ring else 0,
+        )
+
+    def __len__(self):
+        if self._state.ring:
+            return min(self._state.count, self._state.ring)
+        return self._state.count
+
+    def __getitem__(self, name):
+        """Returns a copy of the values of the signal name (or of the cycles, for "cycle") in the samples so far."""
+        if name != "cycle" and name not in self.names:
+            raise KeyError(name)
+        return self.records[name].copy()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and self.filename is not None:
+            self.dump()
+        self.stop()
+
+    @property
+    def records(self):
+        """The samples so far, oldest first, as a structured array with the dtype of the recorder (a view of its
+        buffer, or a copy once a ring buffer wrapped around)."""
+        import numpy as np
+
+        count = self._state.count
+        ring = self._state.ring
+        if ring and count > ring:
+            return np.concatenate((self._buffer[count % ring :], self._buffer[: count % ring]))
+        return self._buffer[:count]
+
+    def columns(self):
+        """Returns a dict mapping "cycle" and the names of the signals to copies of their values so far."""
+        records = self.records
+        return {name: records[name].copy() for name in ["cycle"] + self.names}
+
+    def clear(self):
+        """Discards the samples so far. The cycles of later samples keep counting."""
+        self._state.count = 0
+
+    def stop(self):
+        """Stops recording. The samples so far are kept."""
+        if self in self.sim._recorders:
+            self.sim._recorders.remove(self)
+            self.sim._link_recorders()
+            self._state.next = None
+
+    def dump(self, filename=None):
+        """Writes the samples so far to a VCD file, filename or the filename of the recorder.
+
+        The signals are declared in the scopes of their modules. In a model with a clock, each sample takes two
+        timestamps, so that the clock is visible: timestamp 2 * cycle holds the values after the rising edge of
+        the clock in that cycle, and 2 * cycle + 1 the falling edge. The clock is declared even if it is not
+        recorded. Without a clock, the timestamps are the cycles of the samples."""
+        if filename is None:
+            filename = self.filename
+        if filename is None:
+            raise ValueError("dump() requires a filename")
+        records = self.records
+        signals = list(self.signals)
+        # the values of each signal as ints, in the order of the signals
+        values = []
+        for name, signal in zip(self.names, self.signals):
+            column = records[name].tolist()
+            if signal.width > 64:
+                column = [sum(word << (i * 32) for i, word in enumerate(words)) for words in column]
+            values.append(column)
+        # the clock is 1 in every sample, which is taken after its rising edge
+        clock_index = None
+        if not self._state.every_eval:
+            if self.sim.clock.verilator_name in self.names:
+                clock_index = self.names.index(self.sim.clock.verilator_name)
+            else:
+                clock_index = len(signals)
+                signals.append(self.sim.clock)
+                values.append([1] * len(records))
+        # the signals of each scope, and the scopes in it
+        top_scope = ([], {})
+        for index, signal in enumerate(signals):
+            scope = top_scope
+            for module in signal.modular_name[:-1]:
+                scope = scope[1].setdefault(module, ([], {}))
+            scope[0].append(index)
+        lines = ["$timescale 1ns $end\n"]
+
+        def declare(scope_name, scope):
+            lines.append("$scope module %s $end\n" % scope_name)
+            for index in scope[0]:
+                signal = signals[index]
+                lines.append(
+                    "$var wire %d %s %s%s $end\n"
+                    % (
+                        signal.width,
+                        vcd_identifier(index),
+                        signal.modular_name[-1],
+                        " [%d:0]" % (signal.width - 1) if signal.width > 1 else "",
+                    )
+                )
+            for name, child in scope[1].items():
+                declare(name, child)
+            lines.append("$upscope $end\n")
+
+        declare(self.sim.module_name, top_scope)
+        lines.append("$enddefinitions $end\n")
+        previous = [None] * len(signals)
+        for row, cycle in enumerate(records["cycle"].tolist()):
+            lines.append("#%d\n" % (cycle if clock_index is None else 2 * cycle))
+            for index, column in enumerate(values):
+                value = column[row]
+                if value != previous[index]:
+                    previous[index] = value
+                    if signals[index].width == 1:
+                        lines.append("%d%s\n" % (value, vcd_identifier(index)))
+                    else:
+                        lines.append("b%s %s\n" % (format(value, "b"), vcd_identifier(index)))
+            if clock_index is not None:
+                lines.append("#%d\n0%s\n" % (2 * cycle + 1, vcd_identifier(clock_index)))
+                previous[clock_index] = 0
+        with open(filename, "w") as f:
+            f.writelines(lines)
+
+    def _room(self, cycles):
+        # returns how many of cycles clock cycles the buffer has room for, at least one: a full buffer grows to twice
+        # its size first, so it grows with the samples actually taken and not with the cycles a native loop may run
+        if self._state.ring:
+            return cycles
+        samples = 2 if self._state.every_eval else 1
+        if len(self._buffer) - self._state.count < samples:
+            self._reserve(samples)
+        return min(cycles, (len(self._buffer) - self._state.count) // samples)
+
+    def _reserve(self, samples):
+        # grows the buffer so that it has room for samples more samples
+        import numpy as np
+
+        count = self._state.count
+        if not self._state.ring and count + samples > len(self._buffer):
+            buffer = np.zeros(max(2 * len(self._buffer), count + samples), dtype=self.dtype)
+            buffer[:count] = self._buffer[:count]
+            self._buffer = buffer
+            self._state.buffer = buffer.ctypes.data
+
+
 class Collection:
     """Dictionary-like container for storing Signals and other Collections for PyVerilator.
 
@@ -255,31 +801,80 @@ class Collection:
 
 
 class Signal:
+    # signals are read in tight loops, slots keep their attribute lookups and memory footprint small
+    __slots__ = (
+        "sim_object",
+        "verilator_name",
+        "modular_name",
+        "width",
+        "value_function_and_args",
+        "_words",
+        "_view",
+        "_value_class",
+    )
+
     def __init__(self, pyverilator_sim, verilator_name, width):
         self.sim_object = pyverilator_sim
         self.verilator_name = verilator_name
         self.modular_name = verilator_name_to_standard_modular_name(verilator_name)
         self.width = width
-        # get the function and arguments required for getting the signal's value
-        if width <= 32:
+        self._value_class = None
+        self._bind_accessors()
+
+    def _bind_accessors(self):
+        # get the function and arguments required for getting the signal's value. Signals up to 64 bits are read
+        # directly from the memory of the model through a ctypes scalar at a fixed address. Otherwise the ctypes
+        # functions are resolved and typed once here, so reading the signal only calls into the model.
+        self._words = None
+        self._view = None
+        if self.width <= 64:
+            self._view = self.sim_object._signal_view(self.verilator_name, self.width)
+        if self._view is not None:
+            self.value_function_and_args = (getattr, self._view, "value")
+        elif self.width <= 32:
             self.value_function_and_args = (
-                self.sim_object._read_32,
-                self.verilator_name,
+                self.sim_object._function("get_" + self.verilator_name, [ctypes.c_void_p], ctypes.c_uint32),
+                self.sim_object.model,
             )
-        elif width <= 64:
+        elif self.width <= 64:
             self.value_function_and_args = (
-                self.sim_object._read_64,
-                self.verilator_name,
+                self.sim_object._function("get_" + self.verilator_name, [ctypes.c_void_p], ctypes.c_uint64),
+                self.sim_object.model,
             )
         else:
-            self.value_function_and_args = (
-                self.sim_object._read_words,
-                self.verilator_name,
-                (width + 31) // 32,
+            # the words of wide signals are read directly from the memory of the model
+            self._words = self.sim_object._words_view(self.verilator_name, self.width)
+            if self._words is not None:
+                self.value_function_and_args = (words_to_int, self._words)
+            else:
+                self.value_function_and_args = (
+                    self.sim_object._read_words,
+                    self.verilator_name,
+                    (self.width + 31) // 32,
+                )
+
+    def words(self, as_numpy=False):
+        """Returns a zero-copy view of the 32-bit words of a signal wider than 64 bits, least significant first.
+
+        The view is a memoryview of unsigned ints, or a NumPy uint32 array if as_numpy is True. It shares the
+        memory of the model, so it always shows the current value of the signal without any call into the model,
+        and it is only valid as long as the model exists. Writing through it does not evaluate the model, and
+        reading it does not evaluate a model with pending writes in lazy mode (auto_eval="lazy")."""
+        words = getattr(self, "_words", None)
+        if words is None:
+            raise ValueError(
+                "words() requires a signal wider than 64 bits, %s has %d bits" % (self.verilator_name, self.width)
             )
+        if as_numpy:
+            import numpy as np
+
+            return np.ctypeslib.as_array(words)
+        return memoryview(words).cast("B").cast("I")
 
     @property
     def value(self):
+        if self.sim_object._dirty:
+            self.sim_object.eval()
         # this calls the value function (the 0th element of self.value_function_and_args)
         # with the necessary arguments (the rest of self.value_function_and_args)
         return self.value_function_and_args[0](*self.value_function_and_args[1:])
@@ -298,6 +893,12 @@ class Signal:
     def collection_get(self):
         return SignalValue(self)
 
+    def value_class(self):
+        """Returns the subclass of SignalValue for the values of this signal, see SignalValue."""
+        if self._value_class is None:
+            self._value_class = type("SignalValue", (SignalValue,), {"__slots__": (), "signal": self})
+        return self._value_class
+
     def __repr__(self):
         short_name = self.modular_name[-1]
         return "{} = {}".format(short_name, self.status)
@@ -314,14 +915,30 @@ class SignalValue(int):
         sim.io.output.signal
     """
 
+    # int subclasses can not have non-empty __slots__, so values are instances of a subclass made for each signal
+    # (Signal.value_class()) that holds the signal as a class attribute, and value is the int itself
+    __slots__ = ()
+    signal = None
+
     def __new__(cls, signal, value=None):
         if value is None:
             value = signal.value
+        if cls is SignalValue:
+            cls = signal.value_class()
         ret = super().__new__(cls, value)
-        ret.signal = signal
-        ret.value = value
+        if hasattr(ret, "__dict__"):
+            # a subclass of SignalValue without slots, e.g. defined by the user
+            ret.signal = signal
         return ret
 
+    def __getnewargs__(self):
+        # copies are made with the signal, see __new__
+        return (self.signal, int(self))
+
+    @property
+    def value(self):
+        return int(self)
+
     def send_to_gtkwave(self):
         self.signal.sim_object.send_signal_to_gtkwave(self.signal)
 
@@ -336,41 +953,148 @@ class Submodule(Collection):
 
 
 class Output(Signal):
-    pass
+    __slots__ = ()
 
 
 class InternalSignal(Signal):
-    pass
+    __slots__ = ()
 
 
-class Input(Signal):
-    def __init__(self, pyverilator_sim, verilator_name, width):
+class InternalArray(InternalSignal):
+    """Unpacked array inside the design, such as a memory.
+
+    Elements are accessed by their offset from the lowest index of the array, which is their Verilog index if
+    the array is declared down to 0 (e.g. reg [7:0] mem [0:255] or reg [7:0] mem [255:0]). Multidimensional
+    arrays are flattened in row-major order. width is the width of one element.
+
+    Elements can also be written, e.g. to load the contents of a memory at runtime instead of through $readmemh.
+    """
+
+    __slots__ = ("length",)
+
+    def __init__(self, pyverilator_sim, verilator_name, width, length):
         super().__init__(pyverilator_sim, verilator_name, width)
-        if width <= 32:
+        self.length = length
+
+    def _bind_accessors(self):
+        # elements are read and written by PyVerilator._read_element() and _write_element()
+        pass
+
+    @property
+    def value(self):
+        return [self[i] for i in range(self.length)]
+
+    @property
+    def status(self):
+        return "%d x %d'h" % (self.length, self.width)
+
+    def collection_get(self):
+        return self
+
+    def __len__(self):
+        return self.length
+
+    def _check_index(self, index):
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("index %d is out of range for %s" % (index, self.verilator_name))
+        return index
+
+    def __getitem__(self, index):
+        return self.sim_object._read_element(self.verilator_name, self._check_index(index), self.width)
+
+    def __setitem__(self, index, value):
+        self.sim_object._write_element(self.verilator_name, self._check_index(index), self.width, value)
+        self.sim_object._post_write_hook(self.verilator_name, value)
+
+    def load(self, values, offset=0):
+        """Writes values to the elements starting at offset.
+
+        values is a sequence of ints, or a dict mapping indices to ints. The model is evaluated once after all
+        elements are written."""
+        items = values.items() if isinstance(values, dict) else enumerate(values, offset)
+        for index, value in items:
+            self.sim_object._write_element(self.verilator_name, self._check_index(index), self.width, value)
+        self.sim_object._post_write_hook(self.verilator_name, None)
+
+    def __iter__(self):
+        return (self[i] for i in range(self.length))
+
+    def __repr__(self):
+        return "{} = [{} x {} bits]".format(self.short_name, self.length, self.width)
+
+
+class Input(Signal):
+    __slots__ = ("write_function_and_args",)
+
+    def _bind_accessors(self):
+        super()._bind_accessors()
+        if self._view is not None:
+            self.write_function_and_args = (
+                self.sim_object._write_view,
+                self._view,
+                self.verilator_name,
+                (1 << self.width) - 1,
+            )
+        elif self.width <= 32:
+            self.write_function_and_args = (
+                self.sim_object._write_scalar,
+                self.sim_object._function("set_" + self.verilator_name, [ctypes.c_void_p, ctypes.c_uint32]),
+                self.verilator_name,
+            )
+        elif self.width <= 64:
             self.write_function_and_args = (
-                self.sim_object._write_32,
+                self.sim_object._write_scalar,
+                self.sim_object._function("set_" + self.verilator_name, [ctypes.c_void_p, ctypes.c_uint64]),
                 self.verilator_name,
             )
-        elif width <= 64:
+        elif self._words is not None:
             self.write_function_and_args = (
-                self.sim_object._write_64,
+                self.sim_object._write_wide,
+                self._words,
                 self.verilator_name,
+                self.width,
             )
         else:
             self.write_function_and_args = (
                 self.sim_object._write_words,
                 self.verilator_name,
-                (width + 31) // 32,
+                (self.width + 31) // 32,
             )
 
     def write(self, value):
         self.write_function_and_args[0](*self.write_function_and_args[1:], value)
 
+    def write_words(self, words):
+        """Writes a signal wider than 64 bits from a sequence of 32-bit words, least significant first.
+
+        words can be a list of ints or any object with a buffer of 32-bit words, e.g. a NumPy uint32 array,
+        which is copied into the model with a single call."""
+        num_words = (self.width + 31) // 32
+        try:
+            data = memoryview(words)
+        except TypeError:
+            data = None
+        if data is None or data.itemsize != 4:
+            data = memoryview((ctypes.c_uint32 * len(words))(*words))
+        if data.nbytes != num_words * 4:
+            raise ValueError("%s has %d words, got %d" % (self.verilator_name, num_words, data.nbytes // 4))
+        if self.width <= 64 or self._words is None:
+            self.write(words_to_int(data.cast("B").cast("I")))
+            return
+        ctypes.memmove(self._words, data.tobytes(), num_words * 4)
+        if self.width % 32:
+            self._words[num_words - 1] &= (1 << (self.width % 32)) - 1
+        self.sim_object._post_write_hook(self.verilator_name, None)
+
     def collection_set(self, value):
         self.write(value)
 
 
 class Clock(Input):
+    __slots__ = ()
+
     def __init__(self, input_):
         if not isinstance(input_, Input):
             raise TypeError("Clock must be made from an Input")
@@ -383,6 +1107,85 @@ class Clock(Input):
         self.write(1)
 
 
+class RawCollection:
+    """Low-overhead view of a Collection that reads and writes signals as plain ints.
+
+    Attribute access goes through a property generated for every signal, which calls the pre-bound accessor of
+    the signal directly, without the lookups of Collection.__getattr__ and without creating a SignalValue:
+
+        while sim.raw.ready == 0:
+            sim.clock.tick()
+        sim.raw.data = 0x42
+
+    Signals that are not legal Python identifiers can be accessed as items (sim.raw["name"]), Python keywords
+    by appending "_" (sim.raw.in_), nested collections are RawCollections as well, and internal arrays are
+    returned as InternalArray objects, whose elements are plain ints already.
+    """
+
+    __slots__ = ("_items",)
+
+    @classmethod
+    def from_collection(cls, collection):
+        items = {}
+        attributes = {"__slots__": ()}
+        for name, item in collection._item_dict.items():
+            if isinstance(item, Collection):
+                item = cls.from_collection(item)
+            items[name] = item
+            attribute = name + "_" if iskeyword(name) else name
+            if (attribute not in collection._item_dict or attribute == name) and not hasattr(RawCollection, attribute):
+                attributes[attribute] = cls._property(item)
+        # each collection gets its own subclass, which holds the properties of its signals
+        ret = type(cls.__name__, (cls,), attributes)()
+        ret._items = items
+        return ret
+
+    @staticmethod
+    def _property(item):
+        if not isinstance(item, Signal) or isinstance(item, InternalArray):
+            return property(lambda self: item)
+        sim = item.sim_object
+        read = item.value_function_and_args[0]
+        read_args = item.value_function_and_args[1:]
+
+        def get(self):
+            if sim._dirty:
+                sim.eval()
+            return read(*read_args)
+
+        if not isinstance(item, Input):
+            return property(get)
+        write = item.write_function_and_args[0]
+        write_args = item.write_function_and_args[1:]
+        return property(get, lambda self, value: write(*write_args, value))
+
+    def __getitem__(self, name):
+        if name not in self._items:
+            raise ValueError("'%s' object has no item '%s'" % (self.__class__.__name__, name))
+        item = self._items[name]
+        if isinstance(item, Signal) and not isinstance(item, InternalArray):
+            return item.value
+        return item
+
+    def __setitem__(self, name, value):
+        item = self._items.get(name)
+        if not isinstance(item, Input):
+            raise ValueError('Item "%s" does not exist or can not be set' % name)
+        item.write(value)
+
+    def __contains__(self, name):
+        return name in self._items
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __dir__(self):
+        return sorted(self._items)
+
+    def __repr__(self):
+        return "<{} of {} items>".format(self.__class__.__name__, len(self._items))
+
+
 class PyVerilator:
     """Python wrapper for verilator model.
 
@@ -420,6 +1223,17 @@ class PyVerilator:
         auto_eval=True,
         read_internal_signals=False,
         extra_args=[],
+        cache=None,
+        make_jobs=None,
+        compiler_launcher=None,
+        opt_fast=None,
+        opt_slow=None,
+        opt_global=None,
+        threads=None,
+        shared_runtime=None,
+        trace_format="vcd",
+        trace_threads=None,
+        _load=True,
     ):
         """Build an object file from verilog and load it into python.
 
@@ -438,9 +1252,55 @@ class PyVerilator:
         For example a model coming from bluespec will carry the list of rules of the model in this payload.
 
         gen_only stops the process before compiling the cpp into object.
+
+        cache selects a persistent cache of compiled models (see pyverilator.cache). It can be a BuildCache, a
+        cache directory, True to use the default cache directory, or False to disable caching. By default, a cache
+        is only used if $PYVERILATOR_CACHE_DIR is set. On a cache hit, verilator and make are not run at all and the
+        model is loaded from a copy of the cached shared object, in build_dir if one is given and in a temporary
+        directory otherwise.
+
+        make_jobs is the number of parallel compile jobs (make -j). It defaults to the number of available cores.
+        Verilator splits the C++ of large designs into several files that can be compiled in parallel; to split
+        smaller designs too, pass e.g. "--output-split 5000" in extra_args.
+
+        compiler_launcher is a program that is prepended to every compiler invocation, for example "ccache".
+
+        opt_fast, opt_slow and opt_global override the optimization flags verilator uses for the performance critical
+        model code, the code that runs once (e.g. initialization) and the verilator runtime library, for example
+        opt_fast="-O2". None keeps verilator's defaults.
+
+        threads builds a multithreaded model (verilator --threads) that evaluates the design on this many threads. The
+        thread count can be raised when the model is loaded, see PyVerilator.__init__.
+
+        trace_format selects the waveform format written by start_trace(): "vcd" (verilator --trace) or "fst"
+        (verilator --trace-fst). FST files are compressed and usually an order of magnitude smaller than VCD files.
+        Building FST models requires zlib (lz4 is optional).
+
+        trace_threads moves the FST writer to this many threads of its own (verilator --trace-threads), so the
+        compression runs next to the simulation instead of in it. Without it, compressing makes FST tracing slower
+        than VCD tracing. It requires trace_format="fst", and verilator 5 uses at most 2 trace threads.
+
+        shared_runtime links the design against verilator runtime objects (verilated.o, ...) that are compiled once
+        per verilator installation and compiler configuration and kept in the cache directory, instead of compiling
+        them again in every build_dir. By default this is done whenever a cache is used; True uses the default cache
+        directory even if caching is disabled.
+
+        When build_dir is reused, the build is incremental: verilator only runs again if its arguments or one of
+        the files it read changed, and only the generated C++ files that changed are recompiled (see
+        pyverilator.incremental).
+
+        The output of verilator and make is printed while they run. If one of them fails, a BuildError holding
+        its output is raised.
+
+        A BuildReport with the wall time of each phase of the build, the sizes of the compiled objects and whether
+        the model was found in the cache is stored in the build_report attribute of the returned object. Its
+        build_times attribute is a shortcut to the phases of the report.
+
+        _load is internal to build_async(): with _load=False, the model is not loaded and a BuildResult is returned.
         """
-        # verilator can't find memory init .dat files unless they are in the cwd
-        # so switch to where those are, based on the following sequence of rules:
+        # relative paths (top_verilog_file, verilog_path, build_dir and paths in extra_args) are relative to
+        # the top-level directory of the project, which is also searched for memory initialization .dat files.
+        # It is determined by the following sequence of rules:
         if not isinstance(top_verilog_file, list) and os.path.isabs(top_verilog_file):
             # if the top_verilog_file is specified with absolute path, use its parent directory
             top_verilog_dir = os.path.dirname(os.path.realpath(top_verilog_file))
@@ -454,9 +1314,8 @@ class PyVerilator:
             # if all fails, use the existing working dir
             top_verilog_dir = os.getcwd()
             warnings.warn("Could not determine a top-level directory for project, memory initialization .dat files may not be found")
-
-        old_cwd = os.getcwd()
-        os.chdir(top_verilog_dir)
+        # verilator runs in this directory, the working directory of the process is never changed
+        top_verilog_dir = os.path.abspath(top_verilog_dir)
 
         # get the module name from the verilog file name
         if not isinstance(top_verilog_file, list):
@@ -466,15 +1325,114 @@ class PyVerilator:
             verilog_module_name = top_module_name
             extension = None
 
+        if top_module_name is None and extension != ".v":
+            raise ValueError("PyVerilator() expects top_verilog_file to be a verilog file ending in .v")
+
+        if not isinstance(top_verilog_file, list):
+            verilog_file_arg = [top_verilog_file]
+        else:
+            verilog_file_arg = top_verilog_file
+
+        # Verilator is a perl program that is run as an executable
+        # Old versions of Verilator are interpreted as a perl script by the shell,
+        # while more recent versions are interpreted as a bash script that calls perl on itself
+        which_verilator = shutil.which("verilator")
+        if which_verilator is None:
+            raise Exception("'verilator' executable not found")
+
+        if trace_format not in ("vcd", "fst"):
+            raise ValueError('trace_format must be "vcd" or "fst", not %r' % (trace_format,))
+        if trace_threads is not None and trace_format != "fst":
+            raise ValueError('trace_threads requires trace_format="fst"')
+
+        verilator_cflags = "-fPIC --std=c++11"
+        # on Linux, the model looks up memory initialization files in the directories passed to
+        # PyVerilator.__init__ by wrapping fopen at link time
+        wrap_fopen = sys.platform.startswith("linux")
+        make_flags = ["CFLAGS=-fPIC -shared", "LDFLAGS=-fPIC -shared" + (" -Wl,--wrap=fopen" if wrap_fopen else "")]
+        for opt_var, opt_value in [("OPT_FAST", opt_fast), ("OPT_SLOW", opt_slow), ("OPT_GLOBAL", opt_global)]:
+            if opt_value is not None:
+                make_flags.append("%s=%s" % (opt_var, opt_value))
+        report = BuildReport(verilog_module_name)
+        build_times = report.phases
+        log = []
+        phase_start = time.perf_counter()
+
+        build_cache = None if gen_only else resolve_cache(cache)
+        cache_key = None
+        if build_cache is not None:
+            cache_key = build_key(
+                which_verilator,
+                verilog_file_arg,
+                verilog_path,
+                extra_args,
+                cwd=top_verilog_dir,
+                top_module_name=top_module_name,
+                trace_depth=trace_depth,
+                read_internal_signals=read_internal_signals,
+                json_data=json_data,
+                verilator_cflags=verilator_cflags,
+                make_flags=make_flags,
+                threads=threads,
+                trace_format=trace_format,
+                trace_threads=trace_threads,
+            )
+            cached_so_file = build_cache.lookup(cache_key)
+            if cached_so_file is not None:
+                builddir_to_remove = None
+                if build_dir is not None:
+                    # keep build_dir usable as the model directory, e.g. for memory initialization files
+                    build_dir = os.path.join(top_verilog_dir, build_dir)
+                    os.makedirs(build_dir, exist_ok=True)
+                    so_file = os.path.join(build_dir, os.path.basename(cached_so_file))
+                    # copy then rename, so that a model already loaded from so_file is not overwritten in place
+                    shutil.copy2(cached_so_file, so_file + ".tmp")
+                    os.replace(so_file + ".tmp", so_file)
+                else:
+                    # the model gets a directory of its own, that outlives eviction of the entry and is loaded as a
+                    # separate library instance
+                    build_dir = tempfile.mkdtemp(prefix=verilog_module_name + "-")
+                    builddir_to_remove = build_dir
+                    so_file = os.path.join(build_dir, os.path.basename(cached_so_file))
+                    try:
+                        os.link(cached_so_file, so_file)
+                    except OSError:
+                        shutil.copy2(cached_so_file, so_file)
+                build_times["cache_lookup"] = time.perf_counter() - phase_start
+                report.cache = "hit"
+                report.build_dir = build_dir
+                report.so_file = so_file
+                report.object_sizes[os.path.basename(so_file)] = os.path.getsize(so_file)
+                mem_init_dirs = [os.path.dirname(so_file), top_verilog_dir]
+                if not _load:
+                    return BuildResult(
+                        None, so_file, None, report, builddir_to_remove=builddir_to_remove, mem_init_dirs=mem_init_dirs
+                    )
+                phase_start = time.perf_counter()
+                ret = cls(
+                    so_file,
+                    auto_eval=auto_eval,
+                    builddir_to_remove=builddir_to_remove,
+                    threads=threads,
+                    mem_init_dirs=mem_init_dirs,
+                )
+                build_times["load"] = time.perf_counter() - phase_start
+                ret.build_report = report
+                ret.build_times = build_times
+                return ret
+            build_times["cache_lookup"] = time.perf_counter() - phase_start
+            report.cache = "miss"
+
         builddir_is_tmp = False
         if build_dir is None:
             build_dir = tempfile.mkdtemp(prefix=verilog_module_name + "-")
             builddir_is_tmp = True
-        if top_module_name is None and extension != ".v":
-            raise ValueError("PyVerilator() expects top_verilog_file to be a verilog file ending in .v")
+        else:
+            build_dir = os.path.join(top_verilog_dir, build_dir)
 
         if not os.path.exists(build_dir):
-            os.makedirs(build_dir)        
+            os.makedirs(build_dir)
+        report.build_dir = build_dir
         verilator_cpp_wrapper_path = os.path.join(build_dir, "pyverilator_wrapper.cpp")
 
         # call verilator executable to generate the verilator C++ files
@@ -487,142 +1445,349 @@ class PyVerilator:
         else:
             top_module_arg = []
 
-        if not isinstance(top_verilog_file, list):
-            verilog_file_arg = [top_verilog_file]
+        if threads is not None:
+            threads_arg = ["--threads", "%d" % threads]
         else:
-            verilog_file_arg = top_verilog_file
+            threads_arg = []
 
-        # Verilator is a perl program that is run as an executable
-        # Old versions of Verilator are interpreted as a perl script by the shell,
-        # while more recent versions are interpreted as a bash script that calls perl on itself
-        which_verilator = shutil.which("verilator")
-        if which_verilator is None:
-            raise Exception("'verilator' executable not found")
-        # tracing (--trace) is required in order to see internal signals
+        # tracing (--trace or --trace-fst) is required in order to see internal signals
+        trace_args = ["--trace-fst"] if trace_format == "fst" else ["--trace"]
+        if trace_threads is not None:
+            trace_args += ["--trace-threads", "%d" % trace_threads]
         verilator_args = (
-            ["perl", which_verilator, "-Wno-fatal", "-Mdir", build_dir]
-            + verilog_path_args
-            + [
-                "--CFLAGS",
-                "-fPIC --std=c++11",
-                "--trace",
-                "--trace-depth",
-                "%d" % trace_depth,
-                "--cc",
-            ]
+            verilog_path_args
+            + ["--CFLAGS", verilator_cflags]
+            + trace_args
+            + ["--trace-depth", "%d" % trace_depth, "--cc"]
             + verilog_file_arg
             + top_module_arg
+            + threads_arg
             + ["--exe", verilator_cpp_wrapper_path]
             + extra_args
         )
-        launch_process_helper(verilator_args)
-
-        # get inputs, outputs, and internal signals by parsing the generated verilator output
-        inputs = []
-        outputs = []
+        verilator_cmd = ["perl", which_verilator, "-Wno-fatal"] + verilator_args
+        signals_file = os.path.join(build_dir, SIGNALS_FILE)
+
+        def verilate(output_dir):
+            report.verilated = True
+            # the ports and internal signals of the model are found in a dump of the design, which verilator writes
+            # in a run of its own, at the same time as the model is generated
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                dump = executor.submit(dump_design, verilator_cmd, "V" + verilog_module_name, top_verilog_dir)
+                log.append(launch_process_helper(verilator_cmd + ["-Mdir", output_dir], cwd=top_verilog_dir))
+            # the signals are kept with the generated files
+            if os.path.exists(os.path.join(output_dir, "V%s.h" % verilog_module_name)):
+                signals = model_signals(dump.result(), output_dir, "V" + verilog_module_name)
+                write_signals(os.path.join(output_dir, SIGNALS_FILE), signals)
+
+        phase_start = time.perf_counter()
+        if builddir_is_tmp:
+            verilate(build_dir)
+        else:
+            # only run verilator again if its arguments or one of the files it read changed
+            verilate_inputs = {
+                "verilator": verilator_version(which_verilator),
+                "cwd": top_verilog_dir,
+                "args": verilator_args,
+            }
+            if not stage_is_current(build_dir, "verilate", verilate_inputs):
+                invalidate_stage(build_dir, "verilate")
+                # verilator rewrites all of its output files, so generate them in a staging directory and only
+                # move the ones that changed into build_dir to keep make from recompiling unchanged files
+                staging_dir = tempfile.mkdtemp(prefix=".verilator-", dir=build_dir)
+                try:
+                    verilate(staging_dir)
+                    staged_ver_d = os.path.join(staging_dir, "V%s__ver.d" % verilog_module_name)
+                    dependencies = []
+                    if os.path.exists(staged_ver_d):
+                        dependencies = [os.path.join(top_verilog_dir, d) for d in read_dependency_file(staged_ver_d)]
+                    outputs = update_outputs(staging_dir, build_dir, stage_outputs(build_dir, "verilate"))
+                finally:
+                    shutil.rmtree(staging_dir, ignore_errors=True)
+                if os.path.exists(os.path.join(build_dir, "V%s.mk" % verilog_module_name)) and os.path.exists(
+                    signals_file
+                ):
+                    record_stage(build_dir, "verilate", verilate_inputs, dependencies, outputs)
+        build_times["verilate"] = time.perf_counter() - phase_start
+
+        # get inputs, outputs, and internal signals discovered when verilator ran
+        signals = read_signals(signals_file)
+        inputs = [(signal["name"], signal["width"]) for signal in signals if signal["direction"] in ("input", "inout")]
+        outputs = [(signal["name"], signal["width"]) for signal in signals if signal["direction"] == "output"]
         internal_signals = []
-        verilator_h_file = os.path.join(build_dir, "V" + verilog_module_name + ".h")
-
-        def search_for_signal_decl(signal_type, line):
-            # looks for VL_IN*, VL_OUT*, or VL_SIG* macros
-            result = re.search(
-                "(VL_" + signal_type + r"[^(]*)\(([^,]+),([0-9]+),([0-9]+)(?:,[0-9]+)?\);",
-                line,
-            )
-            if result:
-                signal_name = result.group(2)
-                # sometime after verilator 4.012, these declarations contain &s
-                signal_name = signal_name.replace("&", "")
-                if signal_type == "SIG":
-                    if "[" not in signal_name and int(result.group(4)) == 0:
-                        # this is an internal signal
-                        signal_width = int(result.group(3)) - int(result.group(4)) + 1
-                        return (signal_name, signal_width)
-                    else:
-                        return None
-                else:
-                    # this is an input or an output
-                    signal_width = int(result.group(3)) - int(result.group(4)) + 1
-                    return (signal_name, signal_width)
-            else:
-                return None
-
-        with open(verilator_h_file) as f:
-            for line in f:
-                result = search_for_signal_decl("IN", line)
-                if result:
-                    inputs.append(result)
-                result = search_for_signal_decl("OUT", line)
-                if result:
-                    outputs.append(result)
-                result = search_for_signal_decl("SIG", line)
-                if result and read_internal_signals:
-                    internal_signals.append(result)
+        internal_arrays = []
+        if read_internal_signals:
+            for signal in signals:
+                if signal["direction"] is None and signal["dims"]:
+                    internal_arrays.append((signal["name"], signal["width"], signal["dims"]))
+                elif signal["direction"] is None:
+                    internal_signals.append((signal["name"], signal["width"]))
+        with open(os.path.join(build_dir, "V" + verilog_module_name + ".h")) as f:
+            verilator_h = f.read()
+        # verilator 4.2 and later construct models in a VerilatedContext
+        has_context = "VerilatedContext" in verilator_h
 
         # generate the C++ wrapper file
+        phase_start = time.perf_counter()
         verilator_cpp_wrapper_code = template_cpp.template_cpp(
             verilog_module_name,
             inputs,
             outputs,
             internal_signals,
             json.dumps(json.dumps(json_data)),
+            threads=threads if threads is not None else 1,
+            has_context=has_context,
+            wrap_fopen=wrap_fopen,
+            internal_arrays=internal_arrays,
+            root_header=os.path.exists(os.path.join(build_dir, "V%s___024root.h" % verilog_module_name)),
+            trace_format=trace_format,
         )
-        with open(verilator_cpp_wrapper_path, "w") as f:
-            f.write(verilator_cpp_wrapper_code)
+        # keep the mtime of an unchanged wrapper, so make does not compile it again
+        write_if_changed(verilator_cpp_wrapper_path, verilator_cpp_wrapper_code)
+        build_times["wrapper"] = time.perf_counter() - phase_start
 
         # if only generating verilator C++ files, stop here
         if gen_only:
-            os.chdir(old_cwd)
             return None
 
-        # call make to build the pyverilator shared object
+        # link precompiled verilator runtime objects into build_dir, so make does not compile them again
+        if shared_runtime is None:
+            runtime_cache = build_cache
+        elif shared_runtime:
+            runtime_cache = build_cache if build_cache is not None else BuildCache()
+        else:
+            runtime_cache = None
+        if runtime_cache is not None:
+            runtime_key, runtime_object_files = runtime_objects(
+                which_verilator, build_dir, "V" + verilog_module_name, make_flags
+            )
+            runtime_linked = runtime_cache.link_runtime_objects(runtime_key, runtime_object_files, build_dir)
+            if not runtime_linked:
+                # objects linked for another configuration (e.g. other threads or OPT_* flags) must not be
+                # recompiled in place, nor stored under this key
+                unlink_shared_objects(build_dir, runtime_object_files)
+        else:
+            unlink_shared_objects(build_dir, runtime_object_names(build_dir, "V" + verilog_module_name))
+
+        # call make to build the pyverilator shared object, first compiling all objects and then linking them, so
+        # both steps are timed separately
+        if make_jobs is None:
+            make_jobs = available_cpus()
         make_args = [
             "make",
             "-C",
             build_dir,
             "-f",
             "V%s.mk" % verilog_module_name,
-            "CFLAGS=-fPIC -shared",
-            "LDFLAGS=-fPIC -shared",
-        ]
-        launch_process_helper(make_args)
+            "-j%d" % make_jobs,
+        ] + make_flags
+        if compiler_launcher is not None:
+            make_args.append("OBJCACHE=%s" % compiler_launcher)
+        phase_start = time.perf_counter()
+        log.append(
+            launch_process_helper(make_args + model_object_names(build_dir, "V" + verilog_module_name), cwd=build_dir)
+        )
+        build_times["compile"] = time.perf_counter() - phase_start
+        if runtime_cache is not None and not runtime_linked:
+            runtime_cache.store_runtime_objects(runtime_key, runtime_object_files, build_dir)
         so_file = os.path.join(build_dir, "V" + verilog_module_name)
-        if builddir_is_tmp:
-            # mark the build dir for removal upon destruction
-            ret = cls(so_file, builddir_to_remove=build_dir, auto_eval=auto_eval)
-        else:
-            ret = cls(so_file, auto_eval=auto_eval)
-        os.chdir(old_cwd)
+        phase_start = time.perf_counter()
+        log.append(launch_process_helper(make_args + ["V" + verilog_module_name], cwd=build_dir))
+        build_times["link"] = time.perf_counter() - phase_start
+        report.so_file = so_file
+        report.log = "".join(log)
+        report.record_object_sizes(build_dir, so_file)
+        if build_cache is not None:
+            # verilator also reads files that are not part of the key, e.g. modules next to the top-level file
+            ver_d = os.path.join(build_dir, "V%s__ver.d" % verilog_module_name)
+            dependencies = []
+            if os.path.exists(ver_d):
+                dependencies = [os.path.join(top_verilog_dir, d) for d in read_dependency_file(ver_d)]
+            build_cache.store(cache_key, so_file, {"top_module": verilog_module_name}, dependencies)
+        if not _load:
+            # build_async() loads the model in another process, see BuildResult
+            return BuildResult(
+                None,
+                so_file,
+                report.log,
+                report,
+                builddir_to_remove=build_dir if builddir_is_tmp else None,
+                mem_init_dirs=[build_dir, top_verilog_dir],
+            )
+        phase_start = time.perf_counter()
+        ret = cls(
+            so_file,
+            auto_eval=auto_eval,
+            # mark a temporary build dir for removal upon destruction
+            builddir_to_remove=build_dir if builddir_is_tmp else None,
+            threads=threads,
+            mem_init_dirs=[build_dir, top_verilog_dir],
+        )
+        build_times["load"] = time.perf_counter() - phase_start
+        ret.build_report = report
+        ret.build_times = build_times
+        ret.build_log = report.log
         return ret
 
-    def __init__(self, so_file, auto_eval=True, builddir_to_remove=None):
-        # set cwd to where the .so file is during init to find *.dat files
-        # in the same directory
+    @classmethod
+    def build_async(cls, specs, max_workers=None):
+        """Builds several models concurrently in a pool of worker processes.
+
+        specs is a list of dicts of keyword arguments for PyVerilator.build(), e.g.
+            [{'top_verilog_file': 'axi_ram.v', 'extra_args': ['-GDATA_WIDTH=%d' % w]} for w in (32, 64)]
+
+        max_workers is the number of builds that run at the same time. It defaults to the number of
+        available cores. Unless a spec sets make_jobs, the cores are split between the concurrent builds.
+
+        Returns a list of concurrent.futures.Future, one per spec, whose result is a BuildResult. The output
+        of verilator and make of each build is captured in the log of its result instead of being printed.
+        If a build fails, its future raises a BuildError holding the log of that build.
+        """
+        specs = [dict(spec) for spec in specs]
+        if max_workers is None:
+            max_workers = min(max(len(specs), 1), available_cpus())
+        for spec in specs:
+            spec.setdefault("make_jobs", max(available_cpus() // max_workers, 1))
+        executor = ProcessPoolExecutor(max_workers=max_workers)
+        futures = [executor.submit(_build_worker, spec) for spec in specs]
+        # the workers exit once all builds are done
+        executor.shutdown(wait=False)
+        return futures
+
+    @classmethod
+    def build_many(cls, specs, max_workers=None, return_exceptions=False):
+        """Builds several models concurrently and loads them, see build_async().
+
+        Returns the loaded models in the order of specs. The log of each build is stored in the build_log
+        attribute of its model. If a build fails, a BuildError is raised once all builds finished, or returned
+        in place of the model if return_exceptions is True.
+        """
+        futures = cls.build_async(specs, max_workers=max_workers)
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except BuildError as e:
+                results.append(e)
+        errors = [result for result in results if isinstance(result, BuildError)]
+        if errors and not return_exceptions:
+            for result in results:
+                if isinstance(result, BuildResult):
+                    result.close()
+            raise errors[0]
+        sims = []
+        try:
+            for result in results:
+                sims.append(result if isinstance(result, BuildError) else result.load())
+        finally:
+            # the temporary build dirs of results not loaded because loading one failed
+            for result in results:
+                if isinstance(result, BuildResult):
+                    result.close()
+        return sims
+
+    def __init__(self, so_file, auto_eval=True, builddir_to_remove=None, threads=None, mem_init_dirs=None):
+        """Load a model from a shared object built by PyVerilator.build().
+
+        threads is the number of threads used to evaluate a multithreaded model. It defaults to the thread count the
+        model was built with and can not be lower than that. Models built without threads always run on one thread.
+
+        auto_eval selects when the model is evaluated after inputs are written: True evaluates it after every write,
+        False only when eval() is called, and "lazy" marks the model dirty on writes and evaluates it just before
+        it is read, traced or explicitly evaluated, and before an input that was already written since the last
+        evaluation is written again, so that no clock edge is lost.
+
+        mem_init_dirs is the list of directories in which memory initialization files ($readmemh, ...) with relative
+        paths are searched for. It defaults to the directory of so_file. Each model has its own directories and the
+        working directory of the process is not used or changed, so models can be loaded from several threads at the
+        same time, also from the same shared object.
+        """
+        so_file = os.path.abspath(so_file)
         so_dir = os.path.dirname(os.path.realpath(so_file))
-        old_cwd = os.getcwd()
-        os.chdir(so_dir)
+        if mem_init_dirs is None:
+            mem_init_dirs = [so_dir]
+        self.so_file = so_file
+        self.build_report = None
+        self.build_times = {}
+        self.build_log = None
         self.builddir_to_remove = builddir_to_remove
         # initialize lib and model first so if __init__ fails, __del__ will
         # not fail.
         self.lib = None
         self.model = None
         self.auto_eval = auto_eval
+        # with auto_eval="lazy": whether inputs were written since the last eval(), and which ones
+        self._dirty = False
+        self._dirty_inputs = set()
         # initialize vcd variables
         self.vcd_filename = None
         self.vcd_trace = None
         self.auto_tracing_mode = None
+        # the cycle window and trigger of automatic tracing, see Tracer
+        self._tracer = None
+        self._trigger_signal = None
+        # the active recorders, see record(), and with auto_eval=False whether the next eval() takes a sample
+        self._recorders = []
+        self._sample_pending = False
+        self.vcd_flush_every = 1
+        self.vcd_flush_interval = None
         self.curr_time = 0
         self.vcd_reader = None
         self.gtkwave_active = False
-        self.lib = ctypes.CDLL(so_file)
-        construct = self.lib.construct
-        construct.restype = ctypes.c_void_p
-        self.model = construct()
-        # get inputs, outputs, internal_signals, and json_data
-        self._read_embedded_data()
-        self._sim_init()
-        # constructor helpers
-        self._populate_signal_collections()
+        self.lib = load_shared_object(so_file)
+        # ctypes functions of the model library by name, see _function()
+        self._functions = {}
+        # signals and buffer of snapshot(), by whether internal signals are included
+        self._snapshot_layouts = {}
+        # dtypes of snapshot(as_numpy=True), by whether internal signals are included
+        self._snapshot_dtypes = {}
+        # addresses of the signals in the memory of the model, see _signal_view()
+        self._signal_addresses = None
+        # layout and buffers of write_many()
+        self._input_layout = None
+        # nesting depth of deferred_eval() blocks, and the inputs written in them
+        self._eval_deferred = 0
+        self._deferred_inputs = set()
+        self._eval = self._function("eval", [ctypes.c_void_p], ctypes.c_int)
+        self.build_threads = ctypes.c_uint32.in_dll(self.lib, "_pyverilator_threads").value
+        if threads is None:
+            threads = self.build_threads
+        elif threads < self.build_threads:
+            raise ValueError("model was built with %d threads, it can not run on %d" % (self.build_threads, threads))
+        self.threads = threads
+        try:
+            self.trace_format = ctypes.c_char_p.in_dll(self.lib, "_pyverilator_trace_format").value.decode("ascii")
+        except ValueError:
+            # models built before the trace format was selectable always trace to VCD
+            self.trace_format = "vcd"
+        self.mem_init_dirs = []
+        legacy_cwd = None
+        if not hasattr(self.lib, "set_mem_init_dirs") and mem_init_dirs:
+            # models linked without the fopen wrapper (e.g. on macOS) find memory initialization
+            # files relative to the working directory, so it is changed while the model is initialized
+            legacy_cwd = os.getcwd()
+            os.chdir(mem_init_dirs[0])
+        try:
+            construct = self.lib.construct
+            construct.argtypes = [ctypes.c_uint32]
+            construct.restype = ctypes.c_void_p
+            self.model = construct(threads)
+            # base address of the internal signals, see _signal_view()
+            if hasattr(self.lib, "signal_root"):
+                self._signal_root = self._function("signal_root", [ctypes.c_void_p], ctypes.c_void_p)(self.model)
+            else:
+                self._signal_root = self.model
+            if hasattr(self.lib, "set_mem_init_dirs"):
+                # the model is only evaluated after this, so $readmemh in initial blocks finds its files
+                self.set_mem_init_dirs(mem_init_dirs)
+            # get inputs, outputs, internal_signals, and json_data
+            self._read_embedded_data()
+            # constructor helpers
+            self._populate_signal_collections()
+            self._sim_init()
+        finally:
+            if legacy_cwd is not None:
+                os.chdir(legacy_cwd)
         # try to autodetect the clock
         self.clock = None
         # first look for an io with the name clock or clk (ignoring case)
@@ -636,7 +1801,28 @@ class PyVerilator:
                 if "clock" in sig_name or "clk" in sig_name:
                     self.clock = Clock(self.io[sig_name].signal)
                     break
-        os.chdir(old_cwd)
+
+    def set_mem_init_dirs(self, mem_init_dirs):
+        """Sets the directories in which memory initialization files with relative paths are searched for.
+
+        Files are looked up in the given order. The directories only apply to this model, an empty list
+        leaves only the working directory."""
+        self.mem_init_dirs = [os.path.abspath(d) for d in mem_init_dirs]
+        fn = self._function("set_mem_init_dirs", [ctypes.c_void_p, ctypes.POINTER(ctypes.c_char_p), ctypes.c_uint32])
+        dirs = (ctypes.c_char_p * max(len(self.mem_init_dirs), 1))(*[os.fsencode(d) for d in self.mem_init_dirs])
+        fn(self.model, dirs, len(self.mem_init_dirs))
+
+    def _function(self, name, argtypes, restype=ctypes.c_int):
+        """Returns the function name of the model library, with its argument and return types set.
+
+        Functions are resolved and typed once, so calling them later costs no more than the call itself."""
+        fn = self._functions.get(name)
+        if fn is None:
+            fn = getattr(self.lib, name)
+            fn.argtypes = argtypes
+            fn.restype = restype
+            self._functions[name] = fn
+        return fn
 
     def __del__(self):
         if self.model is not None:
@@ -677,6 +1863,21 @@ class PyVerilator:
         for i in range(num_internal_signals):
             self.internal_signals.append((internal_signal_names[i].decode("ascii"), internal_signal_widths[i]))
 
+        # internal arrays, as (name, element width, number of elements)
+        num_internal_arrays = ctypes.c_uint32.in_dll(self.lib, "_pyverilator_num_internal_arrays").value
+        internal_array_names = (ctypes.c_char_p * num_internal_arrays).in_dll(self.lib, "_pyverilator_internal_arrays")
+        internal_array_widths = (ctypes.c_uint32 * num_internal_arrays).in_dll(
+            self.lib, "_pyverilator_internal_array_widths"
+        )
+        internal_array_lengths = (ctypes.c_uint32 * num_internal_arrays).in_dll(
+            self.lib, "_pyverilator_internal_array_lengths"
+        )
+        self.internal_arrays = []
+        for i in range(num_internal_arrays):
+            self.internal_arrays.append(
+                (internal_array_names[i].decode("ascii"), internal_array_widths[i], internal_array_lengths[i])
+            )
+
         # json_data
         json_string = ctypes.c_char_p.in_dll(self.lib, "_pyverilator_json_data").value.decode("ascii")
         self.json_data = json.loads(json_string)
@@ -697,89 +1898,339 @@ class PyVerilator:
             sig = InternalSignal(self, sig_name, width)
             internals_dict[sig.modular_name] = sig
             all_signals[sig.modular_name] = sig
+        for sig_name, width, length in self.internal_arrays:
+            sig = InternalArray(self, sig_name, width, length)
+            internals_dict[sig.modular_name] = sig
+            all_signals[sig.modular_name] = sig
         self.io = Collection(io_dict)
         self.internals = Collection.build_nested_collection(internals_dict, Submodule)
         self.all_signals = all_signals
+        # plain int access to the same signals, see RawCollection
+        self.raw = RawCollection.from_collection(self.io)
+        self.raw_internals = RawCollection.from_collection(self.internals)
+        # index of the signals by verilator name and by modular name (e.g. "child.state"), with lowercase aliases
+        # for the names that are unique when case is ignored, see find_signal()
+        signal_index = {}
+        for sig in all_signals.values():
+            signal_index[sig.verilator_name] = sig
+            signal_index[".".join(sig.modular_name)] = sig
+        aliases = {}
+        ambiguous = set()
+        for name, sig in signal_index.items():
+            alias = name.lower()
+            if aliases.get(alias, sig) is not sig:
+                ambiguous.add(alias)
+            aliases[alias] = sig
+        for alias in ambiguous:
+            del aliases[alias]
+        aliases.update(signal_index)
+        self._signal_index = aliases
+        # position of each signal in the tables of the wrapper (inputs, outputs, then internal signals)
+        self._signal_numbers = {
+            name: number for number, (name, _) in enumerate(self.inputs + self.outputs + self.internal_signals)
+        }
+
+    def find_signal(self, signal_name):
+        """Returns the signal object with the given name, or None if the model has no such signal.
+
+        signal_name is the verilator name of a signal (e.g. "top__DOT__child__DOT__state"), its modular name
+        joined by dots (e.g. "child.state"), or either of these in a different case if that is unambiguous."""
+        sig = self._signal_index.get(signal_name)
+        if sig is None:
+            sig = self._signal_index.get(signal_name.lower())
+        return sig
 
     def _read(self, port_name):
-        port_width = None
-        for name, width in self.inputs + self.outputs + self.internal_signals:
-            if port_name == name:
-                port_width = width
-        if port_width is None:
+        sig = self.find_signal(port_name)
+        if sig is None:
             raise ValueError('cannot read port "%s" because it does not exist' % port_name)
-        if port_width > 64:
-            num_words = (port_width + 31) // 32
-            return self._read_words(port_name, num_words)
-        elif port_width > 32:
-            return self._read_64(port_name)
-        else:
-            return self._read_32(port_name)
+        return sig.value
 
     def _read_32(self, port_name):
-        fn = getattr(self.lib, "get_" + port_name)
-        fn.argtypes = [ctypes.c_void_p]
-        fn.restype = ctypes.c_uint32
-        return int(fn(self.model))
+        return self._function("get_" + port_name, [ctypes.c_void_p], ctypes.c_uint32)(self.model)
 
     def _read_64(self, port_name):
-        fn = getattr(self.lib, "get_" + port_name)
-        fn.argtypes = [ctypes.c_void_p]
-        fn.restype = ctypes.c_uint64
-        return int(fn(self.model))
+        return self._function("get_" + port_name, [ctypes.c_void_p], ctypes.c_uint64)(self.model)
 
     def _read_words(self, port_name, num_words):
-        fn = getattr(self.lib, "get_" + port_name)
-        fn.argtypes = [ctypes.c_void_p, ctypes.c_uint32]
-        fn.restype = ctypes.c_uint32
-        words = [0] * num_words
-        for i in range(num_words):
-            words[i] = int(fn(self.model, i))
+        fn = self._function("get_" + port_name, [ctypes.c_void_p, ctypes.c_int], ctypes.c_uint32)
         out = 0
         for i in range(num_words):
-            out |= words[i] << (i * 32)
+            out |= fn(self.model, i) << (i * 32)
         return out
 
+    def _read_element(self, array_name, index, width):
+        if self._dirty:
+            self.eval()
+        if width > 64:
+            fn = self._function("get_" + array_name, [ctypes.c_void_p, ctypes.c_uint32, ctypes.c_int], ctypes.c_uint32)
+            out = 0
+            for i in range((width + 31) // 32):
+                out |= fn(self.model, index, i) << (i * 32)
+            return out
+        restype = ctypes.c_uint64 if width > 32 else ctypes.c_uint32
+        return self._function("get_" + array_name, [ctypes.c_void_p, ctypes.c_uint32], restype)(self.model, index)
+
+    def _write_element(self, array_name, index, width, value):
+        # verilator expects the unused upper bits of an element to be 0
+        value &= (1 << width) - 1
+        if width > 64:
+            fn = self._function("set_" + array_name, [ctypes.c_void_p, ctypes.c_uint32, ctypes.c_int, ctypes.c_uint64])
+            for i in range((width + 31) // 32):
+                fn(self.model, index, i, (value >> (i * 32)) & 0xFFFFFFFF)
+        else:
+            value_type = ctypes.c_uint64 if width > 32 else ctypes.c_uint32
+            self._function("set_" + array_name, [ctypes.c_void_p, ctypes.c_uint32, value_type])(self.model, index, value)
+
     def _write(self, port_name, value):
-        port_width = None
-        for name, width in self.inputs:
-            if port_name == name:
-                port_width = width
-        if port_width is None:
+        sig = self.find_signal(port_name)
+        if not isinstance(sig, Input):
             raise ValueError('cannot write port "%s" because it does not exist (or it is an output)' % port_name)
-        if port_width > 64:
-            num_words = (port_width + 31) // 32
-            self._write_words(port_name, num_words, value)
-        elif port_width > 32:
-            self._write_64(port_name, value)
-        else:
-            self._write_32(port_name, value)
+        sig.write(value)
 
     def _write_32(self, port_name, value):
-        fn = getattr(self.lib, "set_" + port_name)
-        fn.argtypes = [ctypes.c_void_p, ctypes.c_uint32]
-        fn(self.model, ctypes.c_uint32(value))
-        self._post_write_hook(port_name, value)
+        self._write_scalar(self._function("set_" + port_name, [ctypes.c_void_p, ctypes.c_uint32]), port_name, value)
 
     def _write_64(self, port_name, value):
-        fn = getattr(self.lib, "set_" + port_name)
-        fn.argtypes = [ctypes.c_void_p, ctypes.c_uint64]
-        fn(self.model, ctypes.c_uint64(value))
+        self._write_scalar(self._function("set_" + port_name, [ctypes.c_void_p, ctypes.c_uint64]), port_name, value)
+
+    def _write_scalar(self, fn, port_name, value):
+        # fn is the set_ function of port_name, typed by _function(); ctypes truncates value to the port type
+        if port_name in self._dirty_inputs:
+            self.eval()
+        fn(self.model, value)
+        self._post_write_hook(port_name, value)
+
+    def _words_view(self, signal_name, width):
+        # returns a ctypes array of the words of a signal wider than 64 bits in the memory of the model, or None
+        # for models built before the words_ functions were added
+        try:
+            words_function = self._function("words_" + signal_name, [ctypes.c_void_p], ctypes.c_void_p)
+        except AttributeError:
+            return None
+        return (ctypes.c_uint32 * ((width + 31) // 32)).from_address(words_function(self.model))
+
+    def _signal_view(self, signal_name, width):
+        # returns a ctypes scalar of a signal of up to 64 bits in the memory of the model, at the byte offset
+        # exported by signal_offsets(), or None for models built before signal_offsets() was added. Offsets of
+        # internal signals are relative to signal_root(), which models built before it was added do not export:
+        # their offsets are all relative to the model
+        if self._signal_addresses is None:
+            self._signal_addresses = {}
+            try:
+                fn = self._function("signal_offsets", [ctypes.c_void_p, ctypes.POINTER(ctypes.c_int64)])
+            except AttributeError:
+                fn = None
+            if fn is not None:
+                ports = self.inputs + self.outputs
+                signals = ports + self.internal_signals
+                offsets = (ctypes.c_int64 * max(len(signals), 1))()
+                fn(self.model, offsets)
+                self._signal_addresses = {
+                    name: (self.model if i < len(ports) else self._signal_root) + offsets[i]
+                    for i, (name, _) in enumerate(signals)
+                }
+        address = self._signal_addresses.get(signal_name)
+        if address is None:
+            return None
+        return signal_ctype(width).from_address(address)
+
+    def _write_view(self, view, port_name, mask, value):
+        # in lazy mode, an input written again is evaluated with its previous value first, see _post_write_hook()
+        if port_name in self._dirty_inputs:
+            self.eval()
+        value &= mask
+        view.value = value
+        self._post_write_hook(port_name, value)
+
+    def _write_wide(self, words, port_name, width, value):
+        if port_name in self._dirty_inputs:
+            self.eval()
+        value &= (1 << width) - 1
+        ctypes.memmove(words, int_to_words_bytes(value, len(words)), len(words) * 4)
         self._post_write_hook(port_name, value)
 
     def _write_words(self, port_name, num_words, value):
-        fn = getattr(self.lib, "set_" + port_name)
-        fn.argtypes = [ctypes.c_void_p, ctypes.c_uint64, ctypes.c_uint32]
+        if port_name in self._dirty_inputs:
+            self.eval()
+        fn = self._function("set_" + port_name, [ctypes.c_void_p, ctypes.c_int, ctypes.c_uint64])
         for i in range(num_words):
-            word = ctypes.c_uint32(value >> (i * 32))
-            fn(self.model, i, word)
+            fn(self.model, i, (value >> (i * 32)) & 0xFFFFFFFF)
         self._post_write_hook(port_name, value)
 
     def _post_write_hook(self, port_name, value):
-        if self.auto_eval:
+        if self._eval_deferred:
+            self._deferred_inputs.add(port_name)
+            return
+        if self.auto_eval == "lazy":
+            # the model is evaluated when it is read next. Inputs are remembered, because writing one of them again
+            # before that would hide its current value from the model, e.g. the rising edge in clock.tick()
+            self._dirty = True
+            self._dirty_inputs.add(port_name)
+        elif self.auto_eval:
             self.eval()
-        if self.auto_tracing_mode == "clock" and port_name == self.clock.verilator_name:
-            self.add_to_vcd_trace()
+        if (
+            (self.auto_tracing_mode == "clock" or self._recorders)
+            and self.clock is not None
+            and port_name == self.clock.verilator_name
+        ):
+            self._clock_written(value)
+
+    def _clock_written(self, value):
+        # traces the change of the clock and records a sample after its rising edge
+        rising_edge = value == 1 if value is not None else self.clock.value == 1
+        if self.auto_tracing_mode == "clock":
+            self._auto_trace(rising_edge)
+        if self._recorders and rising_edge:
+            if self.auto_eval is False:
+                # the model has not seen the edge yet: sample after the next eval(), like run() does
+                self._sample_pending = True
+            else:
+                self._record_samples()
+
+    @contextlib.contextmanager
+    def deferred_eval(self):
+        """Context manager that evaluates the model once when the block exits instead of after every write.
+
+            with sim.deferred_eval():
+                sim.io.awaddr = 0x40
+                sim.io.awvalid = 1
+                sim.io.wdata = 5
+
+        Outputs read inside the block may not reflect the inputs written in it yet. Blocks can be nested, the
+        model is evaluated when the outermost one exits (only if auto_eval is enabled and an input was written,
+        with auto_eval="lazy" it is only marked dirty).
+        """
+        self._eval_deferred += 1
+        try:
+            yield self
+        finally:
+            self._eval_deferred -= 1
+            if not self._eval_deferred and self._deferred_inputs:
+                written = self._deferred_inputs
+                self._deferred_inputs = set()
+                clock_written = self.clock is not None and self.clock.verilator_name in written
+                if self.auto_eval == "lazy":
+                    # as for single writes, an input written again before the next read is evaluated first
+                    self._dirty = True
+                    self._dirty_inputs.update(written)
+                elif self.auto_eval:
+                    self.eval()
+                if clock_written and (self.auto_tracing_mode == "clock" or self._recorders):
+                    self._clock_written(None)
+
+    def write_many(self, values):
+        """Writes several inputs with a single call into the model, followed by a single eval().
+
+        values maps input names to ints, e.g. sim.write_many({'awaddr': 0x40, 'awvalid': 1}). Inputs are named as in
+        sim.io, or by any other name find_signal() accepts. Evaluation follows the same rules as single writes: it
+        only happens if auto_eval is enabled, and is postponed until the end of a deferred_eval() block."""
+        if not values:
+            return
+        if self._input_layout is None:
+            layout = {}
+            num_words = 0
+            for index, (name, width) in enumerate(self.inputs):
+                layout[name] = (index, width, num_words)
+                num_words += (width + 31) // 32
+            buffer = (ctypes.c_uint32 * max(num_words, 1))()
+            mask = (ctypes.c_uint8 * max(len(self.inputs), 1))()
+            self._input_layout = (layout, buffer, mask)
+        layout, buffer, mask = self._input_layout
+        port_values = {}
+        for name, value in values.items():
+            sig = self.find_signal(name)
+            if not isinstance(sig, Input):
+                raise ValueError('cannot write port "%s" because it does not exist (or it is an output)' % name)
+            port_values[sig.verilator_name] = value
+        values = port_values
+        if not self._dirty_inputs.isdisjoint(values):
+            self.eval()
+        ctypes.memset(mask, 0, ctypes.sizeof(mask))
+        for name, value in values.items():
+            index, width, offset = layout[name]
+            value &= (1 << width) - 1
+            for i in range((width + 31) // 32):
+                buffer[offset + i] = (value >> (i * 32)) & 0xFFFFFFFF
+            mask[index] = 1
+        write_inputs = self._function("write_inputs", [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p])
+        write_inputs(self.model, buffer, mask)
+        clock_name = self.clock.verilator_name if self.clock is not None else None
+        # a single hook for all inputs, reporting the clock if it was written so the trace is updated
+        self._post_write_hook(clock_name if clock_name in values else next(iter(values)), None)
+        if self._eval_deferred:
+            self._deferred_inputs.update(values)
+        elif self._dirty:
+            self._dirty_inputs.update(values)
+
+    def _snapshot_layout(self, internals):
+        layout = self._snapshot_layouts.get(internals)
+        if layout is None:
+            signals = self.inputs + self.outputs
+            if internals:
+                signals = signals + self.internal_signals
+            offsets = []
+            num_words = 0
+            for name, width in signals:
+                # the names users see in sim.io and sim.internals, e.g. "a.b" for the escaped identifier \a.b
+                offsets.append((".".join(verilator_name_to_standard_modular_name(name)), width, num_words))
+                num_words += (width + 31) // 32
+            buffer = (ctypes.c_uint32 * max(num_words, 1))()
+            layout = (offsets, num_words, buffer)
+            self._snapshot_layouts[internals] = layout
+        return layout
+
+    def snapshot_dtype(self, internals=False):
+        """Returns the NumPy structured dtype of the arrays returned by snapshot(as_numpy=True).
+
+        It has one field per signal: uint32 for signals up to 32 bits, uint64 for signals up to 64 bits, and
+        a subarray of uint32 words, least significant first, for wider signals."""
+        dtype = self._snapshot_dtypes.get(internals)
+        if dtype is None:
+            offsets, num_words, _ = self._snapshot_layout(internals)
+            dtype = words_dtype(offsets, num_words)
+            self._snapshot_dtypes[internals] = dtype
+        return dtype
+
+    def snapshot(self, internals=False, as_numpy=False, out=None):
+        """Reads the values of all ports, and of all internal signals if internals is True, with one call into
+        the model.
+
+        Returns a dict mapping signal names to ints. Ports are named as in sim.io, with escaped identifiers
+        decoded (e.g. 'a.b' for \\a.b), and internal signals by their dotted path in sim.internals, e.g.
+        'child.state'. If as_numpy is True, a NumPy structured array of shape () with the dtype
+        snapshot_dtype(internals) is returned instead. out can be such an array of size 1 (e.g. a slice
+        records[i:i + 1] of a preallocated array), which is then filled in place and returned, so a monitor
+        can record every cycle without any allocation.
+        """
+        offsets, num_words, buffer = self._snapshot_layout(internals)
+        if self._dirty:
+            self.eval()
+        snapshot = self._function("snapshot", [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int])
+        if out is not None:
+            if out.dtype != self.snapshot_dtype(internals) or out.size != 1 or not out.flags.c_contiguous:
+                raise ValueError("out must be a contiguous array of one element with the dtype snapshot_dtype()")
+            if not out.flags.writeable:
+                raise ValueError("out must be writeable")
+            snapshot(self.model, out.ctypes.data, int(internals))
+            return out
+        snapshot(self.model, buffer, int(internals))
+        if as_numpy:
+            import numpy as np
+
+            return np.frombuffer(buffer, dtype=self.snapshot_dtype(internals), count=1).reshape(()).copy()
+        values = {}
+        for name, width, offset in offsets:
+            if width > 64:
+                value = 0
+                for i in range((width + 31) // 32):
+                    value |= buffer[offset + i] << (i * 32)
+                values[name] = value
+            elif width > 32:
+                values[name] = buffer[offset] | (buffer[offset + 1] << 32)
+            else:
+                values[name] = buffer[offset]
+        return values
 
     def _sim_init(self):
         # initialize all the inputs to 0
@@ -794,26 +2245,360 @@ class PyVerilator:
         self._write(signal_name, value)
 
     def __contains__(self, signal_name):
-        for name, _ in self.inputs + self.outputs + self.internal_signals:
-            if name == signal_name:
-                return True
-        return False
+        return self.find_signal(signal_name) is not None
 
     def eval(self):
-        fn = self.lib.eval
-        fn.argtypes = [ctypes.c_void_p]
-        fn(self.model)
+        if self._dirty:
+            self._dirty = False
+            self._dirty_inputs.clear()
+        self._eval(self.model)
         if self.auto_tracing_mode == "eval":
-            self.add_to_vcd_trace()
+            self._auto_trace(True)
+        if self._recorders and (self.clock is None or self._sample_pending):
+            self._sample_pending = False
+            self._record_samples()
+
+    def record(self, signals=None, capacity=1024):
+        """Starts recording the values of signals (names or Signal objects, by default all ports and internal
+        signals) in every clock cycle into NumPy arrays in memory, and returns the Recorder that holds them.
+
+        The samples are taken by the model library, so recording many signals costs about as much as one
+        snapshot() per cycle, and nothing is written to a file. capacity is the number of samples the buffer of
+        the recorder initially has room for. Recording stops when Recorder.stop() is called or, if it is used as
+        a context manager, at the end of the with block."""
+        return self._add_recorder(Recorder(self, signals, capacity))
+
+    def flight_recorder(self, filename, cycles=1000, signals=None):
+        """Starts recording the last cycles clock cycles of signals (by default the ports, pass the names of
+        internal signals to record them too) in a ring buffer in memory, and returns the Recorder, which writes
+        them to the VCD file filename only when it is asked to, with Recorder.dump(). Used as a context manager,
+        it does so when the with block raises an exception (e.g. a failed assertion or a timeout), so the waveform
+        of a failure is always available while passing runs only pay for the samples:
+
+            with sim.flight_recorder("failure.vcd"):
+                sim.run(1000000)
+                assert sim.io.error == 0
+        """
+        if signals is None:
+            # sampling every internal signal costs several times as much as simulating a cycle of a large design
+            signals = [name for name, _ in self.inputs + self.outputs]
+        return self._add_recorder(Recorder(self, signals, cycles, ring=True, filename=filename))
+
+    def _add_recorder(self, recorder):
+        self._recorders.append(recorder)
+        self._link_recorders()
+        return recorder
+
+    def _link_recorders(self):
+        # the model library records the samples of all recorders in one call, following the next links
+        for recorder, next_recorder in zip(self._recorders, self._recorders[1:] + [None]):
+            recorder._state.next = ctypes.addressof(next_recorder._state) if next_recorder is not None else None
+
+    def _record_samples(self):
+        if self._dirty:
+            self.eval()
+        for recorder in self._recorders:
+            recorder._reserve(1)
+        record = self._function("record", [ctypes.c_void_p, ctypes.c_void_p])
+        record(self.model, ctypes.byref(self._recorders[0]._state))
+
+    def _native_recorder(self, cycles):
+        # returns the state of the active recorders for a call of a native loop, and how many of cycles cycles that
+        # call can run before a buffer is full. The loops are called again for the remaining cycles.
+        if not self._recorders:
+            return None, cycles
+        for recorder in self._recorders:
+            cycles = recorder._room(cycles)
+        return ctypes.byref(self._recorders[0]._state), cycles
+
+    def _clock_input(self, clock, caller):
+        # resolves the clock argument of run() and run_vectors()
+        if clock is None:
+            clock = self.clock
+        elif not isinstance(clock, Signal):
+            clock = self.find_signal(clock)
+        if not isinstance(clock, Input) or clock.width != 1:
+            raise ValueError("%s() requires a 1-bit input as clock, got %r" % (caller, clock))
+        return clock
+
+    def run(self, cycles, clock=None, until=None, value=1, mask=None):
+        """Ticks clock for up to cycles cycles in a native loop and returns the number of cycles run.
+
+        Each cycle does the same as clock.tick() with auto_eval enabled: the clock is set to 0 and then to 1, the
+        model is evaluated after each change and, if automatic VCD tracing is active, dumped to the trace, and the
+        active recorder (see record()) takes its samples. This happens inside the model library without returning
+        to python, and regardless of auto_eval.
+
+        clock is a 1-bit input, given by name or as a signal, and defaults to the detected clock. If until names
+        a signal (of up to 64 bits), the loop stops after the first cycle in which (until & mask) == value, e.g.
+        sim.run(1000, until="done") waits for at most 1000 cycles for done to become 1."""
+        clock = self._clock_input(clock, "run")
+        if not 0 <= cycles < 1 << 64:
+            raise ValueError("run() requires a number of cycles in [0, 2**64), got %r" % (cycles,))
+        stop_signal = None
+        if until is not None:
+            stop_signal = until if isinstance(until, Signal) else self.find_signal(until)
+            if stop_signal is None or isinstance(stop_signal, InternalArray) or stop_signal.width > 64:
+                raise ValueError("run() can only stop on a signal of up to 64 bits, got %r" % (until,))
+        if mask is None:
+            mask = (1 << 64) - 1
+        if self._dirty:
+            self.eval()
+        try:
+            run = self._function(
+                "run",
+                [
+                    ctypes.c_void_p,
+                    ctypes.c_void_p,
+                    ctypes.c_void_p,
+                    ctypes.POINTER(ctypes.c_uint64),
+                    ctypes.c_int,
+                    ctypes.c_uint64,
+                    ctypes.c_int,
+                    ctypes.c_uint64,
+                    ctypes.c_uint64,
+                ],
+                ctypes.c_uint64,
+            )
+        except AttributeError:
+            run = None
+        if run is None:
+            # models built before run() was added are ticked from python
+            for cycle in range(cycles):
+                for level in (0, 1):
+                    clock.write(level)
+                    if self._dirty or not self.auto_eval:
+                        self.eval()
+                if stop_signal is not None and stop_signal.value & mask == value & mask:
+                    return cycle + 1
+            return cycles
+        vcd_time = ctypes.c_uint64(self.curr_time)
+        dumps = self._tracer.dumps if self.auto_tracing_mode is not None else 0
+        cycles_run = 0
+        while cycles_run < cycles:
+            recorder, chunk = self._native_recorder(cycles - cycles_run)
+            chunk_run = run(
+                self.model,
+                ctypes.byref(self._tracer) if self.auto_tracing_mode is not None else None,
+                recorder,
+                ctypes.byref(vcd_time),
+                self._signal_numbers[clock.verilator_name],
+                chunk,
+                self._signal_numbers[stop_signal.verilator_name] if stop_signal is not None else -1,
+                mask,
+                value & mask,
+            )
+            cycles_run += chunk_run
+            if chunk_run < chunk:
+                break
+        self.curr_time = vcd_time.value
+        if self.auto_tracing_mode is not None:
+            self._vcd_dumped(self._tracer.dumps - dumps)
+        return cycles_run
+
+    def run_vectors(self, inputs, outputs, clock=None, cycles=None):
+        """Applies a sequence of per-cycle input values and samples signals after every cycle in a native loop.
 
-    def start_vcd_trace(self, filename, auto_tracing=True):
+        inputs maps input names to NumPy arrays (or sequences) with one value per cycle; inputs wider than 64 bits
+        take arrays of shape (cycles, words) of uint32 words, least significant first. In every cycle the inputs
+        are written, the clock is ticked like in run() and then the signals named in outputs are sampled.
+
+        Returns a dict mapping the names in outputs to NumPy arrays with one value per cycle, of the types of
+        snapshot_dtype(): uint32 up to 32 bits, uint64 up to 64 bits, and (cycles, words) uint32 arrays above.
+        E.g. for a registered adder:
+
+            result = sim.run_vectors({'a': np.arange(1000), 'b': np.full(1000, 2)}, ['sum'])
+            assert (result['sum'] == np.arange(1000) + 2).all()
+
+        cycles is the number of cycles, which is otherwise the length of the input arrays. It is required if
+        inputs is empty, e.g. to only sample outputs, and must match the length of the input arrays otherwise.
+        """
+        import numpy as np
+
+        clock = self._clock_input(clock, "run_vectors")
+        input_signals = []
+        input_values = []
+        for name, values in inputs.items():
+            sig = self.find_signal(name)
+            if not isinstance(sig, Input):
+                raise ValueError('cannot write port "%s" because it does not exist (or it is an output)' % name)
+            if sig.verilator_name == clock.verilator_name:
+                raise ValueError("the clock %s can not be driven by run_vectors()" % name)
+            input_signals.append(sig)
+            input_values.append(np.asarray(values))
+        output_signals = []
+        for name in outputs:
+            sig = self.find_signal(name)
+            if sig is None or isinstance(sig, InternalArray):
+                raise ValueError('cannot sample "%s" because it is not a signal' % name)
+            output_signals.append(sig)
+        if cycles is None:
+            if not input_values:
+                raise ValueError("run_vectors() requires cycles if there are no inputs to drive")
+            cycles = len(input_values[0])
+        if any(len(values) != cycles for values in input_values):
+            raise ValueError("all input arrays must have one value per cycle")
+
+        # rows of the input and output buffers, one per cycle, in the layout of snapshot()
+        input_layout = []
+        input_words = 0
+        for sig in input_signals:
+            input_layout.append((sig.verilator_name, sig.width, input_words))
+            input_words += (sig.width + 31) // 32
+        output_layout = []
+        output_words = 0
+        for name, sig in zip(outputs, output_signals):
+            output_layout.append((name, sig.width, output_words))
+            output_words += (sig.width + 31) // 32
+        input_buffer = np.zeros((cycles, max(input_words, 1)), dtype=np.uint32)
+        for (_, width, offset), values in zip(input_layout, input_values):
+            num_words = (width + 31) // 32
+            if width > 64:
+                if values.shape != (cycles, num_words):
+                    raise ValueError("inputs wider than 64 bits require arrays of shape (cycles, %d)" % num_words)
+                input_buffer[:, offset : offset + num_words] = values
+                input_buffer[:, offset + num_words - 1] &= (1 << (width - 32 * (num_words - 1))) - 1
+            else:
+                # verilator expects the unused upper bits of an input to be 0
+                values = values.astype(np.uint64) & np.uint64((1 << width) - 1)
+                input_buffer[:, offset] = values & np.uint64(0xFFFFFFFF)
+                if width > 32:
+                    input_buffer[:, offset + 1] = values >> np.uint64(32)
+        output_dtype = words_dtype(output_layout, max(output_words, 1))
+        output_buffer = np.zeros(cycles, dtype=output_dtype)
+
+        if self._dirty:
+            self.eval()
+        run_vectors = self._function(
+            "run_vectors",
+            [
+                ctypes.c_void_p,
+                ctypes.c_void_p,
+                ctypes.c_void_p,
+                ctypes.POINTER(ctypes.c_uint64),
+                ctypes.c_int,
+                ctypes.c_uint64,
+                ctypes.c_void_p,
+                ctypes.c_int,
+                ctypes.c_void_p,
+                ctypes.c_void_p,
+                ctypes.c_int,
+                ctypes.c_void_p,
+            ],
+            ctypes.c_uint64,
+        )
+        input_numbers = np.array([self._signal_numbers[sig.verilator_name] for sig in input_signals] or [0], np.intc)
+        output_numbers = np.array([self._signal_numbers[sig.verilator_name] for sig in output_signals] or [0], np.intc)
+        vcd_time = ctypes.c_uint64(self.curr_time)
+        dumps = self._tracer.dumps if self.auto_tracing_mode is not None else 0
+        cycles_run = 0
+        while cycles_run < cycles:
+            recorder, chunk = self._native_recorder(cycles - cycles_run)
+            run_vectors(
+                self.model,
+                ctypes.byref(self._tracer) if self.auto_tracing_mode is not None else None,
+                recorder,
+                ctypes.byref(vcd_time),
+                self._signal_numbers[clock.verilator_name],
+                chunk,
+                input_numbers.ctypes.data,
+                len(input_signals),
+                input_buffer[cycles_run:].ctypes.data,
+                output_numbers.ctypes.data,
+                len(output_signals),
+                output_buffer[cycles_run:].ctypes.data,
+            )
+            cycles_run += chunk
+        self.curr_time = vcd_time.value
+        if self.auto_tracing_mode is not None:
+            self._vcd_dumped(self._tracer.dumps - dumps)
+        return {name: np.ascontiguousarray(output_buffer[name]) for name in outputs}
+
+    def start_vcd_trace(self, filename, *args, **kwargs):
+        """Starts writing a VCD trace of the model to filename, with the options of start_trace().
+
+        Models built with trace_format="fst" can only write FST traces, with start_trace()."""
+        if self.trace_format != "vcd":
+            raise ValueError('start_vcd_trace() requires a model built with trace_format="vcd", use start_trace()')
+        self.start_trace(filename, *args, **kwargs)
+
+    def start_trace(
+        self,
+        filename,
+        auto_tracing=True,
+        flush_every=_FLUSH_EVERY_DEFAULT,
+        flush_interval=None,
+        scopes=None,
+        start_cycle=0,
+        stop_cycle=None,
+        trigger=None,
+        trigger_value=1,
+        trigger_mask=None,
+    ):
+        """Starts writing a trace of the model to filename, in the format it was built for (see trace_format).
+
+        The trace is written and stopped with the same methods for both formats: add_to_vcd_trace(),
+        flush_vcd_trace() and stop_vcd_trace().
+
+        With auto_tracing, the model is dumped to the trace after every change of the clock (or after every eval()
+        if there is no clock). Dumps are buffered, and the flush policy decides when the buffer is written to the
+        file (and GTKWave reloads it): after every flush_every dumps, and when at least flush_interval seconds
+        passed since the last flush. By default, the trace is flushed after every dump, which keeps the file and
+        GTKWave up to date at the cost of a write per dump, or only by time if a flush_interval is given. With
+        flush_every=None and no flush_interval, the trace is only flushed when flush_vcd_trace() is called and
+        when it is stopped.
+
+        scopes limits the trace to some parts of the design, like $dumpvars: a list of hierarchical names of
+        scopes or signals as they appear in the trace, e.g. "TOP.counter.adder" (the leading "TOP." can be left
+        out), each either traced with everything below it or given as a (name, levels) tuple, where levels=1
+        only traces the signals of the scope itself. By default the whole design is traced, up to the
+        trace_depth the model was built with.
+
+        Automatic tracing can be limited to a window of clock cycles (or evaluations, without a clock), which
+        keeps long runs fast until the part of interest: only the cycles start_cycle <= cycle < stop_cycle are
+        dumped, counted from the start of the trace. With a trigger signal (of up to 64 bits), cycles are counted
+        from the first change of the clock after which (trigger & trigger_mask) == trigger_value instead, e.g.
+        trigger="error" traces from the cycle in which error first becomes 1. The time of the trace keeps
+        advancing outside of the window, so its timestamps still tell the cycle of the run."""
         if self.vcd_trace is not None:
-            raise ValueError("start_vcd_trace() called while VCD tracing is already active")
-        start_vcd_trace = self.lib.start_vcd_trace
-        start_vcd_trace.restype = ctypes.c_void_p
-        start_vcd_trace.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
-        self.vcd_trace = start_vcd_trace(self.model, ctypes.c_char_p(filename.encode("ascii")))
+            raise ValueError("start_trace() called while tracing is already active")
+        trigger_signal = None
+        if trigger is not None:
+            trigger_signal = trigger if isinstance(trigger, Signal) else self.find_signal(trigger)
+            if trigger_signal is None or isinstance(trigger_signal, InternalArray) or trigger_signal.width > 64:
+                raise ValueError("start_trace() can only trigger on a signal of up to 64 bits, got %r" % (trigger,))
+        if trigger_mask is None:
+            trigger_mask = (1 << 64) - 1
+        scope_names = []
+        scope_levels = []
+        for scope in scopes or []:
+            name, levels = (scope, 99) if isinstance(scope, str) else scope
+            scope_names.append(name if name == "TOP" or name.startswith("TOP.") else "TOP." + name)
+            scope_levels.append(levels)
+        start_vcd_trace = self._function(
+            "start_vcd_trace",
+            [ctypes.c_void_p, ctypes.c_char_p, ctypes.POINTER(ctypes.c_char_p), ctypes.POINTER(ctypes.c_int), ctypes.c_int],
+            ctypes.c_void_p,
+        )
+        self.vcd_trace = start_vcd_trace(
+            self.model,
+            ctypes.c_char_p(filename.encode("ascii")),
+            (ctypes.c_char_p * len(scope_names))(*[name.encode("ascii") for name in scope_names]),
+            (ctypes.c_int * len(scope_levels))(*scope_levels),
+            len(scope_names),
+        )
+        if self.vcd_trace is None:
+            raise ValueError("the verilator version of this model can not select the scopes of a trace")
         self.vcd_filename = filename
+        self._tracer = Tracer(
+            tfp=self.vcd_trace,
+            start_cycle=start_cycle,
+            stop_cycle=stop_cycle if stop_cycle is not None else (1 << 64) - 1,
+            trigger=self._signal_numbers[trigger_signal.verilator_name] if trigger_signal is not None else -1,
+            trigger_mask=trigger_mask,
+            trigger_value=trigger_value & trigger_mask,
+        )
+        self._trigger_signal = trigger_signal
 
         if not auto_tracing:
             self.auto_tracing_mode = None
@@ -821,42 +2606,74 @@ class PyVerilator:
             self.auto_tracing_mode = "clock"
         else:
             self.auto_tracing_mode = "eval"
+        if flush_every is _FLUSH_EVERY_DEFAULT:
+            flush_every = 1 if flush_interval is None else None
+        self.vcd_flush_every = flush_every
+        self.vcd_flush_interval = flush_interval
+        self._vcd_dumps_since_flush = 0
+        self._vcd_last_flush = time.monotonic()
         self.curr_time = 0
         # initial vcd data
-        self.add_to_vcd_trace()
+        if self.auto_tracing_mode is not None:
+            self._auto_trace(False)
+        else:
+            self.add_to_vcd_trace()
+
+    def _auto_trace(self, cycle_done):
+        # traces a change of the clock (or an evaluation) if it is in the window of start_trace(), like the native
+        # loops of run() and run_vectors() do. cycle_done is True when the change ends a clock cycle.
+        tracer = self._tracer
+        if tracer.trigger >= 0:
+            if self._trigger_signal.value & tracer.trigger_mask != tracer.trigger_value:
+                self.curr_time += 10
+                return
+            tracer.trigger = -1
+        if tracer.start_cycle <= tracer.cycle < tracer.stop_cycle:
+            self.add_to_vcd_trace()
+        else:
+            self.curr_time += 10
+        if cycle_done and tracer.trigger < 0:
+            tracer.cycle += 1
 
     def add_to_vcd_trace(self):
         if self.vcd_trace is None:
             raise ValueError("add_to_vcd_trace() requires VCD tracing to be active")
-        add_to_vcd_trace = self.lib.add_to_vcd_trace
-        add_to_vcd_trace.argtypes = [ctypes.c_void_p, ctypes.c_int32]
-        add_to_vcd_trace.restype = ctypes.c_int32
+        if self._dirty:
+            self.eval()
+        add_to_vcd_trace = self._function("add_to_vcd_trace", [ctypes.c_void_p, ctypes.c_uint64], ctypes.c_int32)
         # do two steps so the most recent value in GTKWave is more obvious
         self.curr_time += 5
         add_to_vcd_trace(self.vcd_trace, self.curr_time)
         self.curr_time += 5
         add_to_vcd_trace(self.vcd_trace, self.curr_time)
-        # go ahead and flush on each vcd update
-        self.flush_vcd_trace()
+        self._vcd_dumped(1)
+
+    def _vcd_dumped(self, dumps):
+        # applies the flush policy of start_vcd_trace() after dumps were added to the trace
+        self._vcd_dumps_since_flush += dumps
+        if (self.vcd_flush_every and self._vcd_dumps_since_flush >= self.vcd_flush_every) or (
+            self.vcd_flush_interval is not None and time.monotonic() - self._vcd_last_flush >= self.vcd_flush_interval
+        ):
+            self.flush_vcd_trace()
 
     def flush_vcd_trace(self):
         if self.vcd_trace is None:
             raise ValueError("flush_vcd_trace() requires VCD tracing to be active")
-        flush_vcd_trace = self.lib.flush_vcd_trace
-        flush_vcd_trace.restype = ctypes.c_int32
-        flush_vcd_trace.argtypes = [ctypes.c_void_p]
+        flush_vcd_trace = self._function("flush_vcd_trace", [ctypes.c_void_p], ctypes.c_int32)
         flush_vcd_trace(self.vcd_trace)
+        self._vcd_dumps_since_flush = 0
+        self._vcd_last_flush = time.monotonic()
         if self.gtkwave_active:
             self.reload_dump_file()
 
     def stop_vcd_trace(self):
         if self.vcd_trace is None:
             raise ValueError("stop_vcd_trace() requires VCD tracing to be active")
-        stop_vcd_trace = self.lib.stop_vcd_trace
-        stop_vcd_trace.restype = ctypes.c_int32
-        stop_vcd_trace.argtypes = [ctypes.c_void_p]
+        stop_vcd_trace = self._function("stop_vcd_trace", [ctypes.c_void_p], ctypes.c_int32)
         stop_vcd_trace(self.vcd_trace)
         self.vcd_trace = None
+        self._tracer = None
+        self._trigger_signal = None
         self.auto_tracing_mode = None
         self.vcd_filename = None
 
@@ -26,17 +26,25 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+from concurrent.futures import ThreadPoolExecutor
+import gc
+import os
+
 import pkg_resources as pk
 
 import numpy as np
+import pytest
 
 from pyverilator import PyVerilator
 from pyverilator.util.axi_utils import (
+    _axi_mem_models,
     axilite_expected_signals,
     axilite_read,
     axilite_write,
     aximm_expected_signals,
+    build_axi_mem,
     create_axi_mem_hook,
+    parse_readmemh,
     reset_rtlsim,
     rtlsim_multi_io,
 )
@@ -90,7 +98,7 @@ def test_pyverilator_axilite():
     assert val_ret == val_a + val_b
 
 
-def test_pyverilator_aximm():
+def test_pyverilator_aximm(tmp_path):
     example_root = pk.resource_filename("pyverilator.data", "verilog/lookup")
     # load example verilog: takes two 32-bit integers as AXI lite mem mapped
     # registers, adds them together and return result
@@ -159,3 +167,57 @@ def test_pyverilator_aximm():
         golden = [int(x, base=16) for x in mem_data_hex[inp][: lookup_width // memif_width]]
         produced = outputs[inp_num]
         assert all(golden == produced)
+
+    def failing_hook(sim):
+        raise ValueError("hook failed")
+
+    # the trace is written and stopped even if the simulation raises
+    trace_file = str(tmp_path / "failing.vcd")
+    with pytest.raises(ValueError):
+        rtlsim_multi_io(sim, io_dict, 1, trace_file=trace_file, sname="_V_", hook_preclk=failing_hook)
+    assert sim.vcd_trace is None
+    with open(trace_file) as f:
+        assert "$enddefinitions" in f.read()
+
+
+def test_pyverilator_axi_mem_cache(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    mem_init_file = str(tmp_path / "mem_init.dat")
+    with open(mem_init_file, "w") as f:
+        f.write("// first word\n0a\n@3 ff_ee /* skips 1 and 2 */\n")
+    mem_data = parse_readmemh(mem_init_file)
+    assert mem_data == {0: 0x0A, 3: 0xFFEE}
+    # start without the models built by other tests
+    _axi_mem_models.clear()
+    # without a cache, the model is compiled for the first memory of a geometry and reused for the others
+    first_sim = build_axi_mem(32, 10, 2, 16, cache=False)
+    assert "compile" in first_sim.build_report.phases
+    loaded_sim = build_axi_mem(32, 10, 2, 16)
+    assert sorted(loaded_sim.build_report.phases) == ["load"]
+    assert os.path.basename(loaded_sim.so_file) == os.path.basename(first_sim.so_file)
+    assert loaded_sim.so_file != first_sim.so_file
+    # the first memory is freed like the others, the compiled model stays available
+    first_dir = os.path.dirname(first_sim.so_file)
+    del first_sim
+    gc.collect()
+    assert not os.path.exists(first_dir)
+    assert os.path.exists(build_axi_mem(32, 10, 2, 16).so_file)
+    # with a cache, a new process loads the model from the cache
+    cached_sim = build_axi_mem(64, 12, 3, 64, cache=cache_dir)
+    assert cached_sim.build_report.cache == "miss"
+    _axi_mem_models.clear()
+    cached_sim = build_axi_mem(64, 12, 3, 64, cache=cache_dir)
+    assert cached_sim.build_report.cache == "hit"
+    loaded_sim = build_axi_mem(64, 12, 3, 64, cache=cache_dir)
+    assert loaded_sim.so_file != cached_sim.so_file
+    # every memory has its own contents
+    loaded_sim.internals["mem"].load(mem_data)
+    loaded_sim.internals["mem"][1] = 0x123456789
+    assert loaded_sim.internals.mem[0] == 0x0A
+    assert loaded_sim.internals.mem[1] == 0x123456789
+    assert loaded_sim.internals.mem[3] == 0xFFEE
+    assert cached_sim.internals.mem[3] == 0
+    # threads asking for the same new geometry at the same time share one build
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        sims = list(executor.map(lambda _: build_axi_mem(32, 8, 1, 8, cache=False), range(2)))
+    assert sorted("compile" in sim.build_report.phases for sim in sims) == [False, True]
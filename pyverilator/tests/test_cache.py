@@ -0,0 +1,182 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+
+import pyverilator
+from pyverilator.cache import BuildCache, file_digest, resolve_cache, source_files
+
+
+class TestBuildCache(unittest.TestCase):
+    def setUp(self):
+        self.old_dir = os.getcwd()
+        self.test_dir = tempfile.mkdtemp()
+        os.chdir(self.test_dir)
+        self.cache_dir = os.path.join(self.test_dir, "cache")
+
+    def tearDown(self):
+        os.chdir(self.old_dir)
+        shutil.rmtree(self.test_dir)
+
+    def write_file(self, name, contents):
+        with open(name, "w") as f:
+            f.write(contents)
+        return name
+
+    def test_store_and_lookup(self):
+        cache = BuildCache(self.cache_dir)
+        self.assertIsNone(cache.lookup("0" * 64))
+        so_file = self.write_file("Vtop", "not really a shared object")
+        cached = cache.store("0" * 64, so_file, {"top_module": "top"})
+        self.assertEqual(cache.lookup("0" * 64), cached)
+        self.assertTrue(cached.startswith(os.path.abspath(self.cache_dir)))
+        with open(cached) as f:
+            self.assertEqual(f.read(), "not really a shared object")
+        entries = cache.entries()
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(entries[0]["top_module"], "top")
+        cache.purge()
+        self.assertIsNone(cache.lookup("0" * 64))
+        self.assertEqual(cache.entries(), [])
+
+    def test_lru_eviction(self):
+        cache = BuildCache(self.cache_dir, max_size=1 << 30)
+        so_file = self.write_file("Vtop", "x" * 1000)
+        for key in ["a" * 64, "b" * 64, "c" * 64]:
+            cache.store(key, so_file)
+        # make "a" the most recently used entry
+        past = time.time() - 100
+        for key in ["b" * 64, "c" * 64]:
+            os.utime(os.path.join(cache.builds_dir, key, "entry.json"), (past, past))
+        cache.lookup("a" * 64)
+        # entry sizes differ slightly with the length of their metadata
+        entry_size = max(entry["size"] for entry in cache.entries())
+        removed = cache.evict(2 * entry_size)
+        self.assertEqual(len(removed), 1)
+        self.assertIsNotNone(cache.lookup("a" * 64))
+        self.assertEqual(len(cache.entries()), 2)
+
+    def test_runtime_eviction(self):
+        cache = BuildCache(self.cache_dir, max_size=1 << 30)
+        os.makedirs("build")
+        self.write_file(os.path.join("build", "verilated.o"), "x" * 1000)
+        cache.store_runtime_objects("r" * 64, ["verilated.o"], "build")
+        cache.store("a" * 64, self.write_file("Vtop", "x" * 1000))
+        self.assertGreater(cache.size(), 2000)
+        # the runtime objects were used less recently than the entry
+        past = time.time() - 100
+        os.utime(os.path.join(cache.runtime_dir, "r" * 64), (past, past))
+        self.assertEqual(cache.evict(cache.size() - 1), ["r" * 64])
+        self.assertEqual(cache.runtime_entries(), [])
+        self.assertIsNotNone(cache.lookup("a" * 64))
+        self.assertFalse(cache.link_runtime_objects("r" * 64, ["verilated.o"], "build"))
+
+    def test_source_files(self):
+        os.makedirs("lib")
+        os.makedirs("inc")
+        top = self.write_file("top.v", "module top(); endmodule")
+        lib = self.write_file(os.path.join("lib", "child.v"), "module child(); endmodule")
+        self.write_file(os.path.join("lib", "data.dat"), "00")
+        inc = self.write_file(os.path.join("inc", "defs.vh"), "`define X 1")
+        files = source_files([top], ["lib"], ["+incdir+inc"])
+        self.assertEqual(files, sorted(os.path.abspath(f) for f in [top, lib, inc]))
+
+    def test_resolve_cache(self):
+        self.assertIsNone(resolve_cache(False))
+        self.assertEqual(resolve_cache(self.cache_dir).cache_dir, os.path.abspath(self.cache_dir))
+        cache = BuildCache(self.cache_dir)
+        self.assertIs(resolve_cache(cache), cache)
+
+    @unittest.skipIf(shutil.which("verilator") is None, "test requires verilator to be in the path")
+    def test_build_cache_dependencies(self):
+        # verilator finds sub.v next to the top-level file on its own, it is not named in the build arguments
+        self.write_file("sub.v", "module sub (input [7:0] a, output [7:0] b); assign b = a + 1; endmodule")
+        self.write_file("dep_top.v", "module dep_top (input [7:0] a, output [7:0] b); sub u (.a(a), .b(b)); endmodule")
+        cache = BuildCache(self.cache_dir)
+        sim = pyverilator.PyVerilator.build("dep_top.v", cache=cache)
+        sim.io.a = 1
+        self.assertEqual(sim.io.b, 2)
+        self.assertEqual(pyverilator.PyVerilator.build("dep_top.v", cache=cache).build_report.cache, "hit")
+        # editing sub.v invalidates the entry, which is replaced by the new build
+        self.write_file("sub.v", "module sub (input [7:0] a, output [7:0] b); assign b = a + 2; endmodule")
+        sim = pyverilator.PyVerilator.build("dep_top.v", cache=cache)
+        self.assertEqual(sim.build_report.cache, "miss")
+        sim.io.a = 1
+        self.assertEqual(sim.io.b, 3)
+        self.assertEqual(len(cache.entries()), 1)
+        self.assertEqual(pyverilator.PyVerilator.build("dep_top.v", cache=cache).build_report.cache, "hit")
+
+    @unittest.skipIf(shutil.which("verilator") is None, "test requires verilator to be in the path")
+    def test_build_cache_hit(self):
+        test_verilog = """
+            module cache_test (
+                    input  [7:0] a,
+                    input  [7:0] b,
+                    output [7:0] c);
+                assign c = a + b;
+            endmodule"""
+        self.write_file("cache_test.v", test_verilog)
+        cache = BuildCache(self.cache_dir)
+        sim = pyverilator.PyVerilator.build("cache_test.v", cache=cache)
+        self.assertEqual(len(cache.entries()), 1)
+        self.assertEqual(sim.build_report.cache, "miss")
+        # the second build is loaded from the cache, into a directory of its own
+        cached_sim = pyverilator.PyVerilator.build("cache_test.v", cache=cache)
+        self.assertFalse(cached_sim.so_file.startswith(cache.cache_dir))
+        other_sim = pyverilator.PyVerilator.build("cache_test.v", cache=cache)
+        self.assertNotEqual(os.path.dirname(other_sim.so_file), os.path.dirname(cached_sim.so_file))
+        self.assertEqual(cached_sim.build_report.cache, "hit")
+        self.assertEqual(sorted(cached_sim.build_times), ["cache_lookup", "load"])
+        self.assertEqual(len(cache.entries()), 1)
+        # models loaded from the cache are independent of each other and of the entry
+        cache.purge()
+        cached_sim.io.a = 3
+        cached_sim.io.b = 4
+        other_sim.io.a = 1
+        other_sim.io.b = 1
+        self.assertEqual(cached_sim.io.c, 7)
+        self.assertEqual(other_sim.io.c, 2)
+        self.assertTrue(os.path.isfile(cached_sim.so_file))
+        # changing the sources results in a new entry
+        pyverilator.PyVerilator.build("cache_test.v", cache=cache)
+        self.write_file("cache_test.v", test_verilog.replace("a + b", "a - b"))
+        sim = pyverilator.PyVerilator.build("cache_test.v", cache=cache)
+        self.assertEqual(len(cache.entries()), 2)
+        sim.io.a = 7
+        sim.io.b = 4
+        self.assertEqual(sim.io.c, 3)
+
+    @unittest.skipIf(shutil.which("verilator") is None, "test requires verilator to be in the path")
+    def test_shared_runtime(self):
+        cache = BuildCache(self.cache_dir)
+        self.write_file("and_gate.v", "module and_gate(input a, input b, output c); assign c = a & b; endmodule")
+        self.write_file("or_gate.v", "module or_gate(input a, input b, output c); assign c = a | b; endmodule")
+        pyverilator.PyVerilator.build(os.path.abspath("and_gate.v"), build_dir="and_build", cache=cache)
+        self.assertEqual(len(os.listdir(cache.runtime_dir)), 1)
+        # the second design links against the runtime objects compiled for the first one
+        sim = pyverilator.PyVerilator.build(os.path.abspath("or_gate.v"), build_dir="or_build", cache=cache)
+        self.assertEqual(len(os.listdir(cache.runtime_dir)), 1)
+        self.assertGreater(os.stat(os.path.join("or_build", "verilated.o")).st_nlink, 1)
+        up_to_date = subprocess.run(["make", "-q", "-C", "or_build", "-f", "Vor_gate.mk", "verilated.o"])
+        self.assertEqual(up_to_date.returncode, 0)
+        sim.io.a = 1
+        self.assertEqual(sim.io.c, 1)
+
+    @unittest.skipIf(shutil.which("verilator") is None, "test requires verilator to be in the path")
+    def test_shared_runtime_reconfigured(self):
+        cache = BuildCache(self.cache_dir)
+        verilog_file = os.path.abspath(
+            self.write_file("xor_gate.v", "module xor_gate(input a, input b, output c); assign c = a ^ b; endmodule")
+        )
+        pyverilator.PyVerilator.build(verilog_file, build_dir="xor_build", cache=cache)
+        (first_key,) = os.listdir(cache.runtime_dir)
+        first_objects = os.path.join(cache.runtime_dir, first_key)
+        digests = {name: file_digest(os.path.join(first_objects, name)) for name in os.listdir(first_objects)}
+        # another configuration in the same build_dir compiles its own runtime objects, next to the first ones
+        sim = pyverilator.PyVerilator.build(verilog_file, build_dir="xor_build", cache=cache, threads=2)
+        self.assertEqual(len(os.listdir(cache.runtime_dir)), 2)
+        self.assertEqual({name: file_digest(os.path.join(first_objects, name)) for name in digests}, digests)
+        sim.io.a = 1
+        self.assertEqual(sim.io.c, 1)
@@ -1,11 +1,28 @@
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import json
 import os
 import shutil
+import subprocess
 import tempfile
 import unittest
+from unittest import mock
+
+import numpy as np
 
 import pyverilator
 
 
+def cxx_can_link(headers, libraries):
+    # verilator compiles models with the c++ compiler, which must find the headers and libraries
+    source = "".join("#include <%s>\n" % header for header in headers) + "int main() { return 0; }\n"
+    cmd = [os.environ.get("CXX", "c++"), "-x", "c++", "-", "-o", os.devnull] + ["-l" + lib for lib in libraries]
+    try:
+        return subprocess.run(cmd, input=source.encode(), capture_output=True).returncode == 0
+    except OSError:
+        return False
+
+
 class TestPyVerilator(unittest.TestCase):
     def setUp(self):
         self.old_dir = os.getcwd()
@@ -101,6 +118,940 @@ class TestPyVerilator(unittest.TestCase):
             )
         )
 
+    @unittest.skipIf(shutil.which("verilator") is None, "test requires verilator to be in the path")
+    def test_pyverilator_build_options(self):
+        test_verilog = """
+            module adder (
+                    input  [15:0] a,
+                    input  [15:0] b,
+                    output [16:0] c);
+                assign c = a + b;
+            endmodule"""
+        with open("adder.v", "w") as f:
+            f.write(test_verilog)
+        sim = pyverilator.PyVerilator.build("adder.v", make_jobs=2, opt_fast="-O1", opt_slow="-O0", opt_global="-O1")
+
+        for phase in ["verilate", "wrapper", "compile", "link", "load"]:
+            self.assertIn(phase, sim.build_times)
+            self.assertGreaterEqual(sim.build_times[phase], 0)
+        report = sim.build_report
+        self.assertIsNone(report.cache)
+        self.assertTrue(report.verilated)
+        self.assertGreater(report.object_sizes["Vadder"], 0)
+        self.assertGreater(report.object_sizes["pyverilator_wrapper.o"], 0)
+        self.assertEqual(json.loads(json.dumps(report.as_dict()))["phases"], sim.build_times)
+        self.assertIn("Vadder__ALL.a", sim.build_log)
+
+        # errors are raised as soon as verilator fails, along with its output
+        with open("broken_adder.v", "w") as f:
+            f.write(test_verilog.replace("a + b", "a +"))
+        with self.assertRaises(pyverilator.BuildError) as cm:
+            pyverilator.PyVerilator.build("broken_adder.v")
+        self.assertIn("exit code", str(cm.exception))
+        self.assertIn("broken_adder.v", cm.exception.log)
+
+        sim.io.a = 0xFFFF
+        sim.io.b = 1
+        self.assertEqual(sim.io.c, 0x10000)
+
+    @unittest.skipIf(shutil.which("verilator") is None, "test requires verilator to be in the path")
+    def test_pyverilator_threads(self):
+        test_verilog = """
+            module counter (
+                    input        clk,
+                    input        rst,
+                    output [7:0] out);
+                reg [7:0] count_reg;
+                assign out = count_reg;
+                always @(posedge clk) begin
+                    if (rst == 1) count_reg <= 0;
+                    else          count_reg <= count_reg + 1;
+                end
+            endmodule"""
+        with open("counter.v", "w") as f:
+            f.write(test_verilog)
+        sim = pyverilator.PyVerilator.build(os.path.abspath("counter.v"), build_dir="build", threads=2)
+        self.assertEqual(sim.build_threads, 2)
+        self.assertEqual(sim.threads, 2)
+
+        sim.io.rst = 1
+        sim.clock.tick()
+        sim.io.rst = 0
+        for _ in range(5):
+            sim.clock.tick()
+        self.assertEqual(sim.io.out, 5)
+
+        with self.assertRaises(ValueError):
+            pyverilator.PyVerilator(sim.so_file, threads=1)
+
+    @unittest.skipIf(shutil.which("verilator") is None, "test requires verilator to be in the path")
+    def test_pyverilator_snapshot(self):
+        test_verilog = """
+            module snapshot (
+                    input          clk,
+                    input  [7:0]   a,
+                    input  [39:0]  b,
+                    input  [99:0]  c,
+                    input  [3:0]   \\d.x ,
+                    output [99:0]  sum);
+                reg [99:0] acc;
+                initial acc = 0;
+                always @(posedge clk) acc <= acc + c;
+                assign sum = acc + a + b + \\d.x ;
+            endmodule"""
+        with open("snapshot.v", "w") as f:
+            f.write(test_verilog)
+        sim = pyverilator.PyVerilator.build("snapshot.v", read_internal_signals=True)
+        sim.io.a = 0x12
+        sim.io.b = 0xAB_0000_0001
+        sim.io.c = (1 << 99) | 5
+        sim.io["d.x"] = 3
+        sim.clock.tick()
+
+        # signals are named as in sim.io and sim.internals
+        values = sim.snapshot()
+        self.assertEqual(sorted(values), ["a", "b", "c", "clk", "d.x", "sum"])
+        for name in values:
+            self.assertEqual(values[name], sim.io[name])
+        values = sim.snapshot(internals=True)
+        self.assertEqual(values["acc"], (1 << 99) | 5)
+        self.assertEqual(values["acc"], sim.internals.acc)
+
+        record = sim.snapshot(as_numpy=True)
+        self.assertEqual(record.dtype, sim.snapshot_dtype())
+        self.assertEqual(int(record["a"]), 0x12)
+        self.assertEqual(int(record["b"]), 0xAB_0000_0001)
+        self.assertEqual(list(record["c"]), [5, 0, 0, 1 << 3])
+
+        records = np.zeros(3, dtype=sim.snapshot_dtype(internals=True))
+        for i in range(3):
+            sim.snapshot(internals=True, out=records[i : i + 1])
+            sim.clock.tick()
+        self.assertEqual(list(records["acc"][:, 0]), [5, 10, 15])
+        with self.assertRaises(ValueError):
+            sim.snapshot(out=records[0:1])
+
+    @unittest.skipIf(shutil.which("verilator") is None, "test requires verilator to be in the path")
+    def test_pyverilator_write_many(self):
+        test_verilog = """
+            module write_many (
+                    input  [7:0]   a,
+                    input  [39:0]  b,
+                    input  [99:0]  c,
+                    input  [3:0]   \\d.x ,
+                    output [99:0]  sum);
+                assign sum = a + b + c + \\d.x ;
+            endmodule"""
+        with open("write_many.v", "w") as f:
+            f.write(test_verilog)
+        sim = pyverilator.PyVerilator.build("write_many.v")
+        evals = []
+        eval_model = sim.eval
+        sim.eval = lambda: evals.append(eval_model())
+
+        sim.write_many({"a": 0x1FF, "b": 1 << 39, "c": 1 << 99})
+        self.assertEqual(len(evals), 1)
+        self.assertEqual(sim.io.a, 0xFF)
+        self.assertEqual(sim.io.sum, 0xFF + (1 << 39) + (1 << 99))
+        # inputs that are not given keep their value
+        sim.write_many({"a": 1})
+        self.assertEqual(sim.io.sum, 1 + (1 << 39) + (1 << 99))
+
+        del evals[:]
+        with sim.deferred_eval():
+            sim.io.a = 2
+            with sim.deferred_eval():
+                sim.io.b = 3
+            sim.write_many({"c": 4})
+            self.assertEqual(len(evals), 0)
+        self.assertEqual(len(evals), 1)
+        self.assertEqual(sim.io.sum, 9)
+
+        # inputs are found like in sim.io and find_signal()
+        sim.write_many({"d.x": 1, "A": 0})
+        self.assertEqual(sim.io["d.x"], 1)
+        self.assertEqual(sim.io.sum, 8)
+
+        with self.assertRaises(ValueError):
+            sim.write_many({"sum": 0})
+        with self.assertRaises(ValueError):
+            sim.write_many({"missing": 0})
+
+    @unittest.skipIf(shutil.which("verilator") is None, "test requires verilator to be in the path")
+    def test_pyverilator_wide_words(self):
+        test_verilog = """
+            module wide_words (
+                    input  [7:0]   narrow,
+                    input  [99:0]  a,
+                    output [131:0] y);
+                assign y = {a, narrow, 24'hc0ffee};
+            endmodule"""
+        with open("wide_words.v", "w") as f:
+            f.write(test_verilog)
+        sim = pyverilator.PyVerilator.build("wide_words.v")
+        a_words = sim.io.a.signal.words()
+        y_words = sim.io.y.signal.words(as_numpy=True)
+        self.assertEqual(y_words.dtype, np.uint32)
+        self.assertEqual(len(a_words), 4)
+        self.assertEqual(len(y_words), 5)
+
+        sim.io.narrow = 0x5A
+        sim.io.a = (1 << 100) | (0xABCD << 64) | 1
+        self.assertEqual(sim.io.a, (0xABCD << 64) | 1)
+        self.assertEqual(a_words.tolist(), [1, 0, 0xABCD, 0])
+        # the views follow the model without reading it again
+        self.assertEqual(y_words.tolist(), [0x5AC0FFEE, 1, 0, 0xABCD, 0])
+        self.assertEqual(sim.io.y, ((0xABCD << 64 | 1) << 32) | 0x5AC0FFEE)
+
+        sim.io.a.signal.write_words(np.array([0xFFFFFFFF] * 4, dtype=np.uint32))
+        self.assertEqual(sim.io.a, (1 << 100) - 1)
+        self.assertEqual(y_words[4], 0xF)
+        sim.io.a.signal.write_words([2, 0, 0, 0])
+        self.assertEqual(sim.io.a, 2)
+        with self.assertRaises(ValueError):
+            sim.io.a.signal.write_words([1, 2])
+        with self.assertRaises(ValueError):
+            sim.io.narrow.signal.words()
+
+    @unittest.skipIf(shutil.which("verilator") is None, "test requires verilator to be in the path")
+    def test_pyverilator_signal_views(self):
+        test_verilog = """
+            module signal_views (
+                    input         clk,
+                    input  [8:0]  a,
+                    input  [32:0] b,
+                    output [8:0]  x,
+                    output [32:0] y);
+                reg [15:0] count;
+                initial count = 0;
+                always @(posedge clk) count <= count + 1;
+                assign x = ~a;
+                assign y = b + 1;
+            endmodule"""
+        with open("signal_views.v", "w") as f:
+            f.write(test_verilog)
+        sim = pyverilator.PyVerilator.build("signal_views.v", read_internal_signals=True)
+        for signal in (sim.io.a.signal, sim.io.b.signal, sim.io.x.signal, sim.io.y.signal, sim.internals.count.signal):
+            self.assertIsNotNone(signal._view)
+
+        # writes are masked to the width of the port and evaluate the model
+        sim.io.a = 0x3FF
+        sim.io.b = (1 << 33) | 0xFFFFFFFF
+        self.assertEqual(sim.io.a, 0x1FF)
+        self.assertEqual(sim.io.x, 0)
+        self.assertEqual(sim.io.b, 0xFFFFFFFF)
+        self.assertEqual(sim.io.y, 1 << 32)
+        # the views read the same values as the get_ functions
+        self.assertEqual(sim._read_32("x"), 0)
+        self.assertEqual(sim._read_64("y"), 1 << 32)
+        count = sim.internals.count.signal
+        for _ in range(3):
+            sim.clock.tick()
+        self.assertEqual(count.value, 3)
+        self.assertEqual(count.value, sim._read_32(count.verilator_name))
+
+    @unittest.skipIf(shutil.which("verilator") is None, "test requires verilator to be in the path")
+    def test_pyverilator_find_signal(self):
+        test_verilog = """
+            module find_signal (
+                    input        clk,
+                    input  [7:0] DataIn,
+                    input        Enable,
+                    input        ENABLE,
+                    output [7:0] data_out);
+                reg [7:0] data_reg;
+                initial data_reg = 0;
+                always @(posedge clk) if (Enable | ENABLE) data_reg <= DataIn;
+                assign data_out = data_reg;
+            endmodule"""
+        with open("find_signal.v", "w") as f:
+            f.write(test_verilog)
+        sim = pyverilator.PyVerilator.build("find_signal.v", read_internal_signals=True)
+        self.assertIs(sim.find_signal("DataIn"), sim.io.DataIn.signal)
+        self.assertIs(sim.find_signal("datain"), sim.io.DataIn.signal)
+        self.assertIs(sim.find_signal("find_signal__DOT__data_reg"), sim.internals.data_reg.signal)
+        self.assertIs(sim.find_signal("data_reg"), sim.internals.data_reg.signal)
+        # Enable and ENABLE only differ in case, so they have no lowercase alias
+        self.assertIs(sim.find_signal("ENABLE"), sim.io.ENABLE.signal)
+        self.assertIsNone(sim.find_signal("enable"))
+        self.assertIsNone(sim.find_signal("missing"))
+        self.assertIn("DATAIN", sim)
+        self.assertNotIn("enable", sim)
+
+        sim["datain"] = 0x1A5
+        sim["Enable"] = 1
+        sim.clock.tick()
+        self.assertEqual(sim["DataIn"], 0xA5)
+        self.assertEqual(sim["DATA_OUT"], 0xA5)
+        self.assertEqual(sim["data_reg"], 0xA5)
+        with self.assertRaises(ValueError):
+            sim["data_out"] = 1
+        with self.assertRaises(ValueError):
+            sim["missing"]
+
+    @unittest.skipIf(shutil.which("verilator") is None, "test requires verilator to be in the path")
+    def test_pyverilator_raw(self):
+        test_verilog = """
+            module raw_child (input clk, input [3:0] in, output [3:0] out);
+                reg [3:0] state;
+                initial state = 0;
+                always @(posedge clk) state <= state + in;
+                assign out = state;
+            endmodule
+            module raw_access (
+                    input         clk,
+                    input  [3:0]  in,
+                    input  [99:0] wide,
+                    output [3:0]  out,
+                    output [99:0] wide_out);
+                raw_child child (.clk(clk), .in(in), .out(out));
+                assign wide_out = wide;
+            endmodule"""
+        with open("raw_access.v", "w") as f:
+            f.write(test_verilog)
+        sim = pyverilator.PyVerilator.build("raw_access.v", read_internal_signals=True)
+        sim.raw.in_ = 3
+        sim.raw["wide"] = (1 << 99) | 7
+        sim.clock.tick()
+        self.assertIs(type(sim.raw.out), int)
+        self.assertEqual(sim.raw.out, 3)
+        self.assertEqual(sim.raw["in"], 3)
+        self.assertEqual(sim.raw.wide_out, (1 << 99) | 7)
+        self.assertIs(type(sim.raw_internals.child.state), int)
+        self.assertEqual(sim.raw_internals.child.state, 3)
+        self.assertIn("in", sim.raw)
+        with self.assertRaises(AttributeError):
+            sim.raw.out = 1
+        with self.assertRaises(ValueError):
+            sim.raw["out"] = 1
+        with self.assertRaises(ValueError):
+            sim.raw["missing"]
+
+        # signals and values have slots, values read through collections still carry their signal
+        self.assertFalse(hasattr(sim.io.out.signal, "__dict__"))
+        self.assertFalse(hasattr(sim.io.out, "__dict__"))
+        self.assertIsInstance(sim.io.out, pyverilator.pyverilator.SignalValue)
+        self.assertIs(sim.io.out.signal, sim.find_signal("out"))
+        self.assertIs(type(sim.io.out), type(sim.io.out))
+        # copies and subclasses keep their type and signal
+        value = copy.copy(sim.io.out)
+        self.assertIs(type(value), type(sim.io.out))
+        self.assertIs(value.signal, sim.io.out.signal)
+
+        class MarkedValue(pyverilator.pyverilator.SignalValue):
+            pass
+
+        marked = MarkedValue(sim.io.out.signal)
+        self.assertIs(type(marked), MarkedValue)
+        self.assertIs(marked.signal, sim.io.out.signal)
+        self.assertEqual(marked, 3)
+        self.assertEqual(sim.io.out.value, 3)
+        self.assertIs(type(sim.io.out.value), int)
+
+    @unittest.skipIf(shutil.which("verilator") is None, "test requires verilator to be in the path")
+    def test_pyverilator_lazy_eval(self):
+        test_verilog = """
+            module lazy_eval (
+                    input        clk,
+                    input  [7:0] a,
+                    input  [7:0] b,
+                    output [7:0] sum,
+                    output [7:0] count);
+                reg [7:0] count_reg;
+                initial count_reg = 0;
+                always @(posedge clk) count_reg <= count_reg + a;
+                assign sum = a + b;
+                assign count = count_reg;
+            endmodule"""
+        with open("lazy_eval.v", "w") as f:
+            f.write(test_verilog)
+        sim = pyverilator.PyVerilator.build("lazy_eval.v", auto_eval="lazy")
+        evals = []
+        eval_function = sim._eval
+        sim._eval = lambda model: evals.append(model) or eval_function(model)
+
+        # writes only mark the model dirty, the next read evaluates it once
+        sim.io.a = 2
+        sim.io.b = 3
+        self.assertEqual(len(evals), 0)
+        self.assertEqual(sim.io.sum, 5)
+        self.assertEqual(sim.raw.sum, 5)
+        self.assertEqual(len(evals), 1)
+        sim.eval()
+        self.assertEqual(len(evals), 2)
+
+        # writing the clock again evaluates its previous value first, so no edge is lost
+        sim.clock.tick()
+        sim.clock.tick()
+        self.assertEqual(sim.io.count, 4)
+        sim.io.clk = 0
+        sim.io.clk = 1
+        sim.io.clk = 0
+        sim.io.clk = 1
+        self.assertEqual(sim.io.count, 8)
+        sim.write_many({"a": 1, "clk": 0})
+        sim.write_many({"clk": 1})
+        self.assertEqual(sim.snapshot()["count"], 9)
+        with sim.deferred_eval():
+            sim.io.b = 10
+        self.assertEqual(sim.io.sum, 11)
+
+        # inputs written in a deferred_eval() block are evaluated first when they are written again after it
+        with sim.deferred_eval():
+            sim.io.clk = 0
+        sim.io.clk = 1
+        self.assertEqual(sim.io.count, 10)
+        with sim.deferred_eval():
+            sim.write_many({"clk": 0})
+        sim.io.clk = 1
+        self.assertEqual(sim.io.count, 11)
+
+    @unittest.skipIf(shutil.which("verilator") is None, "test requires verilator to be in the path")
+    def test_pyverilator_run(self):
+        test_verilog = """
+            module run_loop (
+                    input         clk,
+                    input         slow_clk,
+                    input         rst,
+                    output [15:0] count,
+                    output [7:0]  slow_count,
+                    output        done);
+                reg [15:0] count_reg;
+                reg [7:0] slow_count_reg;
+                initial slow_count_reg = 0;
+                always @(posedge clk) count_reg <= rst ? 0 : count_reg + 1;
+                always @(posedge slow_clk) slow_count_reg <= slow_count_reg + 1;
+                assign count = count_reg;
+                assign slow_count = slow_count_reg;
+                assign done = count_reg == 100;
+            endmodule"""
+        with open("run_loop.v", "w") as f:
+            f.write(test_verilog)
+        sim = pyverilator.PyVerilator.build("run_loop.v")
+        sim.io.rst = 1
+        self.assertEqual(sim.run(2), 2)
+        sim.io.rst = 0
+        self.assertEqual(sim.run(10), 10)
+        self.assertEqual(sim.io.count, 10)
+        self.assertEqual(sim.run(1000, until="done"), 90)
+        self.assertEqual(sim.io.count, 100)
+        self.assertEqual(sim.run(1000, until=sim.io.count.signal, value=0x10, mask=0xF0), 172)
+        self.assertEqual(sim.io.count, 0x110)
+        self.assertEqual(sim.run(3, clock="slow_clk"), 3)
+        self.assertEqual(sim.io.slow_count, 3)
+        self.assertEqual(sim.io.count, 0x110)
+        # counts of 2**32 cycles and more are not truncated
+        self.assertEqual(sim.run(2**32 + 5, until=sim.io.count.signal, value=0x120), 16)
+        self.assertEqual(sim.io.count, 0x120)
+        with self.assertRaises(ValueError):
+            sim.run(-1)
+        with self.assertRaises(ValueError):
+            sim.run(1, clock="count")
+        with self.assertRaises(ValueError):
+            sim.run(1, until="missing")
+
+        # the cycles are dumped to the trace like ticks from python
+        sim.start_vcd_trace("run_loop.vcd")
+        start_time = sim.curr_time
+        sim.run(4)
+        self.assertEqual(sim.curr_time, start_time + 80)
+        sim.clock.tick()
+        self.assertEqual(sim.curr_time, start_time + 100)
+        sim.stop_vcd_trace()
+        with open("run_loop.vcd") as f:
+            timestamps = [line.strip() for line in f if line.startswith("#")]
+        # the rising edges of the clock, 4 from run() and the last one from tick()
+        for i in range(5):
+            self.assertIn("#%d" % (start_time + 15 + 20 * i), timestamps)
+
+    @unittest.skipIf(shutil.which("verilator") is None, "test requires verilator to be in the path")
+    def test_pyverilator_run_vectors(self):
+        test_verilog = """
+            module run_vectors (
+                    input          clk,
+                    input  [7:0]   a,
+                    input  [39:0]  b,
+                    input  [99:0]  c,
+                    output [7:0]   a_reg,
+                    output [40:0]  sum,
+                    output [99:0]  c_reg);
+                reg [7:0] a_q;
+                reg [40:0] sum_q;
+                reg [99:0] c_q;
+                always @(posedge clk) begin
+                    a_q <= a;
+                    sum_q <= a + b;
+                    c_q <= ~c;
+                end
+                assign a_reg = a_q;
+                assign sum = sum_q;
+                assign c_reg = c_q;
+            endmodule"""
+        with open("run_vectors.v", "w") as f:
+            f.write(test_verilog)
+        sim = pyverilator.PyVerilator.build("run_vectors.v")
+        cycles = 300
+        a = np.arange(cycles)
+        b = np.arange(cycles, dtype=np.uint64) << np.uint64(32)
+        c = np.zeros((cycles, 4), dtype=np.uint32)
+        c[:, 0] = np.arange(cycles)
+        result = sim.run_vectors({"a": a, "b": b, "c": c}, ["a_reg", "sum", "c_reg"])
+        self.assertEqual(sorted(result), ["a_reg", "c_reg", "sum"])
+        self.assertEqual(result["a_reg"].dtype, np.uint32)
+        self.assertEqual(result["sum"].dtype, np.uint64)
+        self.assertEqual(result["c_reg"].shape, (cycles, 4))
+        # inputs are masked to their width
+        self.assertEqual(result["a_reg"].tolist(), [value & 0xFF for value in range(cycles)])
+        expected_sum = [(value & 0xFF) + ((value << 32) & (1 << 40) - 1) for value in range(cycles)]
+        self.assertEqual(result["sum"].tolist(), expected_sum)
+        self.assertEqual(result["c_reg"][:, 0].tolist(), [~value & 0xFFFFFFFF for value in range(cycles)])
+        self.assertEqual(result["c_reg"][:, 3].tolist(), [0xF] * cycles)
+        # the model is left in the state of the last cycle
+        self.assertEqual(sim.io.a_reg, (cycles - 1) & 0xFF)
+        # without inputs to drive, the number of cycles is given
+        sim.io.a = 7
+        result = sim.run_vectors({}, ["a_reg"], cycles=3)
+        self.assertEqual(result["a_reg"].tolist(), [7, 7, 7])
+
+        with self.assertRaises(ValueError):
+            sim.run_vectors({}, ["a_reg"])
+        with self.assertRaises(ValueError):
+            sim.run_vectors({"a": a}, ["a_reg"], cycles=10)
+        with self.assertRaises(ValueError):
+            sim.run_vectors({"a": a, "b": b[:10]}, ["sum"])
+        with self.assertRaises(ValueError):
+            sim.run_vectors({"sum": a}, [])
+        with self.assertRaises(ValueError):
+            sim.run_vectors({"c": np.arange(cycles)}, [])
+
+    @unittest.skipIf(shutil.which("verilator") is None, "test requires verilator to be in the path")
+    def test_pyverilator_vcd_flush_policy(self):
+        test_verilog = """
+            module vcd_flush (input clk, output [7:0] count);
+                reg [7:0] count_reg;
+                initial count_reg = 0;
+                always @(posedge clk) count_reg <= count_reg + 1;
+                assign count = count_reg;
+            endmodule"""
+        with open("vcd_flush.v", "w") as f:
+            f.write(test_verilog)
+        sim = pyverilator.PyVerilator.build("vcd_flush.v")
+        self.assertEqual(sim.trace_format, "vcd")
+        flushes = []
+        flush_vcd_trace = sim.flush_vcd_trace
+        sim.flush_vcd_trace = lambda: flushes.append(sim.curr_time) or flush_vcd_trace()
+
+        # the default flushes after every dump, i.e. every clock change
+        sim.start_vcd_trace("vcd_flush_always.vcd")
+        for _ in range(5):
+            sim.clock.tick()
+        self.assertEqual(len(flushes), 11)
+        sim.stop_vcd_trace()
+
+        del flushes[:]
+        sim.start_vcd_trace("vcd_flush_every.vcd", flush_every=4)
+        for _ in range(5):
+            sim.clock.tick()
+        self.assertEqual(len(flushes), 2)
+        sim.run(10)
+        self.assertEqual(len(flushes), 3)
+        sim.stop_vcd_trace()
+
+        del flushes[:]
+        sim.start_vcd_trace("vcd_flush_never.vcd", flush_every=None)
+        sim.run(10)
+        for _ in range(5):
+            sim.clock.tick()
+        self.assertEqual(len(flushes), 0)
+        sim.flush_vcd_trace()
+        self.assertEqual(len(flushes), 1)
+        sim.stop_vcd_trace()
+        with open("vcd_flush_never.vcd") as f:
+            self.assertIn("#%d" % (sim.curr_time - 5), f.read())
+
+        del flushes[:]
+        sim.start_vcd_trace("vcd_flush_interval.vcd", flush_every=None, flush_interval=0.0)
+        sim.clock.tick()
+        self.assertEqual(len(flushes), 3)
+        sim.stop_vcd_trace()
+
+        # a flush_interval alone only flushes by time
+        del flushes[:]
+        sim.start_vcd_trace("vcd_flush_hourly.vcd", flush_interval=3600.0)
+        for _ in range(5):
+            sim.clock.tick()
+        self.assertEqual(len(flushes), 0)
+        sim.stop_vcd_trace()
+
+    @unittest.skipIf(shutil.which("verilator") is None, "test requires verilator to be in the path")
+    def test_pyverilator_record(self):
+        test_verilog = """
+            module record (input clk, input [7:0] step, output [7:0] count, output [95:0] wide);
+                reg [7:0] count_reg;
+                initial count_reg = 0;
+                always @(posedge clk) count_reg <= count_reg + step;
+                assign count = count_reg;
+                assign wide = {count_reg, 80'h1, count_reg};
+            endmodule"""
+        with open("record.v", "w") as f:
+            f.write(test_verilog)
+        sim = pyverilator.PyVerilator.build("record.v")
+        sim.io.step = 1
+        sim.clock.tick()
+
+        # samples after every rising edge, from python and from the native loops, growing the buffer
+        with sim.record(["count", sim.io.wide.signal], capacity=2) as recorder:
+            for _ in range(3):
+                sim.clock.tick()
+            sim.run(5)
+            sim.run_vectors({"step": [2, 2, 2]}, [])
+        self.assertEqual(len(recorder), 11)
+        columns = recorder.columns()
+        self.assertEqual(list(columns), ["cycle", "count", "wide"])
+        self.assertEqual(columns["cycle"].tolist(), list(range(11)))
+        self.assertEqual(columns["count"].tolist(), [2, 3, 4, 5, 6, 7, 8, 9, 11, 13, 15])
+        self.assertEqual(columns["wide"].shape, (11, 3))
+        self.assertEqual(columns["wide"][-1].tolist(), [(1 << 8) | 15, 0, 15 << 24])
+        self.assertEqual(recorder.records.dtype.names, ("cycle", "count", "wide"))
+
+        # stopped at the end of the with block
+        sim.run(2)
+        self.assertEqual(len(recorder), 11)
+
+        recorder = sim.record(["count"])
+        sim.clock.tick()
+        recorder.clear()
+        all_signals = sim.record()
+        sim.clock.tick()
+        self.assertEqual(recorder["cycle"].tolist(), [1])
+        self.assertEqual(recorder["count"].tolist(), [23])
+        self.assertEqual(all_signals.names, ["clk", "step", "count", "wide"])
+        self.assertEqual(all_signals["count"].tolist(), [23])
+        recorder.stop()
+        all_signals.stop()
+
+        # the buffer only grows with the samples taken, not with the cycles a loop may run
+        target = (sim.io.count + 10) & 0xFF
+        with sim.record(["count"], capacity=16) as recorder:
+            self.assertEqual(sim.run(10**9, until="count", value=target), 10)
+            self.assertEqual(len(recorder), 10)
+            self.assertEqual(len(recorder._buffer), 16)
+            sim.run(20)
+            self.assertEqual(len(recorder), 30)
+            self.assertEqual(len(recorder._buffer), 32)
+
+        with self.assertRaises(ValueError):
+            sim.record(["missing"])
+        with self.assertRaises(ValueError):
+            sim.record(["count", "count"])
+
+        # without auto_eval, a rising edge written from python is sampled by the next eval(), as run() samples it
+        manual = pyverilator.PyVerilator.build("record.v", auto_eval=False)
+        manual.io.step = 1
+        manual.eval()
+        with manual.record(["count"]) as recorder:
+            manual.clock.write(0)
+            manual.eval()
+            manual.clock.write(1)
+            self.assertEqual(len(recorder), 0)
+            manual.eval()
+            manual.eval()
+            manual.run(2)
+        self.assertEqual(recorder["cycle"].tolist(), [0, 1, 2])
+        self.assertEqual(recorder["count"].tolist(), [1, 2, 3])
+
+    @unittest.skipIf(shutil.which("verilator") is None, "test requires verilator to be in the path")
+    def test_pyverilator_flight_recorder(self):
+        test_verilog = """
+            module stage (input clk, input [7:0] d, output [7:0] q);
+                reg [7:0] q_reg;
+                initial q_reg = 0;
+                always @(posedge clk) q_reg <= d;
+                assign q = q_reg;
+            endmodule
+            module flight (input clk, output [7:0] count, output error);
+                reg [7:0] count_reg;
+                initial count_reg = 0;
+                always @(posedge clk) count_reg <= count_reg + 1;
+                assign count = count_reg;
+                assign error = count_reg == 100;
+                stage u_stage (.clk(clk), .d(count_reg), .q());
+            endmodule"""
+        with open("flight.v", "w") as f:
+            f.write(test_verilog)
+        sim = pyverilator.PyVerilator.build("flight.v", read_internal_signals=True)
+        if os.path.exists("flight.vcd"):
+            os.remove("flight.vcd")
+
+        # a passing run writes nothing
+        with sim.flight_recorder("flight.vcd", cycles=8) as recorder:
+            sim.run(50)
+        self.assertFalse(os.path.exists("flight.vcd"))
+        self.assertEqual(len(recorder), 8)
+        self.assertEqual(recorder.names, ["clk", "count", "error"])
+        self.assertEqual(recorder["cycle"].tolist(), list(range(42, 50)))
+        self.assertEqual(recorder["count"].tolist(), list(range(43, 51)))
+
+        # a failing one writes the last cycles, from the native loop and from python
+        with self.assertRaises(AssertionError):
+            with sim.flight_recorder("flight.vcd", cycles=8, signals=["count", "error", "u_stage.q_reg"]):
+                sim.run(45)
+                while sim.io.error == 0:
+                    sim.clock.tick()
+                assert sim.io.error == 0
+        self.assertEqual(sim._recorders, [])
+        with open("flight.vcd") as f:
+            vcd = f.read()
+        self.assertIn("$scope module flight $end", vcd)
+        self.assertIn("$scope module u_stage $end", vcd)
+        self.assertIn("$var wire 8 # q_reg [7:0] $end", vcd)
+        self.assertIn('$var wire 1 " error $end', vcd)
+        # two timestamps per cycle, with the clock added to show the edges
+        self.assertIn("$var wire 1 $ clk $end", vcd)
+        timestamps = [int(line[1:]) for line in vcd.splitlines() if line.startswith("#")]
+        self.assertEqual(timestamps, list(range(84, 100)))
+        self.assertTrue(vcd.endswith('#98\nb1100100 !\n1"\nb1100011 #\n1$\n#99\n0$\n'))
+
+        with self.assertRaises(ValueError):
+            sim.record(["count"]).dump()
+
+    @unittest.skipIf(shutil.which("verilator") is None, "test requires verilator to be in the path")
+    def test_pyverilator_trace_window(self):
+        test_verilog = """
+            module delay (input clk, input [7:0] d, output [7:0] q);
+                reg [7:0] q_reg;
+                initial q_reg = 0;
+                always @(posedge clk) q_reg <= d;
+                assign q = q_reg;
+            endmodule
+            module trace_window (input clk, output [7:0] count, output [7:0] delayed);
+                reg [7:0] count_reg;
+                initial count_reg = 0;
+                always @(posedge clk) count_reg <= count_reg + 1;
+                assign count = count_reg;
+                delay u_delay (.clk(clk), .d(count_reg), .q(delayed));
+            endmodule"""
+        with open("trace_window.v", "w") as f:
+            f.write(test_verilog)
+        sim = pyverilator.PyVerilator.build("trace_window.v")
+
+        def timestamps(filename):
+            with open(filename) as f:
+                return [int(line[1:]) for line in f if line.startswith("#")]
+
+        # only the signals of the delay instance
+        sim.start_vcd_trace("trace_scope.vcd", scopes=[("trace_window.u_delay", 1)])
+        sim.run(2)
+        sim.stop_vcd_trace()
+        with open("trace_scope.vcd") as f:
+            variables = [line.split()[4] for line in f if line.strip().startswith("$var")]
+        self.assertEqual(variables, ["clk", "d", "q", "q_reg"])
+
+        # cycles 5 to 7, from python and from the native loop; time advances outside of the window
+        sim.start_vcd_trace("trace_cycles.vcd", start_cycle=5, stop_cycle=8)
+        sim.run(4)
+        for _ in range(3):
+            sim.clock.tick()
+        sim.run(10)
+        self.assertEqual(sim.curr_time, 10 + 17 * 20)
+        sim.stop_vcd_trace()
+        self.assertEqual(timestamps("trace_cycles.vcd")[0], 10 + 5 * 20 + 5)
+        self.assertEqual(timestamps("trace_cycles.vcd")[-1], 10 + 8 * 20)
+
+        # from the rising edge after which count is 40, for the rest of that cycle and the next one
+        for run_python in (True, False):
+            start_count = sim.io.count
+            sim.start_vcd_trace("trace_trigger.vcd", trigger="count", trigger_value=40, stop_cycle=2)
+            if run_python:
+                for _ in range(50):
+                    sim.clock.tick()
+            else:
+                sim.run(50)
+            sim.stop_vcd_trace()
+            trigger_time = 10 + (40 - start_count) * 20
+            self.assertEqual(timestamps("trace_trigger.vcd")[0], trigger_time - 5)
+            self.assertLessEqual(timestamps("trace_trigger.vcd")[-1], trigger_time + 20)
+            sim.run(256 - 50)
+
+        with self.assertRaises(ValueError):
+            sim.start_vcd_trace("trace_trigger.vcd", trigger="missing")
+
+    @unittest.skipIf(shutil.which("verilator") is None, "test requires verilator to be in the path")
+    @unittest.skipUnless(cxx_can_link(["zlib.h"], ["z"]), "FST models require zlib")
+    def test_pyverilator_fst_trace(self):
+        test_verilog = """
+            module fst_trace (input clk, output [7:0] count);
+                reg [7:0] count_reg;
+                initial count_reg = 0;
+                always @(posedge clk) count_reg <= count_reg + 1;
+                assign count = count_reg;
+            endmodule"""
+        with open("fst_trace.v", "w") as f:
+            f.write(test_verilog)
+        with self.assertRaises(ValueError):
+            pyverilator.PyVerilator.build("fst_trace.v", trace_format="lxt")
+        sim = pyverilator.PyVerilator.build("fst_trace.v", trace_format="fst")
+        self.assertEqual(sim.trace_format, "fst")
+        with self.assertRaises(ValueError):
+            sim.start_vcd_trace("fst_trace.vcd")
+        sim.start_trace("fst_trace.fst", flush_every=None)
+        for _ in range(5):
+            sim.clock.tick()
+        sim.run(10)
+        sim.stop_vcd_trace()
+        self.assertEqual(sim.io.count, 15)
+        with open("fst_trace.fst", "rb") as f:
+            header = f.read(1)
+        # FST files start with a header block (type 0), VCD files with a $ keyword
+        self.assertEqual(header, b"\x00")
+
+        # the FST writer can run in a thread of its own
+        with self.assertRaises(ValueError):
+            pyverilator.PyVerilator.build("fst_trace.v", trace_threads=1)
+        sim = pyverilator.PyVerilator.build("fst_trace.v", build_dir="obj_threads", trace_format="fst", trace_threads=1)
+        sim.start_trace("fst_threads.fst", flush_every=None)
+        sim.run(10)
+        sim.stop_vcd_trace()
+        self.assertEqual(sim.io.count, 10)
+        with open("fst_threads.fst", "rb") as f:
+            self.assertEqual(f.read(1), b"\x00")
+
+    @unittest.skipIf(shutil.which("verilator") is None, "test requires verilator to be in the path")
+    def test_pyverilator_build_many(self):
+        test_verilog = """
+            module offset #(parameter OFFSET = 0) (
+                    input  [7:0] a,
+                    output [7:0] b);
+                integer f;
+                initial begin
+                    f = $fopen("LOADS", "a");
+                    $fwrite(f, "%0d\\n", OFFSET);
+                    $fclose(f);
+                end
+                assign b = a + OFFSET;
+            endmodule"""
+        with open("offset.v", "w") as f:
+            f.write(test_verilog.replace("LOADS", os.path.abspath("loads.txt")))
+        with open("broken.v", "w") as f:
+            f.write("module broken(input a, output b); assign b = ; endmodule")
+        specs = [{"top_verilog_file": "offset.v", "extra_args": ["-GOFFSET=%d" % offset]} for offset in (1, 2)]
+        specs.append({"top_verilog_file": "broken.v"})
+        sims = pyverilator.PyVerilator.build_many(specs, max_workers=2, return_exceptions=True)
+
+        for offset, sim in zip((1, 2), sims):
+            self.assertIn("make", sim.build_log)
+            self.assertIn("compile", sim.build_times)
+            sim.io.a = 10
+            self.assertEqual(sim.io.b, 10 + offset)
+        # the workers only compile the models, they are initialized once, in this process
+        with open("loads.txt") as f:
+            self.assertEqual(sorted(f.read().split()), ["1", "2"])
+        self.assertIsInstance(sims[2], pyverilator.BuildError)
+        self.assertIn("broken.v", sims[2].log)
+
+        with self.assertRaises(pyverilator.BuildError):
+            pyverilator.PyVerilator.build_many(specs[2:])
+
+        # the temporary build dir of a result that is not loaded is removed by close() or garbage collection
+        results = [future.result() for future in pyverilator.PyVerilator.build_async(specs[:2])]
+        build_dirs = [result.builddir_to_remove for result in results]
+        self.assertTrue(all(os.path.isdir(build_dir) for build_dir in build_dirs))
+        with results[0]:
+            pass
+        self.assertFalse(os.path.exists(build_dirs[0]))
+        del results[1]
+        self.assertFalse(os.path.exists(build_dirs[1]))
+
+    @unittest.skipIf(shutil.which("verilator") is None, "test requires verilator to be in the path")
+    def test_pyverilator_mem_init_dirs(self):
+        test_verilog = """
+            module rom (
+                    input  [1:0] addr,
+                    output [7:0] data);
+                reg [7:0] mem [0:3];
+                initial $readmemh("rom.dat", mem);
+                assign data = mem[addr];
+            endmodule"""
+        os.makedirs("src")
+        with open(os.path.join("src", "rom.v"), "w") as f:
+            f.write(test_verilog)
+        with open(os.path.join("src", "rom.dat"), "w") as f:
+            f.write("11 22 33 44\n")
+        cwd = os.getcwd()
+        sim = pyverilator.PyVerilator.build(os.path.abspath(os.path.join("src", "rom.v")), build_dir="build")
+        self.assertEqual(os.getcwd(), cwd)
+        # build_dir is relative to the directory of the top-level file, and the .dat file is found there as well
+        self.assertEqual(os.path.dirname(sim.so_file), os.path.abspath(os.path.join("src", "build")))
+        sim.io.addr = 2
+        self.assertEqual(sim.io.data, 0x33)
+
+        # models can be loaded from several threads, each with its own directories, the working directory is
+        # never changed
+        for i in range(4):
+            os.makedirs("data%d" % i)
+            with open(os.path.join("data%d" % i, "rom.dat"), "w") as f:
+                f.write("%02x %02x %02x %02x\n" % (i, i + 0x10, i + 0x20, i + 0x30))
+
+        def load(i):
+            model = pyverilator.PyVerilator(sim.so_file, mem_init_dirs=[os.path.abspath("data%d" % (i % 4))])
+            model.io.addr = 3
+            return model.io.data
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            self.assertEqual(list(executor.map(load, range(16))), [i % 4 + 0x30 for i in range(16)])
+        self.assertEqual(os.getcwd(), cwd)
+        # without directories, the file is only looked up in the working directory
+        with open("rom.dat", "w") as f:
+            f.write("55 66 77 88\n")
+        model = pyverilator.PyVerilator(sim.so_file, mem_init_dirs=[])
+        model.io.addr = 1
+        self.assertEqual(model.io.data, 0x66)
+
+    @unittest.skipIf(shutil.which("verilator") is None, "test requires verilator to be in the path")
+    def test_pyverilator_incremental(self):
+        test_verilog = """
+            module adder (
+                    input  [7:0] a,
+                    input  [7:0] b,
+                    output [7:0] c);
+                assign c = a + b;
+            endmodule"""
+        with open("adder.v", "w") as f:
+            f.write(test_verilog)
+        sim = pyverilator.PyVerilator.build(os.path.abspath("adder.v"), build_dir="build")
+        generated_files = ["pyverilator_wrapper.cpp", "Vadder.h", "Vadder.mk", "Vadder"]
+        mtimes = {name: os.path.getmtime(os.path.join("build", name)) for name in generated_files}
+        del sim
+
+        # nothing changed, so nothing is generated or linked again
+        sim = pyverilator.PyVerilator.build(os.path.abspath("adder.v"), build_dir="build")
+        for name in generated_files:
+            self.assertEqual(os.path.getmtime(os.path.join("build", name)), mtimes[name])
+        sim.io.a = 3
+        sim.io.b = 4
+        self.assertEqual(sim.io.c, 7)
+        del sim
+
+        # changing the logic runs verilator again, but the interface and so the wrapper stay the same
+        with open("adder.v", "w") as f:
+            f.write(test_verilog.replace("a + b", "a - b"))
+        sim = pyverilator.PyVerilator.build(os.path.abspath("adder.v"), build_dir="build")
+        self.assertEqual(
+            os.path.getmtime(os.path.join("build", "pyverilator_wrapper.cpp")), mtimes["pyverilator_wrapper.cpp"]
+        )
+        self.assertNotEqual(os.path.getmtime(os.path.join("build", "Vadder")), mtimes["Vadder"])
+        sim.io.a = 7
+        sim.io.b = 4
+        self.assertEqual(sim.io.c, 3)
+
+        # a failing verilate stage leaves no staging directory behind
+        with open("adder.v", "w") as f:
+            f.write(test_verilog.replace("a + b", "a ^ b"))
+        with mock.patch("pyverilator.pyverilator.update_outputs", side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                pyverilator.PyVerilator.build(os.path.abspath("adder.v"), build_dir="build")
+        self.assertEqual([name for name in os.listdir("build") if name.startswith(".verilator-")], [])
+
     @unittest.skipIf(shutil.which("verilator") is None, "test requires verilator to be in the path")
     @unittest.expectedFailure
     def test_pyverilator_tracing(self):
@@ -241,8 +1192,6 @@ class TestPyVerilator(unittest.TestCase):
             test_pyverilator.io.rd_idx = idx
             return test_pyverilator.io.rd_data
 
-        # TODO: add tests for getting values from internal arrays of registers once supported by pyverilator
-
         write_reg(0, 0)
         self.assertEqual(read_reg(0), 0)
 
@@ -268,6 +1217,89 @@ class TestPyVerilator(unittest.TestCase):
 
         test_pyverilator.stop_vcd_trace()
 
+    @unittest.skipIf(shutil.which("verilator") is None, "test requires verilator to be in the path")
+    def test_pyverilator_internal_arrays(self):
+        test_verilog = """
+            module counter_cell (
+                    input        clk,
+                    output [3:0] count);
+                reg [4:0] state;
+                initial state = 0;
+                always @(posedge clk) state <= state + 1;
+                assign count = state[3:0];
+            endmodule
+
+            module internal_arrays (
+                    input        clk,
+                    input  [1:0] wr_idx,
+                    input  [7:0] wr_data,
+                    output [7:0] out,
+                    output [7:0] taps [0:1]);
+                reg [7:0] mem [0:3];
+                wire [3:0] count;
+                counter_cell child (.clk(clk), .count(count));
+                genvar i;
+                generate
+                    for (i = 0; i < 2; i = i + 1) begin : blk
+                        reg [2:0] bits;
+                        always @(posedge clk) bits <= count[2:0] + i;
+                    end
+                endgenerate
+                always @(posedge clk) mem[wr_idx] <= wr_data;
+                assign out = mem[0];
+                assign taps[0] = mem[1];
+                assign taps[1] = mem[2];
+            endmodule"""
+        with open("internal_arrays.v", "w") as f:
+            f.write(test_verilog)
+        # ports with unpacked dimensions are skipped with a warning
+        with self.assertWarnsRegex(UserWarning, "unpacked dimensions .* taps"):
+            sim = pyverilator.PyVerilator.build("internal_arrays.v", read_internal_signals=True)
+        self.assertEqual(sim.outputs, [("out", 8)])
+        # when verilator can not dump the design, its errors are reported
+        with self.assertWarnsRegex(UserWarning, "could not dump the design"):
+            self.assertIsNone(pyverilator.discovery.dump_design(["false"], "Vinternal_arrays"))
+
+        internal_widths = dict(sim.internal_signals)
+        self.assertEqual(internal_widths["internal_arrays__DOT__child__DOT__state"], 5)
+        self.assertEqual(internal_widths["internal_arrays__DOT__blk__BRA__1__KET____DOT__bits"], 3)
+        self.assertEqual(sim.internal_arrays, [("internal_arrays__DOT__mem", 8, 4)])
+
+        for idx, data in enumerate([0x11, 0x22, 0x33, 0x44]):
+            sim.io.wr_idx = idx
+            sim.io.wr_data = data
+            sim.io.clk = 0
+            sim.io.clk = 1
+        self.assertEqual(sim.internals.child.state, 4)
+        self.assertEqual(sim.internals["blk[1]"].bits, 4)
+        self.assertEqual(len(sim.internals.mem), 4)
+        self.assertEqual(sim.internals.mem[2], 0x33)
+        self.assertEqual(sim.internals.mem[-1], 0x44)
+        self.assertEqual(sim.internals.mem.value, [0x11, 0x22, 0x33, 0x44])
+        with self.assertRaises(IndexError):
+            sim.internals.mem[4]
+
+    def test_pyverilator_escaped_names(self):
+        # verilator encodes the characters of escaped identifiers in upper case hex
+        self.assertEqual(pyverilator.discovery.encode_name("a.b"), "a__02Eb")
+        self.assertEqual(pyverilator.discovery.encode_name("$^_^"), "__024__05E___05E")
+        self.assertEqual(pyverilator.discovery.encode_scope_name("u.0[1]"), "u__02E0__BRA__1__KET__")
+        dtypes = {"t8": {"type": "BASICDTYPE", "range": "7:0"}}
+        modules = {
+            "top": {
+                "name": "escaped",
+                "items": [
+                    {"kind": "var", "name": "in.a", "direction": "INPUT", "var_type": "PORT", "dtype": "t8"},
+                    {"kind": "var", "name": "cnt[hi]", "direction": "NONE", "var_type": "VAR", "dtype": "t8"},
+                ],
+            }
+        }
+        with open("Vescaped.h", "w") as f:
+            f.write("VL_IN8(&in__02Ea,7,0);\nCData/*7:0*/ escaped__DOT__cnt__05Bhi__05D;\n")
+        signals = pyverilator.discovery.model_signals(("top", modules, dtypes), ".", "Vescaped")
+        self.assertEqual([signal["name"] for signal in signals], ["in__02Ea", "escaped__DOT__cnt__05Bhi__05D"])
+        self.assertEqual(signals[1]["hierarchy"], ["cnt[hi]"])
+
     @unittest.skipIf(shutil.which("verilator") is None, "test requires verilator to be in the path")
     @unittest.expectedFailure
     def test_pyverilator_modular(self):
@@ -27,9 +27,17 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import contextlib
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+
 import pkg_resources as pk
 
-from pyverilator import PyVerilator
+from pyverilator import BuildReport, PyVerilator
 
 axilite_expected_signals = [
     "AWVALID",
@@ -109,6 +117,8 @@ def rtlsim_multi_io(
     liveness_threshold=10000,
     hook_preclk=None,
     hook_postclk=None,
+    failure_trace_file="",
+    failure_trace_cycles=1000,
 ):
     """Runs the pyverilator simulation by passing the input values to the simulation,
     toggle the clock and observing the execution time. Function contains also an
@@ -133,98 +143,104 @@ def rtlsim_multi_io(
       terminate simulation
     * hook_preclk: hook function to call prior to clock tick
     * hook_postclk: hook function to call after clock tick
+    * failure_trace_file: vcd filename for the last failure_trace_cycles cycles,
+      which are kept in memory and only written if the simulation fails (e.g.
+      when the liveness_threshold is hit), empty string (no vcd dump) by default
+    * failure_trace_cycles: number of cycles kept for failure_trace_file
 
     Returns: number of clock cycles elapsed for completion
 
     """
 
     if trace_file != "":
-        sim.start_vcd_trace(trace_file)
-
-    for outp in io_dict["outputs"]:
-        _write_signal(sim, outp + sname + "TREADY", 1)
-
-    # observe if output is completely calculated
-    # total_cycle_count will contain the number of cycles the calculation ran
-    output_done = False
-    total_cycle_count = 0
-    output_count = 0
-    old_output_count = 0
-
-    # avoid infinite looping of simulation by aborting when there is no change in
-    # output values after 100 cycles
-    no_change_count = 0
-
-    while not (output_done):
-        for inp in io_dict["inputs"]:
-            inputs = io_dict["inputs"][inp]
-            _write_signal(sim, inp + sname + "TVALID", 1 if len(inputs) > 0 else 0)
-            _write_signal(sim, inp + sname + "TDATA", inputs[0] if len(inputs) > 0 else 0)
-            if _read_signal(sim, inp + sname + "TREADY") == 1 and _read_signal(sim, inp + sname + "TVALID") == 1:
-                inputs = inputs[1:]
-            io_dict["inputs"][inp] = inputs
+        # the trace is flushed once the simulation ends or raises, not after every clock edge
+        sim.start_trace(trace_file, flush_every=None)
 
+    try:
         for outp in io_dict["outputs"]:
-            outputs = io_dict["outputs"][outp]
-            if _read_signal(sim, outp + sname + "TREADY") == 1 and _read_signal(sim, outp + sname + "TVALID") == 1:
-                outputs = outputs + [_read_signal(sim, outp + sname + "TDATA")]
-                output_count += 1
-            io_dict["outputs"][outp] = outputs
-
-        if hook_preclk:
-            hook_preclk(sim)
-        toggle_clk(sim)
-        if hook_postclk:
-            hook_postclk(sim)
-
-        total_cycle_count = total_cycle_count + 1
-
-        if output_count == old_output_count:
-            no_change_count = no_change_count + 1
+            _write_signal(sim, outp + sname + "TREADY", 1)
+
+        # observe if output is completely calculated
+        # total_cycle_count will contain the number of cycles the calculation ran
+        output_done = False
+        total_cycle_count = 0
+        output_count = 0
+        old_output_count = 0
+
+        # avoid infinite looping of simulation by aborting when there is no change in
+        # output values after 100 cycles
+        no_change_count = 0
+
+        if failure_trace_file != "":
+            # the last cycles are recorded in memory and only written to a file if the simulation raises
+            flight_recorder = sim.flight_recorder(failure_trace_file, cycles=failure_trace_cycles)
         else:
-            no_change_count = 0
-            old_output_count = output_count
-
-        # check if all expected output words received
-        if output_count == num_out_values:
-            output_done = True
-
-        # end sim on timeout
-        if no_change_count == liveness_threshold:
-            if trace_file != "":
-                sim.flush_vcd_trace()
-                sim.stop_vcd_trace()
-            raise Exception(
-                "Error in simulation! Takes too long to produce output. "
-                "Consider setting the LIVENESS_THRESHOLD env.var. to a "
-                "larger value."
-            )
-
-    if trace_file != "":
-        sim.flush_vcd_trace()
-        sim.stop_vcd_trace()
+            flight_recorder = contextlib.nullcontext()
+
+        with flight_recorder:
+            while not (output_done):
+                for inp in io_dict["inputs"]:
+                    inputs = io_dict["inputs"][inp]
+                    _write_signal(sim, inp + sname + "TVALID", 1 if len(inputs) > 0 else 0)
+                    _write_signal(sim, inp + sname + "TDATA", inputs[0] if len(inputs) > 0 else 0)
+                    if _read_signal(sim, inp + sname + "TREADY") == 1 and _read_signal(sim, inp + sname + "TVALID") == 1:
+                        inputs = inputs[1:]
+                    io_dict["inputs"][inp] = inputs
+
+                for outp in io_dict["outputs"]:
+                    outputs = io_dict["outputs"][outp]
+                    if _read_signal(sim, outp + sname + "TREADY") == 1 and _read_signal(sim, outp + sname + "TVALID") == 1:
+                        outputs = outputs + [_read_signal(sim, outp + sname + "TDATA")]
+                        output_count += 1
+                    io_dict["outputs"][outp] = outputs
+
+                if hook_preclk:
+                    hook_preclk(sim)
+                toggle_clk(sim)
+                if hook_postclk:
+                    hook_postclk(sim)
+
+                total_cycle_count = total_cycle_count + 1
+
+                if output_count == old_output_count:
+                    no_change_count = no_change_count + 1
+                else:
+                    no_change_count = 0
+                    old_output_count = output_count
+
+                # check if all expected output words received
+                if output_count == num_out_values:
+                    output_done = True
+
+                # end sim on timeout
+                if no_change_count == liveness_threshold:
+                    raise Exception(
+                        "Error in simulation! Takes too long to produce output. "
+                        "Consider setting the LIVENESS_THRESHOLD env.var. to a "
+                        "larger value."
+                    )
+    finally:
+        if trace_file != "":
+            sim.flush_vcd_trace()
+            sim.stop_vcd_trace()
 
     return total_cycle_count
 
 
 def _find_signal(sim, signal_name):
     # handle both mixed caps and lowercase signal names
-    if signal_name in sim.io:
-        return signal_name
-    elif signal_name.lower() in sim.io:
-        return signal_name.lower()
-    else:
+    signal = sim.find_signal(signal_name)
+    if signal is None:
         raise Exception("Signal not found: " + signal_name)
+    return signal
 
 
 def _read_signal(sim, signal_name):
-    signal_name = _find_signal(sim, signal_name)
-    return sim.io[signal_name]
+    return _find_signal(sim, signal_name).collection_get()
 
 
 def _write_signal(sim, signal_name, signal_value):
-    signal_name = _find_signal(sim, signal_name)
-    sim.io[signal_name] = signal_value
+    _find_signal(sim, signal_name).collection_set(signal_value)
 
 
 def reset_rtlsim(sim, rst_name="ap_rst_n", active_low=True, clk_name="ap_clk"):
@@ -345,30 +361,101 @@ def axilite_read(sim, addr, basename="s_axi_control_"):
     return ret_data
 
 
-def create_axi_mem_hook(ref_sim, aximm_ifname, mem_depth, mem_init_file="", trace_file=""):
+def parse_readmemh(mem_init_file):
+    """Read a memory initialization file in the format of $readmemh.
+
+    Returns: a dict mapping addresses to values. Whitespace separated hex values,
+    _ separators, @address directives and // and /* */ comments are supported.
+    """
+    with open(mem_init_file, "r") as f:
+        text = f.read()
+    text = re.sub(r"/\*.*?\*/", " ", text, flags=re.S)
+    text = re.sub(r"//[^\n]*", " ", text)
+    contents = {}
+    address = 0
+    for token in text.split():
+        if token.startswith("@"):
+            address = int(token[1:], 16)
+        else:
+            contents[address] = int(token.replace("_", ""), 16)
+            address += 1
+    return contents
+
+
+# AXI memory models compiled by this process, by (data width, address width, id width, depth). Only the
+# BuildResult is kept: it owns the build directory of the model until the end of the process, while the
+# simulations handed to callers are separate instances that are freed as usual.
+_axi_mem_models = {}
+_axi_mem_models_lock = threading.Lock()
+
+
+def build_axi_mem(data_width, addr_width, id_width, mem_depth, cache=None):
+    """Return a new AXI slave memory model (axi_ram from verilog-axi) with the
+    given interface widths and depth.
+
+    The model is only compiled once per geometry and process: later calls load
+    another instance of the same shared object, their build_report only has a
+    load phase. Every instance is loaded from a link of its own, so instances
+    do not share the state of the library. cache selects the build cache like
+    in PyVerilator.build(), to also reuse the model across processes. By
+    default it is only used if $PYVERILATOR_CACHE_DIR is set. The contents of
+    the memory are not part of the model, they can be written at runtime with
+    sim.internals.mem.load()."""
+    key = (data_width, addr_width, id_width, mem_depth)
+    # threads building the same geometry at the same time wait for the first one instead of building it again
+    with _axi_mem_models_lock:
+        result = _axi_mem_models.get(key)
+        if result is not None:
+            report = BuildReport("axi_ram")
+            report.so_file = result.so_file
+        else:
+            example_root = pk.resource_filename("pyverilator.data", "verilog/verilog-axi")
+            result = PyVerilator.build(
+                "axi_ram.v",
+                verilog_path=[example_root],
+                top_module_name="axi_ram",
+                extra_args=[
+                    "-GDATA_WIDTH=%d" % data_width,
+                    "-GADDR_WIDTH=%d" % addr_width,
+                    "-GID_WIDTH=%d" % id_width,
+                    "-GSTRB_WIDTH=%d" % (data_width // 8),
+                    "-GMEM_DEPTH=%d" % mem_depth,
+                ],
+                read_internal_signals=True,
+                cache=cache,
+                _load=False,
+            )
+            _axi_mem_models[key] = result
+            report = result.report
+    start = time.perf_counter()
+    load_dir = tempfile.mkdtemp(prefix="axi_ram-")
+    so_file = os.path.join(load_dir, os.path.basename(result.so_file))
+    try:
+        os.link(result.so_file, so_file)
+    except OSError:
+        shutil.copy2(result.so_file, so_file)
+    aximem_sim = PyVerilator(so_file, builddir_to_remove=load_dir, mem_init_dirs=result.mem_init_dirs)
+    report.phases["load"] = time.perf_counter() - start
+    aximem_sim.build_report = report
+    aximem_sim.build_times = report.phases
+    aximem_sim.build_log = report.log
+    return aximem_sim
+
+
+def create_axi_mem_hook(ref_sim, aximm_ifname, mem_depth, mem_init_file="", trace_file="", cache=None):
     """Create and return a pair of (pre_hook, post_hook) functions to serve
-    as an AXI slave memory on the AXI MM master interface with given name."""
+    as an AXI slave memory on the AXI MM master interface with given name.
+
+    The memory model is built by build_axi_mem() with the given cache, and
+    mem_init_file is loaded into it at runtime."""
     # find the AXI-MM master interface with given name and extract interface widths
     data_width = ref_sim.io[aximm_ifname + "RDATA"].signal.width
     id_width = ref_sim.io[aximm_ifname + "RID"].signal.width
     addr_width = ref_sim.io[aximm_ifname + "ARADDR"].signal.width
-    strb_width = int(data_width / 8)
     # create pyverilator sim object for AXI memory
-    example_root = pk.resource_filename("pyverilator.data", "verilog/verilog-axi")
-    aximem_sim = PyVerilator.build(
-        "axi_ram.v",
-        verilog_path=[example_root],
-        top_module_name="axi_ram",
-        extra_args=[
-            "-GDATA_WIDTH=%d" % data_width,
-            "-GADDR_WIDTH=%d" % addr_width,
-            "-GID_WIDTH=%d" % id_width,
-            "-GSTRB_WIDTH=%d" % strb_width,
-            "-GMEM_DEPTH=%d" % mem_depth,
-            '-GMEM_INIT_FILE="%s"' % mem_init_file,
-            "-GDO_MEM_INIT=%d" % (1 if mem_init_file != "" else 0),
-        ],
-    )
+    aximem_sim = build_axi_mem(data_width, addr_width, id_width, mem_depth, cache=cache)
+    if mem_init_file != "":
+        aximem_sim.internals["mem"].load(parse_readmemh(mem_init_file))
     master_to_slave = []
     slave_to_master = []
     aximem_ifname = "s_axi_"
@@ -385,7 +472,7 @@ def create_axi_mem_hook(ref_sim, aximm_ifname, mem_depth, mem_init_file="", trac
     # apply reset
     reset_rtlsim(aximem_sim, "rst", False, clk_name="clk")
     if trace_file != "":
-        aximem_sim.start_vcd_trace(trace_file)
+        aximem_sim.start_trace(trace_file)
     # define hook functions
 
     def sim_hook_axi_mem_preclk(sim):
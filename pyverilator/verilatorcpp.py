@@ -1,15 +1,29 @@
-def header_cpp(top_module):
+def header_cpp(top_module, root_header=False, trace_format="vcd"):
     s = """#include <cstddef>
+#include <map>
+#include <mutex>
+#include <string>
+#include <vector>
+#include <unistd.h>
 #include "verilated.h"
-#include "verilated_vcd_c.h"
+#include "{trace_header}"
 #include "{module_filename}.h"
+// the trace writer the model was built for (verilator --trace or --trace-fst)
+typedef {trace_class} _pyverilator_trace_t;
     """.format(
-        module_filename="V" + top_module
+        module_filename="V" + top_module,
+        trace_header="verilated_fst_c.h" if trace_format == "fst" else "verilated_vcd_c.h",
+        trace_class="VerilatedFstC" if trace_format == "fst" else "VerilatedVcdC",
     )
+    if root_header:
+        # verilator 5 keeps the internal signals in the root class of the model
+        s += '#include "V{}___024root.h"\n'.format(top_module)
     return s
 
 
-def var_declaration_cpp(top_module, inputs, outputs, internal_signals, json_data):
+def var_declaration_cpp(
+    top_module, inputs, outputs, internal_signals, json_data, threads=1, internal_arrays=[], trace_format="vcd"
+):
     s = """// pyverilator defined values
 // first declare variables as extern
 extern const char* _pyverilator_module_name;
@@ -22,9 +36,15 @@ extern const uint32_t _pyverilator_output_widths[];
 extern const uint32_t _pyverilator_num_internal_signals;
 extern const char* _pyverilator_internal_signals[];
 extern const uint32_t _pyverilator_internal_signal_widths[];
+extern const uint32_t _pyverilator_num_internal_arrays;
+extern const char* _pyverilator_internal_arrays[];
+extern const uint32_t _pyverilator_internal_array_widths[];
+extern const uint32_t _pyverilator_internal_array_lengths[];
 extern const uint32_t _pyverilator_num_rules;
 extern const char* _pyverilator_rules[];
 extern const char* _pyverilator_json_data;
+extern const uint32_t _pyverilator_threads;
+extern const char* _pyverilator_trace_format;
 // now initialize the variables
 const char* _pyverilator_module_name = "{top_module}";
 const uint32_t _pyverilator_num_inputs = {nb_inputs};
@@ -39,8 +59,17 @@ const uint32_t _pyverilator_num_internal_signals = {nb_internals};
 const char* _pyverilator_internal_signals[] = {{{name_internals}}};
 const uint32_t _pyverilator_internal_signal_widths[] = {{{size_internals}}};
 
+const uint32_t _pyverilator_num_internal_arrays = {nb_arrays};
+const char* _pyverilator_internal_arrays[] = {{{name_arrays}}};
+const uint32_t _pyverilator_internal_array_widths[] = {{{size_arrays}}};
+const uint32_t _pyverilator_internal_array_lengths[] = {{{length_arrays}}};
+
 const char* _pyverilator_json_data = {json_data};
 
+const uint32_t _pyverilator_threads = {threads};
+
+const char* _pyverilator_trace_format = "{trace_format}";
+
 // this is required by verilator for verilog designs using $time
 // main_time is incremented in eval
 double main_time = 0;
@@ -55,68 +84,453 @@ double main_time = 0;
         nb_internals=len(internal_signals),
         name_internals=",".join(map(lambda internal: '"' + internal[0] + '"', internal_signals)),
         size_internals=",".join(map(lambda internal: str(internal[1]), internal_signals)),
+        nb_arrays=len(internal_arrays),
+        name_arrays=",".join(map(lambda array: '"' + array[0] + '"', internal_arrays)),
+        size_arrays=",".join(map(lambda array: str(array[1]), internal_arrays)),
+        length_arrays=",".join(map(lambda array: str(array_length(array[2])), internal_arrays)),
         json_data=json_data if json_data else "null",
+        threads=threads,
+        trace_format=trace_format,
     )
     return s
 
 
-def function_definitions_cpp(top_module, inputs, outputs, internal_signals, json_data):
-    constant_part = """double sc_time_stamp() {{
-return main_time;
+def array_length(dims):
+    length = 1
+    for dim in dims:
+        length *= dim
+    return length
+
+
+def array_index_cpp(dims):
+    """Returns the C++ subscripts that select the element at the flat (row-major) index 'index'."""
+    subscripts = ""
+    for i in range(len(dims)):
+        inner_length = array_length(dims[i + 1 :])
+        subscript = "index / %d" % inner_length if inner_length > 1 else "index"
+        if i > 0:
+            subscript = "(%s) %% %d" % (subscript, dims[i])
+        subscripts += "[" + subscript + "]"
+    return subscripts
+
+
+def construct_cpp(top_module, has_context):
+    """Returns the construct() and destruct() functions.
+
+    Verilator 4.2 and later create models in a VerilatedContext. Each model gets its own
+    context so that models are independent and the size of the thread pool used by
+    multithreaded models (verilator --threads) can be chosen when the model is constructed.
+    Older versions of verilator only have a global context and ignore the thread count."""
+    if has_context:
+        s = """{module_filename}* construct(uint32_t threads) {{
+    VerilatedContext* contextp = new VerilatedContext;
+    contextp->commandArgs(0, (const char**) nullptr);
+    contextp->traceEverOn(true);
+    _pyverilator_set_threads(contextp, threads, 0);
+    {module_filename}* top = new {module_filename}(contextp);
+    return top;
 }}
-// function definitions
-// helper functions for basic verilator tasks
-extern "C" {{ //Open an extern C closed in the footer
-{module_filename}* construct() {{
+int destruct({module_filename}* top) {{
+    if (top != nullptr) {{
+        _pyverilator_mem_init_release(top);
+        VerilatedContext* contextp = top->contextp();
+        delete top;
+        delete contextp;
+        top = nullptr;
+    }}
+    return 0;
+}}"""
+    else:
+        s = """{module_filename}* construct(uint32_t threads) {{
     Verilated::commandArgs(0, (const char**) nullptr);
     Verilated::traceEverOn(true);
     {module_filename}* top = new {module_filename}();
     return top;
 }}
-int eval({module_filename}* top) {{
-    top->eval();
-    main_time++;
-    return 0;
-}}
 int destruct({module_filename}* top) {{
     if (top != nullptr) {{
+        _pyverilator_mem_init_release(top);
         delete top;
         top = nullptr;
     }}
     return 0;
+}}"""
+    return s.format(module_filename="V" + top_module)
+
+
+def snapshot_word_cpp(member, width, offset):
+    # signals are stored in consecutive 32-bit words, least significant word first
+    if width > 64:
+        return "for (int i = 0; i < {words}; i++) buffer[{offset} + i] = top->{member}[i];".format(
+            words=(width + 31) // 32, offset=offset, member=member
+        )
+    elif width > 32:
+        return "buffer[{offset}] = (uint32_t)top->{member}; buffer[{next}] = (uint32_t)(top->{member} >> 32);".format(
+            offset=offset, next=offset + 1, member=member
+        )
+    return "buffer[{offset}] = top->{member};".format(offset=offset, member=member)
+
+
+def write_word_cpp(member, width, offset):
+    # the reverse of snapshot_word_cpp(), sets a signal from consecutive 32-bit words in buffer
+    if width > 64:
+        return "for (int i = 0; i < {words}; i++) top->{member}[i] = buffer[{offset} + i];".format(
+            words=(width + 31) // 32, member=member, offset=offset
+        )
+    elif width > 32:
+        return "top->{member} = (QData)buffer[{offset}] | ((QData)buffer[{next}] << 32);".format(
+            member=member, offset=offset, next=offset + 1
+        )
+    return "top->{member} = buffer[{offset}];".format(member=member, offset=offset)
+
+
+def snapshot_cpp(top_module, ports, internal_signals, internals_prefix=""):
+    """Returns the snapshot() function, which copies all ports and optionally all internal signals of the model
+    into one buffer with a single call.
+
+    The signals are stored in the order of ports followed by internal_signals (lists of (name, width) tuples),
+    each in (width + 31) / 32 words. Returns the number of words written."""
+    lines = []
+    offset = 0
+    for name, width in ports:
+        lines.append("    " + snapshot_word_cpp(name, width, offset))
+        offset += (width + 31) // 32
+    lines.append("    if (!internals) return {};".format(offset))
+    for name, width in internal_signals:
+        lines.append("    " + snapshot_word_cpp(internals_prefix + name, width, offset))
+        offset += (width + 31) // 32
+    return """int snapshot({module_filename}* top, uint32_t* buffer, int internals) {{
+{body}
+    return {words};
+}}""".format(
+        module_filename="V" + top_module, body="\n".join(lines), words=offset
+    )
+
+
+def signal_offsets_cpp(top_module, ports, internal_signals, internals_prefix=""):
+    """Returns the signal_offsets() function, which stores the byte offset of each signal in offsets, in the order
+    of ports followed by internal_signals (lists of (name, width) tuples), and the signal_root() function.
+
+    Signals are stored in plain memory that is owned by the model, so they can be read and written at a base
+    address + offset. The base of ports is the model, the base of internal signals is the address returned by
+    signal_root(): the root module (top->rootp) of verilator 5 models, whose internal signals are members of it,
+    and the model itself otherwise."""
+    root = "top->" + internals_prefix[: -len("->")] if internals_prefix else "top"
+    lines = [
+        "    offsets[{index}] = (int64_t)((uintptr_t)&(top->{member}) - (uintptr_t)top);".format(index=index, member=name)
+        for index, (name, _) in enumerate(ports)
+    ] + [
+        "    offsets[{index}] = (int64_t)((uintptr_t)&({root}->{member}) - (uintptr_t){root});".format(
+            index=len(ports) + index, root=root, member=name
+        )
+        for index, (name, _) in enumerate(internal_signals)
+    ]
+    return """void* signal_root({module_filename}* top) {{
+    return {root};
+}}
+int signal_offsets({module_filename}* top, int64_t* offsets) {{
+{body}
+    return {count};
+}}""".format(
+        module_filename="V" + top_module, root=root, body="\n".join(lines), count=len(ports) + len(internal_signals)
+    )
+
+
+def recorder_cpp(top_module, signals):
+    """Returns the record() function, which appends the values of some signals to the buffers of a list of
+    recorders, and its helpers, which are also used by run_cpp() and run_vectors_cpp() and must come first.
+
+    The signals of a recorder are their indices in signals (a list of (member, width) tuples, in the order of
+    signal_offsets()). Each sample is a row of row_words words at buffer + count * row_words, or at
+    buffer + (count % ring) * row_words for a ring buffer of ring rows: the cycle as two words, followed by the
+    value of each signal in (width + 31) / 32 words, least significant word first, like in snapshot(). The
+    buffer must have room for the row, it is grown by python. next links to the next recorder of the list."""
+    read_cases = "\n".join(
+        "    case {index}: {statement} return {words};".format(
+            index=index, statement=snapshot_word_cpp(member, width, 0), words=(width + 31) // 32
+        )
+        for index, (member, width) in enumerate(signals)
+    )
+    return """// the recorder of run() and run_vectors(), shared with python (see Recorder)
+typedef struct _pyverilator_recorder {{
+    const int* signals;
+    int32_t num_signals;
+    int32_t every_eval;
+    uint32_t* buffer;
+    uint64_t row_words;
+    uint64_t count;
+    uint64_t cycle;
+    uint64_t ring;
+    struct _pyverilator_recorder* next;
+}} _pyverilator_recorder_t;
+static uint32_t _pyverilator_read_words({module_filename}* top, int signal, uint32_t* buffer) {{
+    switch (signal) {{
+{read_cases}
+    }}
+    return 0;
+}}
+static void _pyverilator_record({module_filename}* top, _pyverilator_recorder_t* recorder) {{
+    for (; recorder; recorder = recorder->next) {{
+        uint64_t index = recorder->ring ? recorder->count % recorder->ring : recorder->count;
+        uint32_t* row = recorder->buffer + index * recorder->row_words;
+        row[0] = (uint32_t) recorder->cycle;
+        row[1] = (uint32_t) (recorder->cycle >> 32);
+        row += 2;
+        for (int i = 0; i < recorder->num_signals; i++) row += _pyverilator_read_words(top, recorder->signals[i], row);
+        recorder->count++;
+        recorder->cycle++;
+    }}
+}}
+int record({module_filename}* top, _pyverilator_recorder_t* recorder) {{
+    _pyverilator_record(top, recorder);
+    return 0;
+}}""".format(
+        module_filename="V" + top_module, read_cases=read_cases
+    )
+
+
+def run_cpp(top_module, inputs, signals):
+    """Returns the run() function, which toggles a clock for a number of cycles in a native loop. It uses the
+    helpers of recorder_cpp(), which must come first.
+
+    clock is the index of a 1-bit input in inputs, and stop the index of the signal (of up to 64 bits) in signals
+    that ends the loop early, or -1. Both lists contain (member, width) tuples, signals in the order of
+    signal_offsets(). Each cycle sets the clock to 0 and then to 1 and evaluates the model after each change.
+    The loop stops after a cycle in which (signal & stop_mask) == stop_value. Returns the number of cycles run.
+
+    If tracer is not null, each change is traced like the automatic tracing of python does: *time advances by
+    10, and if the trigger signal matched once and the cycle (counted from the trigger, or from the start of
+    the trace without one) is in [start_cycle, stop_cycle), the model is dumped twice like add_to_vcd_trace().
+    The trace is not flushed, that is left to the flush policy in python. If recorder is not null, it records
+    a sample after each rising edge of the clock, or after each evaluation if every_eval is set."""
+    clock_cases = "\n".join(
+        "    case {index}: top->{member} = value; break;".format(index=index, member=member)
+        for index, (member, width) in enumerate(inputs)
+        if width == 1
+    )
+    signal_cases = "\n".join(
+        "    case {index}: return top->{member};".format(index=index, member=member)
+        for index, (member, width) in enumerate(signals)
+        if width <= 64
+    )
+    return """// the trace of run() and run_vectors(), shared with python (see PyVerilator._tracer)
+typedef struct {{
+    _pyverilator_trace_t* tfp;
+    uint64_t cycle;
+    uint64_t start_cycle;
+    uint64_t stop_cycle;
+    int64_t trigger;
+    uint64_t trigger_mask;
+    uint64_t trigger_value;
+    uint64_t dumps;
+}} _pyverilator_tracer_t;
+static void _pyverilator_set_clock({module_filename}* top, int clock, uint8_t value) {{
+    switch (clock) {{
+{clock_cases}
+    }}
+}}
+static uint64_t _pyverilator_read_signal({module_filename}* top, int signal) {{
+    switch (signal) {{
+{signal_cases}
+    }}
+    return 0;
+}}
+static void _pyverilator_trace_step({module_filename}* top, _pyverilator_tracer_t* tracer, uint64_t* time) {{
+    if (tracer->trigger >= 0) {{
+        if ((_pyverilator_read_signal(top, tracer->trigger) & tracer->trigger_mask) != tracer->trigger_value) {{
+            *time += 10;
+            return;
+        }}
+        tracer->trigger = -1;
+    }}
+    if (tracer->cycle >= tracer->start_cycle && tracer->cycle < tracer->stop_cycle) {{
+        *time += 5;
+        tracer->tfp->dump(*time);
+        *time += 5;
+        tracer->tfp->dump(*time);
+        tracer->dumps++;
+    }} else {{
+        *time += 10;
+    }}
+}}
+static void _pyverilator_clock_cycle({module_filename}* top, _pyverilator_tracer_t* tracer,
+                                     _pyverilator_recorder_t* recorder, uint64_t* time, int clock) {{
+    for (uint8_t level = 0; level < 2; level++) {{
+        _pyverilator_set_clock(top, clock, level);
+        eval(top);
+        if (tracer) _pyverilator_trace_step(top, tracer, time);
+        if (recorder && (level || recorder->every_eval)) _pyverilator_record(top, recorder);
+    }}
+    if (tracer && tracer->trigger < 0) tracer->cycle++;
+}}
+uint64_t run({module_filename}* top, _pyverilator_tracer_t* tracer, _pyverilator_recorder_t* recorder, uint64_t* time,
+             int clock, uint64_t cycles, int stop, uint64_t stop_mask, uint64_t stop_value) {{
+    uint64_t cycle = 0;
+    while (cycle < cycles) {{
+        _pyverilator_clock_cycle(top, tracer, recorder, time, clock);
+        cycle++;
+        if (stop >= 0 && (_pyverilator_read_signal(top, stop) & stop_mask) == stop_value) break;
+    }}
+    return cycle;
+}}""".format(
+        module_filename="V" + top_module, clock_cases=clock_cases, signal_cases=signal_cases
+    )
+
+
+def run_vectors_cpp(top_module, inputs, signals):
+    """Returns the run_vectors() function, which applies per-cycle input values and samples signals in a native
+    loop. It uses the helpers of recorder_cpp() and run_cpp(), which must come first.
+
+    The inputs and outputs arguments of run_vectors() are the numbers of the inputs to write and of the signals
+    to sample, i.e. their indices in inputs and signals (lists of (member, width) tuples, as in run()). Each
+    cycle, the values of the inputs are taken from input_buffer, the clock is ticked like in run(), and then
+    the values of the outputs are appended to output_buffer. Values are stored in (width + 31) / 32 words,
+    least significant word first, like in snapshot(), so both buffers consist of one row of words per cycle."""
+    write_cases = "\n".join(
+        "    case {index}: {statement} return {words};".format(
+            index=index, statement=write_word_cpp(member, width, 0), words=(width + 31) // 32
+        )
+        for index, (member, width) in enumerate(inputs)
+    )
+    return """static uint32_t _pyverilator_write_input({module_filename}* top, int input, const uint32_t* buffer) {{
+    switch (input) {{
+{write_cases}
+    }}
+    return 0;
+}}
+uint64_t run_vectors({module_filename}* top, _pyverilator_tracer_t* tracer, _pyverilator_recorder_t* recorder,
+                     uint64_t* time, int clock, uint64_t cycles, const int* inputs, int num_inputs,
+                     const uint32_t* input_buffer, const int* outputs, int num_outputs, uint32_t* output_buffer) {{
+    for (uint64_t cycle = 0; cycle < cycles; cycle++) {{
+        for (int i = 0; i < num_inputs; i++) input_buffer += _pyverilator_write_input(top, inputs[i], input_buffer);
+        _pyverilator_clock_cycle(top, tracer, recorder, time, clock);
+        for (int i = 0; i < num_outputs; i++) output_buffer += _pyverilator_read_words(top, outputs[i], output_buffer);
+    }}
+    return cycles;
+}}""".format(
+        module_filename="V" + top_module, write_cases=write_cases
+    )
+
+
+def write_inputs_cpp(top_module, inputs):
+    """Returns the write_inputs() function, which sets several inputs of the model with a single call.
+
+    The values are stored in buffer in the order of inputs (a list of (name, width) tuples), each in
+    (width + 31) / 32 words, least significant word first, like in snapshot(). Only the inputs whose entry
+    in mask is non-zero are written."""
+    lines = []
+    offset = 0
+    for index, (name, width) in enumerate(inputs):
+        lines.append("    if (mask[{index}]) {statement}".format(index=index, statement=write_word_cpp(name, width, offset)))
+        offset += (width + 31) // 32
+    return """int write_inputs({module_filename}* top, const uint32_t* buffer, const uint8_t* mask) {{
+{body}
+    return 0;
+}}""".format(
+        module_filename="V" + top_module, body="\n".join(lines)
+    )
+
+
+def function_definitions_cpp(
+    top_module, inputs, outputs, internal_signals, json_data, has_context=False, internal_arrays=[], root_header=False
+):
+    constant_part = """{time_functions}
+// VerilatedContext::threads(n) only exists since verilator 5, so only call it if it is there
+template <typename T>
+auto _pyverilator_set_threads(T* contextp, uint32_t threads, int) -> decltype(contextp->threads(threads), void()) {{
+    if (threads > 0) contextp->threads(threads);
 }}
-VerilatedVcdC* start_vcd_trace({module_filename}* top, const char* filename) {{
-    VerilatedVcdC* tfp = new VerilatedVcdC;
+template <typename T>
+void _pyverilator_set_threads(T* contextp, uint32_t threads, long) {{}}
+// trace writers only select scopes with dumpvars() since verilator 4.2, without it everything is traced
+template <typename T>
+auto _pyverilator_dumpvars(T* tfp, int level, const char* hier, int) -> decltype(tfp->dumpvars(level, hier), int()) {{
+    tfp->dumpvars(level, hier);
+    return 1;
+}}
+template <typename T>
+int _pyverilator_dumpvars(T* tfp, int level, const char* hier, long) {{
+    return 0;
+}}
+// function definitions
+// helper functions for basic verilator tasks
+extern "C" {{ //Open an extern C closed in the footer
+{construct_functions}
+int eval({module_filename}* top) {{
+    _pyverilator_mem_init_model(top);
+    top->eval();
+    {time_increment}
+    return 0;
+}}
+_pyverilator_trace_t* start_vcd_trace({module_filename}* top, const char* filename, const char** scopes,
+                                      const int* levels, int num_scopes) {{
+    _pyverilator_trace_t* tfp = new _pyverilator_trace_t;
     top->trace(tfp, 99);
+    // the scopes must be selected before the signals are declared when the file is opened
+    for (int i = 0; i < num_scopes; i++) {{
+        if (!_pyverilator_dumpvars(tfp, levels[i], scopes[i], 0)) {{
+            delete tfp;
+            return nullptr;
+        }}
+    }}
     tfp->open(filename);
     return tfp;
 }}
-int add_to_vcd_trace(VerilatedVcdC* tfp, int time) {{
+int add_to_vcd_trace(_pyverilator_trace_t* tfp, uint64_t time) {{
     tfp->dump(time);
     return 0;
 }}
-int flush_vcd_trace(VerilatedVcdC* tfp) {{
+int flush_vcd_trace(_pyverilator_trace_t* tfp) {{
     tfp->flush();
     return 0;
 }}
-int stop_vcd_trace(VerilatedVcdC* tfp) {{
+int stop_vcd_trace(_pyverilator_trace_t* tfp) {{
     tfp->close();
     return 0;
 }}""".format(
-        module_filename="V" + top_module
+        module_filename="V" + top_module,
+        construct_functions=construct_cpp(top_module, has_context),
+        # with a context, each model keeps its own time; the global main_time is shared by all models
+        # loaded from the same shared object and must not be used as the time of a new model
+        time_functions="" if has_context else "double sc_time_stamp() {\nreturn main_time;\n}",
+        time_increment="top->contextp()->timeInc(1);" if has_context else "main_time++;",
     )
+    internals_prefix = "rootp->" if root_header else ""
     get_functions = "\n".join(
         map(
             lambda port: (
-                "uint32_t get_{portname}({module_filename}* top, int word)" "{{ return top->{portname}[word];}}"
+                "uint32_t get_{portname}({module_filename}* top, int word)" "{{ return top->{member}[word];}}"
                 if port[1] > 64
                 else (
-                    "uint64_t get_{portname}({module_filename}* top)" "{{return top->{portname};}}"
+                    "uint64_t get_{portname}({module_filename}* top)" "{{return top->{member};}}"
                     if port[1] > 32
-                    else "uint32_t get_{portname}({module_filename}* top)" "{{return top->{portname};}}"
+                    else "uint32_t get_{portname}({module_filename}* top)" "{{return top->{member};}}"
                 )
-            ).format(module_filename="V" + top_module, portname=port[0]),
-            outputs + inputs + internal_signals,
+            ).format(module_filename="V" + top_module, portname=port[0], member=port[2] + port[0]),
+            [port + ("",) for port in outputs + inputs]
+            + [(name, width, internals_prefix) for name, width in internal_signals],
+        )
+    )
+    # array elements are selected by their flat index
+    get_array_functions = "\n".join(
+        map(
+            lambda array: (
+                "uint32_t get_{name}({module_filename}* top, uint32_t index, int word)"
+                "{{ return top->{member}{subscripts}[word];}}"
+                if array[1] > 64
+                else (
+                    "uint64_t get_{name}({module_filename}* top, uint32_t index)" "{{return top->{member}{subscripts};}}"
+                    if array[1] > 32
+                    else "uint32_t get_{name}({module_filename}* top, uint32_t index)"
+                    "{{return top->{member}{subscripts};}}"
+                )
+            ).format(
+                module_filename="V" + top_module,
+                name=array[0],
+                member=internals_prefix + array[0],
+                subscripts=array_index_cpp(array[2]),
+            ),
+            internal_arrays,
         )
     )
     set_functions = "\n".join(
@@ -136,15 +550,144 @@ int stop_vcd_trace(VerilatedVcdC* tfp) {{
             inputs,
         )
     )
+    # signals wider than 64 bits are stored in arrays of 32-bit words, which are accessed through their address
+    words_functions = "\n".join(
+        "uint32_t* words_{name}({module_filename}* top) {{ return &top->{member}[0]; }}".format(
+            module_filename="V" + top_module, name=signal[0], member=signal[2] + signal[0]
+        )
+        for signal in [port + ("",) for port in outputs + inputs]
+        + [(name, width, internals_prefix) for name, width in internal_signals]
+        if signal[1] > 64
+    )
+    set_array_functions = "\n".join(
+        map(
+            lambda array: (
+                "int set_{name}({module_filename}* top, uint32_t index, int word, uint64_t new_value)"
+                "{{ top->{member}{subscripts}[word] = new_value; return 0;}}"
+                if array[1] > 64
+                else (
+                    "int set_{name}({module_filename}* top, uint32_t index, uint64_t new_value)"
+                    "{{ top->{member}{subscripts} = new_value; return 0;}}"
+                    if array[1] > 32
+                    else "int set_{name}({module_filename}* top, uint32_t index, uint32_t new_value)"
+                    "{{ top->{member}{subscripts} = new_value; return 0;}}"
+                )
+            ).format(
+                module_filename="V" + top_module,
+                name=array[0],
+                member=internals_prefix + array[0],
+                subscripts=array_index_cpp(array[2]),
+            ),
+            internal_arrays,
+        )
+    )
+    snapshot_function = snapshot_cpp(top_module, inputs + outputs, internal_signals, internals_prefix)
+    write_inputs_function = write_inputs_cpp(top_module, inputs)
+    signal_members = inputs + outputs + [(internals_prefix + name, width) for name, width in internal_signals]
+    signal_offsets_function = signal_offsets_cpp(top_module, inputs + outputs, internal_signals, internals_prefix)
+    recorder_function = recorder_cpp(top_module, signal_members)
+    run_function = run_cpp(top_module, inputs, signal_members)
+    run_vectors_function = run_vectors_cpp(top_module, inputs, signal_members)
     footer = "}"
-    return "\n".join([constant_part, get_functions, set_functions, footer])
+    return "\n".join(
+        [
+            constant_part,
+            get_functions,
+            get_array_functions,
+            words_functions,
+            set_functions,
+            set_array_functions,
+            snapshot_function,
+            write_inputs_function,
+            signal_offsets_function,
+            recorder_function,
+            run_function,
+            run_vectors_function,
+            footer,
+        ]
+    )
+
+
+def mem_init_cpp(wrap_fopen):
+    """Returns the fopen wrapper and set_mem_init_dirs() for models linked with -Wl,--wrap=fopen.
+
+    Each model has its own list of directories, set with set_mem_init_dirs(). eval() records the model
+    evaluated by the calling thread, and the wrapper looks up files with relative paths that are opened
+    for reading (e.g. by $readmemh) in the directories of that model before falling back to the working
+    directory. Without the wrapper, _pyverilator_mem_init_model() and _pyverilator_mem_init_release() do
+    nothing."""
+    if not wrap_fopen:
+        return """static inline void _pyverilator_mem_init_model(const void* top) {}
+static inline void _pyverilator_mem_init_release(const void* top) {}
+"""
+    return """// directories searched for memory initialization files, by model
+static std::mutex _pyverilator_mem_init_mutex;
+static std::map<const void*, std::vector<std::string>> _pyverilator_mem_init_dirs;
+// the model evaluated last by the calling thread
+static thread_local const void* _pyverilator_mem_init_current = nullptr;
+static inline void _pyverilator_mem_init_model(const void* top) {
+    _pyverilator_mem_init_current = top;
+}
+static void _pyverilator_mem_init_release(const void* top) {
+    if (_pyverilator_mem_init_current == top) _pyverilator_mem_init_current = nullptr;
+    std::lock_guard<std::mutex> lock(_pyverilator_mem_init_mutex);
+    _pyverilator_mem_init_dirs.erase(top);
+}
+extern "C" FILE* __real_fopen(const char* path, const char* mode);
+extern "C" FILE* __wrap_fopen(const char* path, const char* mode) {
+    if (path != nullptr && path[0] != '/' && mode != nullptr && mode[0] == 'r' &&
+        _pyverilator_mem_init_current != nullptr) {
+        std::vector<std::string> dirs;
+        {
+            std::lock_guard<std::mutex> lock(_pyverilator_mem_init_mutex);
+            auto it = _pyverilator_mem_init_dirs.find(_pyverilator_mem_init_current);
+            if (it != _pyverilator_mem_init_dirs.end()) dirs = it->second;
+        }
+        for (const std::string& dir : dirs) {
+            std::string dir_path = dir + "/" + path;
+            if (access(dir_path.c_str(), F_OK) == 0) return __real_fopen(dir_path.c_str(), mode);
+        }
+    }
+    return __real_fopen(path, mode);
+}
+extern "C" int set_mem_init_dirs(const void* top, const char** dirs, uint32_t num_dirs) {
+    std::lock_guard<std::mutex> lock(_pyverilator_mem_init_mutex);
+    _pyverilator_mem_init_dirs[top].assign(dirs, dirs + num_dirs);
+    return 0;
+}
+"""
+
 
+def template_cpp(
+    top_module,
+    inputs,
+    outputs,
+    internal_signals,
+    json_data,
+    threads=1,
+    has_context=False,
+    wrap_fopen=False,
+    internal_arrays=[],
+    root_header=False,
+    trace_format="vcd",
+):
+    """Returns the C++ wrapper of a verilated model.
 
-def template_cpp(top_module, inputs, outputs, internal_signals, json_data):
+    inputs, outputs and internal_signals are lists of (name, width) tuples, and
+    internal_arrays is a list of (name, width, dims) tuples, where width is the
+    width of one element and dims the sizes of the unpacked dimensions.
+    root_header is True for verilator 5 models, which keep internal signals in
+    their root class. trace_format is the waveform format the model was
+    verilated for, "vcd" (--trace) or "fst" (--trace-fst)."""
     return "\n".join(
         [
-            header_cpp(top_module),
-            var_declaration_cpp(top_module, inputs, outputs, internal_signals, json_data),
-            function_definitions_cpp(top_module, inputs, outputs, internal_signals, json_data),
+            header_cpp(top_module, root_header, trace_format),
+            var_declaration_cpp(
+                top_module, inputs, outputs, internal_signals, json_data, threads, internal_arrays, trace_format
+            ),
+            mem_init_cpp(wrap_fopen),
+            function_definitions_cpp(
+                top_module, inputs, outputs, internal_signals, json_data, has_context, internal_arrays, root_header
+            ),
         ]
     )